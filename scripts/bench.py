@@ -0,0 +1,130 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from steg.frame import Frame
+from steg.steg import encode, encode_video, decode, images_to_video, video_to_images
+
+RESOLUTIONS = {
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '1440p': (2560, 1440),
+}
+
+
+class Args(argparse.Namespace):
+    size: float
+    resolutions: list[str]
+    tile_sizes: list[int]
+    fps: int
+    seed: int
+    output: str
+
+
+def main():
+    argparser = argparse.ArgumentParser(prog="bench", description="measure encode/decode throughput on a synthetic payload")
+    argparser.add_argument('--size', '-s', type=float, default=1.0, help="payload size in MB")
+    argparser.add_argument('--resolutions', '-r', nargs='+', default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    argparser.add_argument('--tile-sizes', '-t', nargs='+', type=int, default=[16, 32, 48])
+    argparser.add_argument('--fps', '-f', type=int, default=20)
+    argparser.add_argument('--seed', type=int, default=0, help="seed for the payload, so runs are comparable across commits")
+    argparser.add_argument('--output', '-o', help="write the JSON report here instead of stdout")
+    args = argparser.parse_args(namespace=Args())
+
+    data = random.Random(args.seed).randbytes(int(args.size * 1_000_000))
+
+    results = []
+    for resolution_name in args.resolutions:
+        for tile_size in args.tile_sizes:
+            # progress output and ffmpeg logs go to stderr so stdout only has the report
+            with contextlib.redirect_stdout(sys.stderr):
+                results.append(run_case(data, RESOLUTIONS[resolution_name], tile_size, args.fps) | {
+                    'resolution': resolution_name,
+                    'tile_size': tile_size,
+                })
+
+    report = json.dumps({'payload_bytes': len(data), 'seed': args.seed, 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+def run_case(data: bytes, resolution: tuple[int, int], tile_size: int, fps: int) -> dict:
+    stages = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        video_path = os.path.join(workdir, 'test.mp4')
+        streamed_video_path = os.path.join(workdir, 'streamed.mp4')
+
+        frame_paths = measure(stages, 'encode', data, lambda: encode(data, resolution=resolution, tile_width=tile_size, tile_height=tile_size, output_path=workdir))
+        num_frames = len(frame_paths or [])
+        measure(stages, 'images_to_video', data, lambda: images_to_video(os.path.join(workdir, 'test_%03d.png'), video_path, framerate=fps), num_frames)
+        measure(stages, 'video_to_images', data, lambda: video_to_images(video_path, os.path.join(workdir, 'videoout%03d.png')), num_frames)
+        decoded = measure(stages, 'decode', data, lambda: decode_images(os.path.join(workdir, 'videoout*.png')), num_frames)
+        stages['decode']['matches'] = decoded == data
+
+        measure(stages, 'encode_video', data, lambda: encode_video(data, streamed_video_path, resolution=resolution, tile_width=tile_size, tile_height=tile_size, framerate=fps), num_frames)
+        decoded = measure(stages, 'decode_video', data, lambda: decode(streamed_video_path), num_frames)
+        stages['decode_video']['matches'] = decoded == data
+
+    return {'frames': num_frames, 'stages': stages}
+
+
+def decode_images(frames_glob: str) -> bytes:
+    frame_paths = sorted(glob.glob(frames_glob))
+    return b''.join(Frame.load_from_file(frame_path).decode() for frame_path in frame_paths)
+
+
+def measure(stages: dict, name: str, data: bytes, fn, num_frames: int = None):
+    """Runs one stage, recording its throughput and peak memory in stages[name]. Returns the stage's result."""
+    reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        result = fn()
+    except Exception as e:
+        stages[name] = {'error': str(e)}
+        return None
+    elapsed = time.perf_counter() - start
+
+    if num_frames is None:
+        num_frames = len(result)
+    stages[name] = {
+        'seconds': elapsed,
+        'mb_per_second': len(data) / 1_000_000 / elapsed,
+        'frames_per_second': num_frames / elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+        # ffmpeg runs in a child process; this is the largest child seen so far, not just this stage's
+        'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+    return result
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its own peak RSS, which makes per-stage peaks possible
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # otherwise fall back to the peak for the lifetime of the process (reported in bytes on macOS, KB elsewhere)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
@@ -1,33 +1,34 @@
 import argparse
-import glob
 import os
-import re
 
-from steg.frame import Frame
+from steg.cache import FrameCache
+from steg.search import search_images, search_video
 
 
 class Args(argparse.Namespace):
     frames_path: str
     needle: str
+    fuzziness: int
+    jobs: int
+    cache: bool
+    ignore_errors: bool
 
 
 def main():
     argparser = argparse.ArgumentParser(prog="byte finder")
-    argparser.add_argument('frames_path')
-    argparser.add_argument('needle')
+    argparser.add_argument('frames_path', help="a directory of PNG frames, or a video")
+    argparser.add_argument('needle', help="the bytes to search for, in hex")
+    argparser.add_argument('--fuzziness', '-f', default=17, type=int)
+    argparser.add_argument('--jobs', '-j', default=1, type=int, help="number of processes to decode frames with")
+    argparser.add_argument('--cache', default=False, action='store_true', help="cache decoded frames, so searching the same frames again is faster. "
+                                                                               "Keeps up to 1 GB of them in ~/.cache/steg/frames")
+    argparser.add_argument('--ignore-errors', default=False, action='store_true', help="search frames with tiles that couldn't be decoded too, as if those bytes were 0, "
+                                                                                       "instead of stopping. Needles that overlap them can be missed or misplaced")
     args = argparser.parse_args(namespace=Args())
 
     needle_bytes = bytes.fromhex(args.needle)
 
-    frames = glob.glob(os.path.join(args.frames_path, '*.png'))
-    frames = sorted(frames, key=lambda x: float(re.findall(r"(\d+)", x)[-1]))
-
-    for frame_path in frames:
-        frame = Frame.load_from_file(frame_path)
-        decoded = frame.decode()
-        try:
-            index = decoded.index(needle_bytes)
-        except ValueError:
-            continue
-        print(f"needle found in {frame_path} @ index {index}")
-
+    search = search_images if os.path.isdir(args.frames_path) else search_video
+    cache = FrameCache() if args.cache else None
+    for match in search(args.frames_path, needle_bytes, fuzziness=args.fuzziness, workers=args.jobs, cache=cache, ignore_errors=args.ignore_errors):
+        print(f"needle found in {match.source} @ offset {match.offset} (frame {match.frame})")
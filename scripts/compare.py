@@ -1,4 +1,5 @@
 import argparse
+from steg.cache import FrameCache
 from steg.frame import Frame
 from steg.util import fuzzy_equals
 
@@ -7,6 +8,7 @@ class Args(argparse.Namespace):
     file1: str
     file2: str
     fuzziness: int
+    no_cache: bool
 
 
 def main():
@@ -14,10 +16,12 @@ def main():
     argparser.add_argument('file1')
     argparser.add_argument('file2')
     argparser.add_argument('--fuzziness', '-f', default=17, type=int)
+    argparser.add_argument('--no-cache', default=False, action='store_true', help="don't read or write the decoded frame cache, which keeps up to 1 GB of decoded frames in ~/.cache/steg/frames")
     args = argparser.parse_args(namespace=Args())
 
-    frame1 = Frame.load_from_file(args.file1)
-    frame2 = Frame.load_from_file(args.file2)
+    cache = None if args.no_cache else FrameCache()
+    frame1 = Frame.load_from_file(args.file1, cache=cache)
+    frame2 = Frame.load_from_file(args.file2, cache=cache)
 
     decoded1 = frame1.decode()
     decoded2 = frame2.decode()
@@ -1,5 +1,7 @@
 import argparse
+from steg.cache import FrameCache
 from steg.frame import Frame
+from steg.palette import load_palette
 import sys
 
 
@@ -7,6 +9,9 @@ class Args(argparse.Namespace):
     file: str
     output: str
     raw: str
+    no_cache: bool
+    palette: str
+    palette_seed: str
 
 
 def main():
@@ -14,9 +19,15 @@ def main():
     argparser.add_argument('file')
     argparser.add_argument('-o', '--output')
     argparser.add_argument('-r', '--raw', action='store_true')
+    argparser.add_argument('--no-cache', default=False, action='store_true', help="don't read or write the decoded frame cache, which keeps up to 1 GB of decoded frames in ~/.cache/steg/frames")
+    argparser.add_argument('--palette', '-p', help="the palette file the frame was encoded with, if it wasn't encoded on this machine")
+    argparser.add_argument('--palette-seed', '-s', help="the palette seed the frame was encoded with, if it wasn't encoded on this machine")
     args = argparser.parse_args(namespace=Args())
+    if args.palette and args.palette_seed:
+        argparser.error("--palette and --palette-seed can't be combined")
+    load_palette(args.palette, args.palette_seed)
 
-    frame = Frame.load_from_file(args.file)
+    frame = Frame.load_from_file(args.file, cache=None if args.no_cache else FrameCache())
     decoded = frame.decode()
 
     if args.output:
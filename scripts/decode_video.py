@@ -1,7 +1,13 @@
 import argparse
+import math
+import sys
 import time
 
-from steg.steg import decode
+from steg.archive import extract, read_manifest
+from steg.cache import FrameCache
+from steg.palette import load_palette
+from steg.stats import Stats
+from steg.steg import decode_into, decode_to_file
 
 
 class Args(argparse.Namespace):
@@ -9,22 +15,81 @@ class Args(argparse.Namespace):
     output: str
     keep_images: bool
     fuzziness: int
+    jobs: int
+    stats: str
+    range: str
+    cache: bool
+    decimate: bool
+    mapped: bool
+    extract: str
+    list: bool
+    palette: str
+    palette_seed: str
 
 
 def main():
     argparser = argparse.ArgumentParser(prog="decode_video")
     argparser.add_argument('input')
-    argparser.add_argument('output')
+    argparser.add_argument('output', nargs='?', help="file to write, not needed with --list")
     argparser.add_argument('--keep-images', '-k', default=False, action='store_true')
     argparser.add_argument('--fuzziness', '-f', default=17, type=int)
+    argparser.add_argument('--jobs', '-j', default=1, type=int, help="number of processes to decode frames with")
+    argparser.add_argument('--stats', choices=['text', 'json'], help="print stage timings and frame/tile counters when done")
+    argparser.add_argument('--range', '-r', help="only decode payload bytes START:END (END exclusive), seeking straight to them")
+    argparser.add_argument('--cache', default=False, action='store_true', help="cache decoded frames, so decoding the same video again is faster. "
+                                                                               "Keeps up to 1 GB of them in ~/.cache/steg/frames")
+    argparser.add_argument('--mapped', '-m', default=False, action='store_true', help="write each frame straight to its offset in the output file as it's decoded, "
+                                                                                   "keeping frames that arrive out of order and listing any that are missing")
+    argparser.add_argument('--decimate', default=False, action='store_true', help="have ffmpeg drop repeated frames, for videos whose frame rate was raised (ignored with --range)")
+    argparser.add_argument('--extract', '-x', metavar='NAME', help="extract the file with this name from a video made with encode_file --archive, decoding only the frames that hold it")
+    argparser.add_argument('--list', '-l', default=False, action='store_true', help="list the files in a video made with encode_file --archive")
+    argparser.add_argument('--palette', '-p', help="the palette file the video was encoded with, if it wasn't encoded on this machine")
+    argparser.add_argument('--palette-seed', '-s', help="the palette seed the video was encoded with, if it wasn't encoded on this machine")
 
 
     args = argparser.parse_args(namespace=Args())
+    if args.output is None and not args.list:
+        argparser.error("the output file is required unless --list is given")
+    if (args.extract or args.list) and (args.range or args.mapped or args.keep_images):
+        argparser.error("--extract and --list can't be combined with --range, --mapped or --keep-images")
+    if args.palette and args.palette_seed:
+        argparser.error("--palette and --palette-seed can't be combined")
+    load_palette(args.palette, args.palette_seed)
 
     start_time = time.time()
 
-    with open(args.output, 'wb') as f:
-        f.write(decode(args.input, keep_images=args.keep_images, fuzziness=args.fuzziness))
+    byte_range = None
+    if args.range:
+        start, end = args.range.split(':')
+        byte_range = (int(start or 0), int(end) if end else math.inf)
 
-    print()
-    print(f"took {time.time() - start_time}s")
+    stats = Stats()
+    cache = FrameCache() if args.cache else None
+    if args.list:
+        manifest, _ = read_manifest(args.input, fuzziness=args.fuzziness, stats=stats, cache=cache)
+        for entry in manifest:
+            print(f"{entry.size:>12}  {entry.name}")
+    elif args.extract:
+        with open(args.output, 'wb') as f:
+            extract(args.input, args.extract, f, fuzziness=args.fuzziness, workers=args.jobs, stats=stats, cache=cache)
+    elif args.mapped:
+        if byte_range is not None or args.keep_images:
+            argparser.error("--mapped can't be combined with --range or --keep-images")
+        missing = decode_to_file(args.input, args.output, fuzziness=args.fuzziness, workers=args.jobs, stats=stats,
+                                 cache=cache, decimate=args.decimate)
+        if missing:
+            print(file=sys.stderr)
+            print(f"missing frames: {', '.join(str(frame_index) for frame_index in missing)}", file=sys.stderr)
+    else:
+        with open(args.output, 'wb') as f:
+            decode_into(args.input, f, keep_images=args.keep_images, fuzziness=args.fuzziness, workers=args.jobs, stats=stats,
+                        byte_range=byte_range, cache=cache, decimate=args.decimate)
+
+    # progress and timing go to stderr, so stdout only has the stats (or the --list output)
+    print(file=sys.stderr)
+    print(f"took {time.time() - start_time}s", file=sys.stderr)
+
+    if args.stats == 'json':
+        print(stats.to_json())
+    elif args.stats == 'text':
+        print(stats)
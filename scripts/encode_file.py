@@ -1,27 +1,102 @@
 import argparse
 import os.path
-from steg.steg import encode, images_to_video
+import sys
+from typing import Optional
+
+from steg.archive import Manifest, archive_name, encode_archive
+from steg.codec import codec_names
+from steg.stats import Stats
+from steg.index import FrameIndex
+from steg.palette import Palette, load_palette
+from steg.steg import encode_video, estimate_encode
 
 
 class Args(argparse.Namespace):
-    input_file: str
+    input_files: list[str]
     output: str
     fps: int
     width: int
     height: int
     tile_size: int
+    keep_images: bool
+    jobs: int
+    stats: str
+    dry_run: bool
+    compression: str
+    fec: int
+    palette: str
+    palette_seed: str
+    archive: bool
 
 
 def main():
-    argparser = argparse.ArgumentParser(prog="encode_file")
-    argparser.add_argument('input_file')
+    argparser = argparse.ArgumentParser(prog="encode_file", fromfile_prefix_chars='@')
+    argparser.add_argument('input_files', nargs='+', metavar='input_file', help="file to encode, or - to read from stdin. "
+                                                                           "With --archive, any number of files, or @FILE to read their paths from FILE, one per line")
     argparser.add_argument('output')
     argparser.add_argument('--fps', '-f', type=int, default=3)
     argparser.add_argument('--width', '-w', type=int, default=1280)
     argparser.add_argument('--height', '-H', type=int, default=720)
     argparser.add_argument('--tile_size', '-t', type=int, default=None)
+    argparser.add_argument('--keep-images', '-k', default=False, action='store_true', help="also save each frame as a PNG in the output directory")
+    argparser.add_argument('--jobs', '-j', default=1, type=int, help="number of processes to render frames with")
+    argparser.add_argument('--stats', choices=['text', 'json'], help="print stage timings and frame counters when done")
+    argparser.add_argument('--compression', '-c', choices=codec_names(), help="compress the input before encoding it, unless it already looks compressed")
+    argparser.add_argument('--fec', '-e', type=int, default=0, help="Reed-Solomon parity tiles per 255-tile codeword, so frames survive compression with smaller tiles (0 for none)")
+    argparser.add_argument('--palette', '-p', help="draw the data in the colors of this palette file: 768 bytes of RGB, one for each byte value, "
+                                                   "or 256 bytes giving the value of each default palette color. Decoding needs the same palette")
+    argparser.add_argument('--palette-seed', '-s', help="scramble the default palette with this seed. Decoding needs the same seed")
+    argparser.add_argument('--archive', '-a', default=False, action='store_true', help="pack all the input files into one video, with a manifest so each file can be extracted on its own with decode_video --extract")
+    argparser.add_argument('--dry-run', '-n', default=False, action='store_true', help="only print the predicted tile size, frame count, duration and video size (before any compression)")
     args = argparser.parse_args(namespace=Args())
 
-    with open(args.input_file, 'rb') as f:
-        encode(f.read(), output_path=args.output, resolution=(args.width, args.height), tile_width=args.tile_size, tile_height=args.tile_size)
-    images_to_video(os.path.join(args.output, 'test_%03d.png'), os.path.join(args.output, 'out.mp4'), framerate=args.fps)
+    if len(args.input_files) > 1 and not args.archive:
+        argparser.error("only one input file can be encoded at a time without --archive")
+    if args.archive and ('-' in args.input_files or args.compression):
+        argparser.error("--archive can't read from stdin or be combined with --compression")
+    if args.palette and args.palette_seed:
+        argparser.error("--palette and --palette-seed can't be combined")
+    palette = load_palette(args.palette, args.palette_seed)
+
+    if args.dry_run:
+        if args.input_files == ['-']:
+            argparser.error("--dry-run needs the length of the input, so it can't read from stdin")
+        if args.archive:
+            # the checksums don't change the manifest's length much, so they're left out rather than reading every file
+            data_length = Manifest([(archive_name(path), os.path.getsize(path), 0) for path in args.input_files]).total_bytes
+        else:
+            data_length = os.path.getsize(args.input_files[0])
+        estimate = estimate_encode(data_length, resolution=(args.width, args.height),
+                                   tile_width=args.tile_size, tile_height=args.tile_size, framerate=args.fps, fec=args.fec, palette=palette)
+        print(f"tiles: {estimate['tile_width']}x{estimate['tile_height']} ({estimate['columns']}x{estimate['rows']} per frame, {estimate['bytes_per_frame']} bytes)")
+        print(f"frames: {estimate['frames']}")
+        print(f"duration: {estimate['duration_seconds']:.1f}s at {args.fps} fps")
+        print(f"video size: ~{estimate['video_bytes'] / 1_000_000:.2f} MB")
+        return
+
+    stats = Stats()
+    if args.archive:
+        video_path = os.path.join(args.output, 'out.mp4')
+        encode_archive(args.input_files, video_path, resolution=(args.width, args.height),
+                       tile_width=args.tile_size, tile_height=args.tile_size, framerate=args.fps,
+                       images_path=args.output if args.keep_images else None, workers=args.jobs, stats=stats, fec=args.fec,
+                       palette=palette)
+    elif args.input_files == ['-']:
+        # the length of piped input isn't known up front
+        encode_stream(sys.stdin.buffer, None, args, stats, palette)
+    else:
+        with open(args.input_files[0], 'rb') as f:
+            encode_stream(f, os.path.getsize(args.input_files[0]), args, stats, palette)
+
+    if args.stats == 'json':
+        print(stats.to_json())
+    elif args.stats == 'text':
+        print(stats)
+
+
+def encode_stream(stream, data_length, args: Args, stats: Stats, palette: Optional[Palette] = None):
+    video_path = os.path.join(args.output, 'out.mp4')
+    encode_video(stream, video_path, resolution=(args.width, args.height),
+                 tile_width=args.tile_size, tile_height=args.tile_size, framerate=args.fps,
+                 images_path=args.output if args.keep_images else None, workers=args.jobs, data_length=data_length,
+                 stats=stats, index_path=FrameIndex.sidecar_path(video_path), compression=args.compression, fec=args.fec, palette=palette)
@@ -1,6 +1,5 @@
-from steg.steg import encode, images_to_video
+from steg.steg import encode_video
 
 def main():
     data = b''.join([x.to_bytes() for x in range(256)])
-    encode(data, output_path="scripts")
-    images_to_video('scripts/test_%03d.png', 'rainbow.mp4', framerate=1)
+    encode_video(data, 'rainbow.mp4', framerate=1, images_path="scripts")
@@ -0,0 +1,55 @@
+import argparse
+import os
+
+from steg.cache import FrameCache
+from steg.palette import Palette
+from steg.server import StegService, make_server
+
+
+class Args(argparse.Namespace):
+    host: str
+    port: int
+    socket: str
+    jobs: int
+    max_jobs: int
+    fuzziness: int
+    cache: bool
+    root: str
+    palette: list[str]
+    palette_seed: list[str]
+    token: str
+    quiet: bool
+
+
+def main():
+    argparser = argparse.ArgumentParser(prog="serve", description="run a local encode/decode service with warm worker processes, see steg/server.py for the API")
+    argparser.add_argument('--host', default='127.0.0.1')
+    argparser.add_argument('--port', '-p', default=8375, type=int)
+    argparser.add_argument('--socket', '-s', help="listen on a Unix socket at this path instead of on a TCP port")
+    argparser.add_argument('--jobs', '-j', default=0, type=int, help="number of worker processes (default: one per CPU)")
+    argparser.add_argument('--max-jobs', default=0, type=int, help="number of jobs to run at once, the rest are queued (default: twice the workers)")
+    argparser.add_argument('--fuzziness', '-f', default=17, type=int, help="fuzziness to decode with when a job doesn't say, and to warm the workers up for")
+    argparser.add_argument('--cache', default=False, action='store_true', help="cache decoded frames, so decoding the same frames again is faster. "
+                                                                               "Keeps up to 1 GB of them in ~/.cache/steg/frames")
+    argparser.add_argument('--root', default='.', help="directory that the paths of videos to encode and decode are relative to, and can't lead out of (default: the current directory)")
+    argparser.add_argument('--palette', default=[], action='append', help="palette file that jobs can encode and decode with, can be given more than once")
+    argparser.add_argument('--palette-seed', default=[], action='append', help="seed of a scrambled palette that jobs can encode and decode with, can be given more than once")
+    argparser.add_argument('--token', default=os.environ.get('STEG_TOKEN'), help="refuse requests that don't send this in a X-Steg-Token header (default: $STEG_TOKEN)")
+    argparser.add_argument('--quiet', '-q', default=False, action='store_true', help="don't log each request")
+    args = argparser.parse_args(namespace=Args())
+
+    palettes = [Palette.from_file(path) for path in args.palette] + [Palette.scrambled(seed) for seed in args.palette_seed]
+    service = StegService(workers=args.jobs, max_jobs=args.max_jobs, fuzziness=args.fuzziness,
+                          cache=FrameCache() if args.cache else None, root=args.root, palettes=palettes)
+    service.warm()
+    server = make_server(service, args.host, args.port, args.socket, quiet=args.quiet, token=args.token)
+    print(f"listening on {args.socket or f'http://{args.host}:{args.port}'} with {service.workers} workers, in {service.root}")
+    for palette in palettes:
+        print(f"palette={palette.id:08x}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,165 @@
+"""
+An asyncio version of the decode pipeline, for embedding in async code:
+
+    async for chunk in decode_stream('out.mp4'):
+        ...
+
+ffmpeg runs as an asyncio subprocess, frames are decoded in an executor, and decode_stream_into() writes the output
+from a task of its own. Bounded queues sit between the stages, so a slow stage holds back the ones before it
+(all the way back to ffmpeg, through its stdout pipe) instead of frames piling up in memory.
+Every stage runs at once, so the pipeline goes about as fast as its slowest stage.
+"""
+import asyncio
+import functools
+from collections.abc import AsyncGenerator, AsyncIterable, Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Optional
+
+import numpy as np
+
+from steg.cache import FrameCache
+from steg.stats import Stats
+from steg.steg import DECODE_BATCH_SIZE, Reassembler, RepeatFilter, _check_frames_output, _decode_frame_batch, _raw_frames_output, probe_video
+
+# decoded chunks waiting to be written by decode_stream_into()
+MAX_QUEUED_CHUNKS = 16
+
+
+async def video_frames_async(video_path: str, resolution: tuple[int, int], start_time: Optional[float] = None, num_frames: Optional[int] = None, decimate: bool = False) -> AsyncGenerator[np.ndarray, None]:
+    """
+    Like steg.steg.video_frames(), but reads ffmpeg's output without blocking the event loop.
+    ffmpeg is stopped if the generator is closed before the video ends, and raises like video_frames() does if ffmpeg fails.
+    """
+    width, height = resolution
+    frame_size = width * height * 3
+    command = _raw_frames_output(video_path, start_time, num_frames, decimate).compile()
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+
+    finished = False
+    trailing_bytes = 0
+    try:
+        while True:
+            try:
+                buffer = await process.stdout.readexactly(frame_size)
+            except asyncio.IncompleteReadError as e:
+                finished = True
+                trailing_bytes = len(e.partial)
+                break
+            yield np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+        if not finished and process.returncode is None:
+            process.kill()
+        await process.wait()
+
+    _check_frames_output(video_path, process.returncode, trailing_bytes)
+
+
+async def decode_stream(video_path: str, fuzziness: int = 17, workers: int = 1, ignore_errors: bool = False, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = None, cache: Optional[FrameCache] = None, decimate: bool = False, executor: Optional[Executor] = None) -> AsyncGenerator[bytes, None]:
+    """
+    Decodes the data stored in a video, yielding the data from each frame in order, like steg.steg.decode_chunks().
+    See decode_chunks() for the parameters.
+
+    :param executor: where frames are decoded. By default a process pool of the given number of workers,
+                     or a single thread if workers is 1, which keeps the event loop free either way.
+    """
+    stats = stats if stats is not None else Stats()
+    loop = asyncio.get_running_loop()
+    with stats.stage('probe'):
+        stream = await loop.run_in_executor(None, probe_video, video_path)
+    stats.total_frames = int(stream.get('nb_frames', 0)) or None
+
+    frames = video_frames_async(video_path, (stream['width'], stream['height']), decimate=decimate)
+    async for chunk in _decode_frames_async(stats.timed_async('extract', frames), fuzziness=fuzziness, workers=workers,
+                                            ignore_errors=ignore_errors, stats=stats, progress=progress, cache=cache,
+                                            executor=executor):
+        yield chunk
+
+
+async def decode_stream_into(video_path: str, sink: BinaryIO | asyncio.StreamWriter, **kwargs) -> int:
+    """
+    Decodes a video into a file or stream, with the writes running alongside the decoding.
+    See decode_stream() for the remaining parameters.
+
+    :param sink: a writable binary file, written from a thread so the event loop isn't blocked, or an asyncio
+                 StreamWriter, which is drained after each write
+    :return: the number of bytes written
+    """
+    stats = kwargs.setdefault('stats', Stats())
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue[Optional[bytes]] = asyncio.Queue(MAX_QUEUED_CHUNKS)
+
+    async def write():
+        while (chunk := await chunks.get()) is not None:
+            with stats.stage('write'):
+                if isinstance(sink, asyncio.StreamWriter):
+                    sink.write(chunk)
+                    await sink.drain()
+                else:
+                    await loop.run_in_executor(None, sink.write, chunk)
+
+    writer = asyncio.create_task(write())
+    bytes_written = 0
+    try:
+        async for chunk in decode_stream(video_path, **kwargs):
+            await _put(chunks, chunk, writer)
+            bytes_written += len(chunk)
+        await _put(chunks, None, writer)
+        await writer
+    finally:
+        writer.cancel()
+    return bytes_written
+
+
+async def _decode_frames_async(frames: AsyncIterable[np.ndarray], fuzziness: int = 17, workers: int = 1, ignore_errors: bool = False, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = None, cache: Optional[FrameCache] = None, executor: Optional[Executor] = None) -> AsyncGenerator[bytes, None]:
+    stats = stats if stats is not None else Stats()
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(workers) if workers > 1 else ThreadPoolExecutor(1)
+    decode_batch = functools.partial(_decode_frame_batch, fuzziness=fuzziness, ignore_errors=ignore_errors, cache=cache)
+    # batches being decoded, in order. Only a couple per worker are let ahead of the reassembly.
+    pending: asyncio.Queue[Optional[asyncio.Future]] = asyncio.Queue(max(workers, 1) * 2)
+
+    async def submit():
+        repeats = RepeatFilter(fuzziness, stats)
+        batch = []
+        try:
+            async for pixels in frames:
+                if repeats.is_repeat(pixels):
+                    continue
+                batch.append(pixels)
+                if len(batch) == DECODE_BATCH_SIZE:
+                    await pending.put(loop.run_in_executor(executor, decode_batch, tuple(batch)))
+                    batch = []
+            if batch:
+                await pending.put(loop.run_in_executor(executor, decode_batch, tuple(batch)))
+        finally:
+            # also on errors, which are raised from the task once the batches before them are out
+            await pending.put(None)
+
+    submitter = asyncio.create_task(submit())
+    reassembler = Reassembler(stats, progress)
+    try:
+        while (future := await pending.get()) is not None:
+            decoded, batch_stats = await future
+            stats.merge(batch_stats)
+            for frame in decoded:
+                for chunk in reassembler.add(*frame):
+                    yield chunk
+        await submitter
+        for chunk in reassembler.finish():
+            yield chunk
+    finally:
+        submitter.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def _put(queue: asyncio.Queue, item, consumer: asyncio.Task):
+    """Puts an item on a bounded queue, unless the task consuming it has stopped, in which case its error is raised."""
+    put = asyncio.ensure_future(queue.put(item))
+    await asyncio.wait([put, consumer], return_when=asyncio.FIRST_COMPLETED)
+    if not put.done():
+        put.cancel()
+        await consumer
+        raise Exception("the writer stopped before all the output was written")
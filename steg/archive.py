@@ -0,0 +1,245 @@
+"""
+Archives pack many files back to back into one payload, so they share a single encode (one ffmpeg, one partly filled
+last frame) instead of paying for one each. The payload starts with a manifest of the files:
+
+    magic (4 bytes) | archive version (1 byte) | manifest length (4 bytes) | manifest | file data...
+
+The manifest is zlib-compressed JSON listing each file's name, size and CRC-32, in payload order, so each file's
+offset follows from the sizes before it, and the video's FrameIndex says which frames hold that offset: extract()
+reads the manifest from the leading frames, then seeks straight to the frames holding the file it's after.
+"""
+import json
+import os
+import pathlib
+import struct
+import zlib
+from collections.abc import Callable, Generator
+from typing import BinaryIO, Optional
+
+from steg.cache import FrameCache
+from steg.codec import PIECE_SIZE
+from steg.frame import Frame
+from steg.index import FrameIndex
+from steg.stats import Stats, print_progress
+from steg.steg import _decode_body, decode_chunks, encode_video, load_index, probe_video, video_frames
+
+MAGIC = b'STGA'
+ARCHIVE_VERSION = 1
+# magic, archive version, manifest length
+PREFIX = struct.Struct('>4sBI')
+
+
+class ArchiveEntry:
+    name: str
+    size: int
+    # CRC-32 of the file's contents
+    crc32: int
+    # where the file starts in the payload
+    offset: int
+
+    def __init__(self, name: str, size: int, crc32: int, offset: int):
+        self.name = name
+        self.size = size
+        self.crc32 = crc32
+        self.offset = offset
+
+    def __repr__(self):
+        return f"ArchiveEntry(name={self.name!r}, size={self.size}, offset={self.offset})"
+
+
+class Manifest:
+    """The files in an archive, in the order their data is stored."""
+    entries: list[ArchiveEntry]
+    # where the manifest ends and the first file's data starts in the payload
+    data_offset: int
+
+    def __init__(self, files: list[tuple[str, int, int]]):
+        """
+        :param files: the name, size and CRC-32 of each file
+        """
+        names = set()
+        for name, _, _ in files:
+            if name in names:
+                raise Exception(f"{name!r} is in the archive more than once")
+            names.add(name)
+
+        self._body = zlib.compress(json.dumps({'files': files}, separators=(',', ':')).encode(), 9)
+        self.data_offset = PREFIX.size + len(self._body)
+        self.entries = []
+        offset = self.data_offset
+        for name, size, crc32 in files:
+            self.entries.append(ArchiveEntry(name, size, crc32, offset))
+            offset += size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    @property
+    def total_bytes(self) -> int:
+        """the length of the whole payload, manifest included"""
+        if not self.entries:
+            return self.data_offset
+        last = self.entries[-1]
+        return last.offset + last.size
+
+    def find(self, name: str) -> ArchiveEntry:
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+        raise Exception(f"{name!r} isn't in the archive")
+
+    def to_bytes(self) -> bytes:
+        return PREFIX.pack(MAGIC, ARCHIVE_VERSION, len(self._body)) + self._body
+
+    @staticmethod
+    def manifest_length(prefix: bytes) -> int:
+        """:return: the length of the manifest after the prefix at the start of an archive's payload"""
+        if len(prefix) < PREFIX.size:
+            raise Exception("payload is too short to be an archive")
+        magic, version, length = PREFIX.unpack_from(prefix)
+        if magic != MAGIC:
+            raise Exception("payload isn't an archive")
+        if version != ARCHIVE_VERSION:
+            raise Exception(f"unsupported archive version {version}")
+        return length
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Manifest':
+        """:param data: the start of an archive's payload, up to at least the end of the manifest"""
+        end = PREFIX.size + cls.manifest_length(data)
+        if len(data) < end:
+            raise Exception(f"the manifest is {end} bytes long, but only {len(data)} bytes were given")
+        files = json.loads(zlib.decompress(data[PREFIX.size:end]))['files']
+        return cls([(name, size, crc32) for name, size, crc32 in files])
+
+
+def archive_name(path: str) -> str:
+    """:return: the name a file is stored under by default, which is its path as given, with forward slashes"""
+    return pathlib.PurePath(os.path.normpath(path)).as_posix()
+
+
+def pack(paths: list[str], names: Optional[list[str]] = None) -> tuple[Manifest, Generator[bytes, None, None]]:
+    """
+    Builds the manifest for an archive of the given files, reading each file once to checksum it.
+    The payload is read a second time as it's consumed, so only a piece of one file is held in memory at a time.
+
+    :param paths: the files to pack, in the order they're stored
+    :param names: the name to store each file under, archive_name() of its path by default
+    :return: the manifest and the payload, which is manifest.total_bytes long
+    """
+    names = names if names is not None else [archive_name(path) for path in paths]
+    if len(names) != len(paths):
+        raise Exception(f"got {len(names)} names for {len(paths)} files")
+
+    files = []
+    for name, path in zip(names, paths):
+        size, crc32 = _checksum(path)
+        files.append((name, size, crc32))
+    manifest = Manifest(files)
+    return manifest, _payload(manifest, paths)
+
+
+def _checksum(path: str) -> tuple[int, int]:
+    size, crc32 = 0, 0
+    with open(path, 'rb') as f:
+        while piece := f.read(PIECE_SIZE):
+            size += len(piece)
+            crc32 = zlib.crc32(piece, crc32)
+    return size, crc32
+
+
+def _payload(manifest: Manifest, paths: list[str]) -> Generator[bytes, None, None]:
+    yield manifest.to_bytes()
+    for entry, path in zip(manifest.entries, paths):
+        size, crc32 = 0, 0
+        with open(path, 'rb') as f:
+            while piece := f.read(PIECE_SIZE):
+                size += len(piece)
+                crc32 = zlib.crc32(piece, crc32)
+                yield piece
+        # the offsets of every file after this one are already in the manifest
+        if (size, crc32) != (entry.size, entry.crc32):
+            raise Exception(f"{path} changed while it was being encoded")
+
+
+def encode_archive(paths: list[str], output_path: str, names: Optional[list[str]] = None, **kwargs) -> Manifest:
+    """
+    Encodes many files into one video, see pack(). A FrameIndex sidecar is written next to the video unless
+    index_path says otherwise. See encode_video() for the remaining parameters.
+    Archives can't be compressed as a whole, since files are found by their offset in the payload as it's stored.
+
+    :return: the archive's manifest
+    """
+    if kwargs.get('compression') is not None:
+        raise Exception("archives can't be compressed, since files are extracted by their offset")
+    manifest, payload = pack(paths, names)
+    kwargs.setdefault('index_path', FrameIndex.sidecar_path(output_path))
+    encode_video(payload, output_path, data_length=manifest.total_bytes, **kwargs)
+    return manifest
+
+
+def read_manifest(video_path: str, fuzziness: int = 17, stats: Optional[Stats] = None, cache: Optional[FrameCache] = None) -> tuple[Manifest, FrameIndex]:
+    """
+    Reads an archive's manifest from the leading frames of a video, usually just the first one.
+
+    :return: the manifest, and an index of the video's frames to find files by. That's the video's FrameIndex
+             sidecar if it has one, or else one made by scanning the video's headers (see load_index()), since
+             a re-encoded video can have frames repeated or missing.
+    """
+    stats = stats if stats is not None else Stats()
+    with stats.stage('probe'):
+        stream = probe_video(video_path)
+
+    frames = stats.timed('extract', video_frames(video_path, resolution=(stream['width'], stream['height']), num_frames=1))
+    pixels = next(frames, None)
+    frames.close()
+    if pixels is None:
+        raise Exception(f"{video_path} has no frames")
+    with stats.stage('decode_header'):
+        frame = Frame.load_from_array(pixels, fuzziness=fuzziness, cache=cache)
+    if frame.version < 2 or frame.codec:
+        raise Exception(f"{video_path} isn't an archive")
+
+    index = load_index(video_path, fuzziness=fuzziness, stats=stats)
+
+    head = _decode_body(frame, fuzziness=fuzziness, stats=stats)
+    end = PREFIX.size + Manifest.manifest_length(head)
+    if end > len(head):
+        # a long manifest carries on into the next frames
+        head += b''.join(decode_chunks(video_path, fuzziness=fuzziness, stats=stats, progress=None, byte_range=(len(head), end),
+                                       index=index, cache=cache))
+    return Manifest.from_bytes(head), index
+
+
+def extract(video_path: str, name: str, sink: BinaryIO, fuzziness: int = 17, workers: int = 1, ignore_errors: bool = False, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = print_progress, cache: Optional[FrameCache] = None) -> ArchiveEntry:
+    """
+    Extracts one file from an archive, decoding only the frames that hold the manifest and that file.
+    The file is checked against the size and checksum in the manifest once it has all been written.
+    See decode_chunks() for the remaining parameters.
+
+    :param name: the name the file is stored under
+    :param sink: a writable binary file, pipe, socket file, etc.
+    :return: the file's entry in the manifest
+    """
+    stats = stats if stats is not None else Stats()
+    manifest, index = read_manifest(video_path, fuzziness=fuzziness, stats=stats, cache=cache)
+    entry = manifest.find(name)
+
+    size, crc32 = 0, 0
+    for chunk in decode_chunks(video_path, fuzziness=fuzziness, workers=workers, ignore_errors=ignore_errors, stats=stats,
+                               progress=progress, byte_range=(entry.offset, entry.offset + entry.size), index=index, cache=cache):
+        size += len(chunk)
+        crc32 = zlib.crc32(chunk, crc32)
+        with stats.stage('write'):
+            sink.write(chunk)
+
+    # an index made before the video was re-encoded sends seeks to the wrong frames
+    stale_index = f"If the video was re-encoded after {FrameIndex.sidecar_path(video_path)} was made, delete it so it's rebuilt"
+    if size != entry.size:
+        raise Exception(f"{name} should be {entry.size} bytes, but only {size} were decoded. {stale_index}")
+    if crc32 != entry.crc32 and not ignore_errors:
+        raise Exception(f"{name} doesn't match its checksum, the frames holding it were decoded wrong. {stale_index}")
+    return entry
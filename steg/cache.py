@@ -0,0 +1,137 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+from steg.util import cache_dir
+
+# default cap on the total size of the frame cache, in bytes
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class CacheEntry:
+    """Everything decoding a frame produces: the header fields, the body, and which body bytes couldn't be decoded."""
+    version: int
+    frame_seqno: int
+    codec: int
+    fec: int
+    tile_width: int
+    tile_height: int
+    # id of the palette the body is drawn in, see steg.palette
+    palette_id: int
+    body: bytes
+    unmatched: np.ndarray
+
+    def __init__(self, version: int, frame_seqno: int, codec: int, fec: int, tile_width: int, tile_height: int, palette_id: int, body: bytes, unmatched: np.ndarray):
+        self.version = version
+        self.frame_seqno = frame_seqno
+        self.codec = codec
+        self.fec = fec
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.palette_id = palette_id
+        self.body = body
+        self.unmatched = unmatched
+
+    @property
+    def body_length(self) -> int:
+        return len(self.body)
+
+
+class FrameCache:
+    """
+    On-disk cache of decoded frames, so running decode_frame, compare, byte_finder and decode_video over the same
+    frames again doesn't re-classify every tile. decode_frame and compare use it by default, while decode_video,
+    byte_finder and serve only do with --cache, since a whole video's frames fill it quickly.
+
+    Entries are keyed by a hash of the frame's pixels plus the palette and fuzziness it was decoded with.
+    Reading an entry refreshes its modification time, and once the cache grows past max_bytes
+    the least recently used entries are deleted.
+    """
+    path: pathlib.Path
+    max_bytes: int
+    _total_bytes: Optional[int]
+
+    def __init__(self, path: Optional[str | pathlib.Path] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = pathlib.Path(path) if path is not None else cache_dir() / 'frames'
+        self.max_bytes = max_bytes
+        # only known once the directory has been scanned, see evict()
+        self._total_bytes = None
+
+    @staticmethod
+    def pixel_digest(pixels: np.ndarray) -> str:
+        """Hashes a frame's pixels. Done once per frame, then combined with the decode settings by key()."""
+        digest = hashlib.blake2b(np.ascontiguousarray(pixels).data, digest_size=16)
+        digest.update(repr(pixels.shape).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(pixel_digest: str, palette: np.ndarray | list[tuple[int, int, int]], fuzziness: int) -> str:
+        palette_digest = hashlib.blake2b(np.asarray(palette, dtype=np.uint8).tobytes(), digest_size=8).hexdigest()
+        return f'{pixel_digest}_{palette_digest}_f{fuzziness}'
+
+    def entry_path(self, key: str) -> pathlib.Path:
+        return self.path / f'{key}.npz'
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                header = entry['header']
+                body = entry['body'].tobytes()
+                unmatched = entry['unmatched']
+            os.utime(path)
+            version, frame_seqno, codec, fec, tile_width, tile_height, palette_id = (int(field) for field in header)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return CacheEntry(version, frame_seqno, codec, fec, tile_width, tile_height, palette_id, body, unmatched)
+
+    def put(self, key: str, entry: CacheEntry):
+        # the cache is best-effort, so a read-only or missing cache directory is not an error
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.path, suffix='.npz.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f,
+                         header=np.array([entry.version, entry.frame_seqno, entry.codec, entry.fec, entry.tile_width, entry.tile_height, entry.palette_id]),
+                         body=np.frombuffer(entry.body, dtype=np.uint8),
+                         unmatched=entry.unmatched)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, self.entry_path(key))
+        except OSError:
+            return
+
+        if self._total_bytes is not None:
+            self._total_bytes += size
+        if self._total_bytes is None or self._total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for path in self.path.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        # other processes may share the cache, so the total is recounted from disk each time
+        self._total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            self._total_bytes -= size
+
+    def clear(self):
+        for path in self.path.glob('*.npz'):
+            path.unlink(missing_ok=True)
+        self._total_bytes = 0
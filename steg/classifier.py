@@ -0,0 +1,103 @@
+import hashlib
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+from steg.util import cache_dir
+
+NO_MATCH = 256
+
+_classifiers: dict[tuple, 'PaletteClassifier'] = {}
+
+
+class PaletteClassifier:
+    """
+    Maps sampled colors to byte values in constant time using a lookup table that covers every 24-bit color.
+
+    The table reproduces list_fuzzy_search for the default palette: colors where every channel is within `fuzziness`
+    of 0 map to 0, otherwise the first palette entry within `fuzziness` on every channel wins, and anything else maps
+    to NO_MATCH. In palettes that move the darkest color away from 0 (see steg.palette), that color keeps its value.
+    Tables are cached on disk per palette and fuzziness so they only have to be built once.
+    """
+    palette: list[tuple[int, int, int]]
+    fuzziness: int
+    table: np.ndarray
+
+    def __init__(self, palette: list[tuple[int, int, int]], fuzziness: int = 17, use_disk_cache: bool = True):
+        self.palette = palette
+        self.fuzziness = fuzziness
+
+        table = self.load_table() if use_disk_cache else None
+        if table is None:
+            table = self.build_table(palette, fuzziness)
+            if use_disk_cache:
+                self.save_table(table)
+        self.table = table
+
+    @staticmethod
+    def build_table(palette: list[tuple[int, int, int]], fuzziness: int) -> np.ndarray:
+        table = np.full((256, 256, 256), NO_MATCH, dtype=np.uint16)
+
+        # anything close enough to black is a null byte, unless a palette entry is painted over it below.
+        # The default palette's darkest color is 0, whose box covers all of this anyway.
+        near_black = max(fuzziness + 1, 0)
+        table[:near_black, :near_black, :near_black] = 0
+
+        # paint each palette entry's tolerance box in reverse, so earlier entries win where boxes overlap
+        for value in reversed(range(len(palette))):
+            r, g, b = palette[value]
+            table[max(r - fuzziness, 0):r + fuzziness + 1,
+                  max(g - fuzziness, 0):g + fuzziness + 1,
+                  max(b - fuzziness, 0):b + fuzziness + 1] = value
+
+        return table
+
+    @property
+    def cache_path(self) -> str:
+        digest = hashlib.sha256(np.asarray(self.palette, dtype=np.uint8).tobytes()).hexdigest()[:16]
+        return os.path.join(cache_dir(), f'classifier_{digest}_f{self.fuzziness}.npy')
+
+    def load_table(self) -> Optional[np.ndarray]:
+        try:
+            table = np.load(self.cache_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        if table.shape != (256, 256, 256) or table.dtype != np.uint16:
+            return None
+        return table
+
+    def save_table(self, table: np.ndarray):
+        # the cache is best-effort, so a read-only or missing cache directory is not an error
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir(), suffix='.npy.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, table)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            pass
+
+    def classify(self, colors: np.ndarray) -> np.ndarray:
+        """
+        Classifies an array of colors with shape (..., 3).
+        :return: an array of shape (...) holding byte values, or NO_MATCH for colors that aren't in the palette
+        """
+        colors = np.asarray(colors)
+        return self.table[colors[..., 0], colors[..., 1], colors[..., 2]]
+
+    def lookup(self, color: tuple[int, int, int]) -> int:
+        value = int(self.table[color[0], color[1], color[2]])
+        if value == NO_MATCH:
+            raise Exception(f"image was too messed up, couldn't find value for color {color}")
+        return value
+
+
+def get_classifier(palette: list[tuple[int, int, int]], fuzziness: int = 17) -> PaletteClassifier:
+    """Returns a classifier for the given palette and fuzziness, reusing one built earlier in this process if possible."""
+    key = (tuple(palette), fuzziness)
+    if key not in _classifiers:
+        _classifiers[key] = PaletteClassifier(palette, fuzziness)
+    return _classifiers[key]
@@ -0,0 +1,126 @@
+import functools
+import itertools
+import lzma
+import zlib
+from collections.abc import Callable, Generator, Iterable
+from typing import Optional
+
+from steg.util import read_chunks, ByteSource
+
+# how much of the payload is read at a time when compressing, and looked at to decide whether to compress at all
+PIECE_SIZE = 64 * 1024
+
+# file signatures of formats that are already compressed
+COMPRESSED_SIGNATURES = [
+    b'\x1f\x8b',  # gzip
+    b'PK\x03\x04',  # zip, docx, jar, etc.
+    b'\xfd7zXZ\x00',  # xz
+    b'BZh',  # bzip2
+    b'\x28\xb5\x2f\xfd',  # zstd
+    b'7z\xbc\xaf\x27\x1c',  # 7z
+    b'\x89PNG',
+    b'\xff\xd8\xff',  # jpeg
+    b'GIF8',
+    b'RIFF',  # webp, avi, wav
+    b'\x1a\x45\xdf\xa3',  # mkv, webm
+    b'OggS',
+    b'fLaC',
+    b'ID3',  # mp3
+]
+
+
+class Codec:
+    """
+    A streaming compressor, identified in frame headers by a 1-byte id (0 means uncompressed).
+
+    compressor() and decompressor() make objects that work like zlib's compressobj/decompressobj:
+    compress()/decompress() take a piece of data and return whatever output is ready, and flush() returns the rest.
+    Decompressors don't need a flush() if they never hold output back, like lzma's.
+    """
+    id: int
+    name: str
+    compressor: Callable
+    decompressor: Callable
+
+    def __init__(self, id: int, name: str, compressor: Callable, decompressor: Callable):
+        self.id = id
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+
+_codecs: dict[int, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    """Makes a codec available to encode with by name, and to decode videos whose headers have its id."""
+    if not 0 < codec.id < 256:
+        raise Exception(f"codec ids must be between 1 and 255, got {codec.id}")
+    _codecs[codec.id] = codec
+
+
+def get_codec(codec: int | str) -> Codec:
+    """:return: the registered codec with the given id or name"""
+    for registered in _codecs.values():
+        if codec in (registered.id, registered.name):
+            return registered
+    raise Exception(f"unknown codec {codec!r}")
+
+
+def codec_names() -> list[str]:
+    return [codec.name for codec in _codecs.values()]
+
+
+register_codec(Codec(1, 'zlib', functools.partial(zlib.compressobj, 9), zlib.decompressobj))
+register_codec(Codec(2, 'lzma', lzma.LZMACompressor, lzma.LZMADecompressor))
+
+
+def looks_compressed(sample: bytes) -> bool:
+    """
+    Guesses whether data is already compressed (or encrypted, or otherwise random), in which case compressing it
+    again would only add overhead. Known file signatures are checked first, then whether a quick zlib pass
+    over the sample shrinks it at all. Empty data has nothing to gain either.
+    """
+    if any(sample.startswith(signature) for signature in COMPRESSED_SIGNATURES):
+        return True
+    return len(zlib.compress(sample, 1)) >= len(sample) * 0.98
+
+
+def compress_source(data: ByteSource, compression: Optional[str], data_length: Optional[int] = None) -> tuple[ByteSource, int, Optional[int]]:
+    """
+    Compresses the payload with the named codec, unless it already looks compressed.
+    Data in memory is compressed up front so its compressed length is known when picking a tile size.
+    Streams and iterables are compressed as they're read, and data_length is passed through as an upper bound.
+
+    :return: the data to encode, the id of the codec it was compressed with (0 if it wasn't), and its length if known
+    """
+    if compression is None:
+        return data, 0, data_length
+
+    codec = get_codec(compression)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        if looks_compressed(bytes(data[:PIECE_SIZE])):
+            return data, 0, len(data)
+        compressed = b''.join(compress_chunks([data], codec))
+        return compressed, codec.id, len(compressed)
+
+    pieces = read_chunks(data, PIECE_SIZE)
+    first_piece = next(pieces, b'')
+    pieces = itertools.chain([first_piece], pieces)
+    if looks_compressed(first_piece):
+        return pieces, 0, data_length
+    return compress_chunks(pieces, codec), codec.id, data_length
+
+
+def compress_chunks(pieces: Iterable[bytes], codec: Codec) -> Generator[bytes, None, None]:
+    compressor = codec.compressor()
+    for piece in pieces:
+        output = compressor.compress(piece)
+        if output:
+            yield output
+    yield compressor.flush()
+
+
+def flush_decompressor(decompressor) -> bytes:
+    """:return: any output the decompressor was still holding back, once all the input has been given to it"""
+    return decompressor.flush() if hasattr(decompressor, 'flush') else b''
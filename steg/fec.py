@@ -0,0 +1,352 @@
+"""
+Reed-Solomon error correction over GF(256), applied to each frame body.
+
+A body is split into as few codewords of at most 255 tiles as it can be, each with `nsym` parity tiles. Codewords are
+interleaved across the frame (tile t belongs to codeword t % number_of_codewords) so a smudge that wipes out
+neighbouring tiles only costs each codeword a tile or two. A codeword can fix any mix of e wrong tiles and
+u erased tiles (tiles the classifier couldn't match) as long as 2e + u <= nsym.
+
+Encoding and the syndrome check are done for every codeword of a frame at once with table lookups. Only codewords
+whose syndromes aren't zero go through the (much slower, per-codeword) error location and correction.
+"""
+import functools
+import math
+
+import numpy as np
+
+# GF(256) with the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1 and generator 2
+_EXP = [0] * 512
+_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    _EXP[_power] = _value
+    _LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11d
+for _power in range(255, 512):
+    _EXP[_power] = _EXP[_power - 255]
+
+# MUL[a, b] is a * b in GF(256)
+_log = np.array(_LOG)
+MUL = np.array(_EXP, dtype=np.uint8)[(_log[:, np.newaxis] + _log[np.newaxis, :])]
+MUL[0, :] = 0
+MUL[:, 0] = 0
+_POWERS_OF_2 = np.array(_EXP[:255], dtype=np.uint8)
+
+MAX_CODEWORD_LENGTH = 255
+
+
+class FecError(Exception):
+    pass
+
+
+def check_nsym(nsym: int):
+    if not 0 < nsym < MAX_CODEWORD_LENGTH - 1:
+        raise Exception(f"the number of parity tiles per codeword must be between 1 and {MAX_CODEWORD_LENGTH - 2}, got {nsym}")
+
+
+def encoded_length(data_length: int, nsym: int) -> int:
+    """:return: the number of tiles it takes to store data_length bytes with nsym parity tiles per codeword"""
+    return data_length + _num_codewords(data_length, nsym) * nsym
+
+
+def data_length(encoded_length: int, nsym: int) -> int:
+    """:return: the number of data bytes in a body of encoded_length tiles, the inverse of encoded_length()"""
+    return encoded_length - math.ceil(encoded_length / MAX_CODEWORD_LENGTH) * nsym
+
+
+def data_capacity(tiles: int, nsym: int) -> int:
+    """:return: the most data bytes that fit in the given number of tiles, i.e. the largest d with encoded_length(d) <= tiles"""
+    # as many full codewords as fit, then whatever data the leftover tiles hold after their own parity
+    full_codewords, leftover = divmod(max(tiles, 0), MAX_CODEWORD_LENGTH)
+    return full_codewords * (MAX_CODEWORD_LENGTH - nsym) + max(leftover - nsym, 0)
+
+
+def _num_codewords(data_length: int, nsym: int) -> int:
+    return math.ceil(data_length / (MAX_CODEWORD_LENGTH - nsym))
+
+
+def encode(data: bytes, nsym: int) -> bytes:
+    """:return: the data followed by parity, interleaved into a frame body"""
+    if not data:
+        return b''
+    num_codewords = _num_codewords(len(data), nsym)
+    data_per_codeword = math.ceil(len(data) / num_codewords)
+
+    # codeword i holds data bytes i, i + num_codewords, ..., padded at the front with zeros (a shortened code)
+    # where there are fewer of them, which doesn't change the parity
+    messages = _deinterleave(np.frombuffer(data, dtype=np.uint8), num_codewords, data_per_codeword)
+    parity_rows = _parity_matrix(nsym)[-data_per_codeword:]
+    parity = np.bitwise_xor.reduce(MUL[messages[:, :, np.newaxis], parity_rows[np.newaxis, :, :]], axis=1)
+
+    return _interleave(np.concatenate([messages, parity], axis=1), encoded_length(len(data), nsym)).tobytes()
+
+
+def decode(body: np.ndarray, erased: np.ndarray, nsym: int) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Corrects a frame body, treating erased tiles as erasures.
+
+    :param body: the tile values of the body, with anything erased set to 0
+    :param erased: a boolean array that is True for each tile that couldn't be read
+    :return: the data bytes; a boolean array that is True for each data byte in a codeword that couldn't be corrected;
+             and the number of tiles that were corrected
+    """
+    length = data_length(len(body), nsym)
+    if length <= 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=bool), 0
+    num_codewords = _num_codewords(length, nsym)
+    data_per_codeword = math.ceil(length / num_codewords)
+
+    codewords = _deinterleave(body, num_codewords, data_per_codeword + nsym)
+    codeword_erasures = _deinterleave(erased, num_codewords, data_per_codeword + nsym)
+
+    failed = np.zeros(num_codewords, dtype=bool)
+    corrected = 0
+    syndromes = np.bitwise_xor.reduce(MUL[codewords[:, :, np.newaxis], _syndrome_matrix(codewords.shape[1], nsym)[np.newaxis]], axis=1)
+    for index in np.flatnonzero(syndromes.any(axis=1)):
+        # leading padding isn't part of the codeword that was sent
+        padding = data_per_codeword - _codeword_data_length(index, length, num_codewords)
+        codeword = [int(value) for value in codewords[index, padding:]]
+        erase_positions = [int(position) for position in np.flatnonzero(codeword_erasures[index, padding:])]
+        try:
+            fixed = _correct(codeword, nsym, erase_positions)
+        except FecError:
+            failed[index] = True
+            continue
+        corrected += sum(1 for before, after in zip(codeword, fixed) if before != after)
+        codewords[index, padding:] = fixed
+
+    data = _interleave(codewords[:, :data_per_codeword], length)
+    failed_bytes = _interleave(np.repeat(failed[:, np.newaxis], data_per_codeword, axis=1), length)
+    return data, failed_bytes, corrected
+
+
+def _codeword_data_length(index: int, length: int, num_codewords: int) -> int:
+    return length // num_codewords + (1 if index < length % num_codewords else 0)
+
+
+def _deinterleave(values: np.ndarray, num_codewords: int, per_codeword: int) -> np.ndarray:
+    """splits interleaved values into one row per codeword, front-padded with zeros to the same length"""
+    padded = np.zeros(num_codewords * per_codeword, dtype=values.dtype)
+    # the last row of the interleaved grid is only partly filled, and its empty slots belong to the last codewords
+    short = num_codewords * per_codeword - len(values)
+    grid = padded.reshape(per_codeword, num_codewords)
+    grid.reshape(-1)[:len(values)] = values
+    rows = grid.T.copy()
+    if short:
+        # codewords without a value in the last row move their values one place to the right, padding at the front
+        rows[num_codewords - short:, 1:] = rows[num_codewords - short:, :-1].copy()
+        rows[num_codewords - short:, 0] = 0
+    return rows
+
+
+def _interleave(rows: np.ndarray, length: int) -> np.ndarray:
+    """the inverse of _deinterleave()"""
+    num_codewords, per_codeword = rows.shape
+    short = num_codewords * per_codeword - length
+    rows = rows.copy()
+    if short:
+        rows[num_codewords - short:, :-1] = rows[num_codewords - short:, 1:].copy()
+    return rows.T.reshape(-1)[:length]
+
+
+@functools.lru_cache(maxsize=16)
+def _generator(nsym: int) -> list[int]:
+    generator = [1]
+    for power in range(nsym):
+        generator = _poly_mul(generator, [1, _EXP[power]])
+    return generator
+
+
+@functools.lru_cache(maxsize=16)
+def _parity_matrix(nsym: int) -> np.ndarray:
+    """
+    Row j (counting from the end) holds the parity contributed by a 1 at degree j of the message,
+    i.e. x^(j + nsym) mod the generator, so a codeword's parity is the XOR of its data bytes times their rows.
+    """
+    check_nsym(nsym)
+    generator = _generator(nsym)
+    rows = []
+    remainder = [0] * nsym
+    top = 1
+    for _ in range(MAX_CODEWORD_LENGTH - nsym):
+        remainder = [remainder[i + 1] ^ _mul(top, generator[i + 1]) if i + 1 < nsym else _mul(top, generator[i + 1]) for i in range(nsym)]
+        rows.append(remainder)
+        top = remainder[0]
+    matrix = np.array(rows[::-1], dtype=np.uint8)
+    matrix.flags.writeable = False
+    return matrix
+
+
+@functools.lru_cache(maxsize=64)
+def _syndrome_matrix(codeword_length: int, nsym: int) -> np.ndarray:
+    """column i evaluates a codeword at 2^i, the ith root of the generator"""
+    degrees = np.arange(codeword_length - 1, -1, -1)[:, np.newaxis]
+    matrix = np.array(_EXP, dtype=np.uint8)[(degrees * np.arange(nsym)[np.newaxis, :]) % 255]
+    matrix.flags.writeable = False
+    return matrix
+
+
+def _mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def _div(a: int, b: int) -> int:
+    if a == 0:
+        return 0
+    return _EXP[(_LOG[a] + 255 - _LOG[b]) % 255]
+
+
+def _pow(a: int, power: int) -> int:
+    return _EXP[(_LOG[a] * power) % 255]
+
+
+def _inverse(a: int) -> int:
+    return _EXP[255 - _LOG[a]]
+
+
+def _poly_scale(poly: list[int], x: int) -> list[int]:
+    return [_mul(coefficient, x) for coefficient in poly]
+
+
+def _poly_add(p: list[int], q: list[int]) -> list[int]:
+    result = [0] * max(len(p), len(q))
+    for i, coefficient in enumerate(p):
+        result[i + len(result) - len(p)] = coefficient
+    for i, coefficient in enumerate(q):
+        result[i + len(result) - len(q)] ^= coefficient
+    return result
+
+
+def _poly_mul(p: list[int], q: list[int]) -> list[int]:
+    result = [0] * (len(p) + len(q) - 1)
+    for j, q_coefficient in enumerate(q):
+        for i, p_coefficient in enumerate(p):
+            result[i + j] ^= _mul(p_coefficient, q_coefficient)
+    return result
+
+
+def _poly_eval(poly: list[int], x: int) -> int:
+    y = poly[0]
+    for coefficient in poly[1:]:
+        y = _mul(y, x) ^ coefficient
+    return y
+
+
+def _poly_div_remainder(dividend: list[int], divisor: list[int]) -> list[int]:
+    output = list(dividend)
+    for i in range(len(dividend) - (len(divisor) - 1)):
+        coefficient = output[i]
+        if coefficient != 0:
+            for j in range(1, len(divisor)):
+                if divisor[j] != 0:
+                    output[i + j] ^= _mul(divisor[j], coefficient)
+    return output[-(len(divisor) - 1):]
+
+
+def _syndromes(codeword: list[int], nsym: int) -> list[int]:
+    # the leading 0 keeps the indexing used by the locator and evaluator below
+    products = MUL[np.array(codeword, dtype=np.uint8)[:, np.newaxis], _syndrome_matrix(len(codeword), nsym)]
+    return [0] + np.bitwise_xor.reduce(products, axis=0).tolist()
+
+
+def _errata_locator(coefficient_positions: list[int]) -> list[int]:
+    locator = [1]
+    for position in coefficient_positions:
+        locator = _poly_mul(locator, _poly_add([1], [_pow(2, position), 0]))
+    return locator
+
+
+def _error_evaluator(syndromes: list[int], locator: list[int], nsym: int) -> list[int]:
+    return _poly_div_remainder(_poly_mul(syndromes, locator), [1] + [0] * (nsym + 1))
+
+
+def _correct_errata(codeword: list[int], syndromes: list[int], positions: list[int]) -> list[int]:
+    """Forney's algorithm: works out the error values at known positions and removes them."""
+    coefficient_positions = [len(codeword) - 1 - position for position in positions]
+    locator = _errata_locator(coefficient_positions)
+    evaluator = _error_evaluator(syndromes[::-1], locator, len(locator) - 1)[::-1]
+    roots = [_pow(2, -(255 - position)) for position in coefficient_positions]
+
+    errors = [0] * len(codeword)
+    for i, root in enumerate(roots):
+        root_inverse = _inverse(root)
+        locator_derivative = 1
+        for j, other in enumerate(roots):
+            if j != i:
+                locator_derivative = _mul(locator_derivative, 1 ^ _mul(root_inverse, other))
+        if locator_derivative == 0:
+            raise FecError("could not find error magnitude")
+        y = _mul(root, _poly_eval(evaluator[::-1], root_inverse))
+        errors[positions[i]] = _div(y, locator_derivative)
+    return _poly_add(codeword, errors)
+
+
+def _error_locator(forney_syndromes: list[int], nsym: int, erase_count: int) -> list[int]:
+    """Berlekamp-Massey, on syndromes that already have the erasures taken out."""
+    locator = [1]
+    old_locator = [1]
+    shift = len(forney_syndromes) - nsym if len(forney_syndromes) > nsym else 0
+    for i in range(nsym - erase_count):
+        k = i + shift
+        delta = forney_syndromes[k]
+        for j in range(1, len(locator)):
+            delta ^= _mul(locator[-(j + 1)], forney_syndromes[k - j])
+        old_locator = old_locator + [0]
+        if delta != 0:
+            if len(old_locator) > len(locator):
+                new_locator = _poly_scale(old_locator, delta)
+                old_locator = _poly_scale(locator, _inverse(delta))
+                locator = new_locator
+            locator = _poly_add(locator, _poly_scale(old_locator, delta))
+
+    while locator and locator[0] == 0:
+        del locator[0]
+    if (len(locator) - 1) * 2 + erase_count > nsym:
+        raise FecError("too many errors to correct")
+    return locator
+
+
+def _error_positions(locator: list[int], length: int) -> list[int]:
+    """Chien search: the positions where the error locator has a root."""
+    points = _POWERS_OF_2[:length]
+    values = np.full(length, locator[0], dtype=np.uint8)
+    for coefficient in locator[1:]:
+        values = MUL[values, points] ^ coefficient
+    positions = [length - 1 - int(i) for i in np.flatnonzero(values == 0)]
+    if len(positions) != len(locator) - 1:
+        raise FecError("could not locate the errors")
+    return positions
+
+
+def _forney_syndromes(syndromes: list[int], erase_positions: list[int], length: int) -> list[int]:
+    forney = list(syndromes[1:])
+    for position in erase_positions:
+        x = _pow(2, length - 1 - position)
+        for j in range(len(forney) - 1):
+            forney[j] = _mul(forney[j], x) ^ forney[j + 1]
+    return forney
+
+
+def _correct(codeword: list[int], nsym: int, erase_positions: list[int]) -> list[int]:
+    """:return: the corrected codeword (data and parity), or raises FecError if there are too many errors"""
+    if len(erase_positions) > nsym:
+        raise FecError("too many erasures to correct")
+    codeword = list(codeword)
+    for position in erase_positions:
+        codeword[position] = 0
+
+    syndromes = _syndromes(codeword, nsym)
+    if max(syndromes) == 0:
+        return codeword
+
+    forney = _forney_syndromes(syndromes, erase_positions, len(codeword))
+    locator = _error_locator(forney, nsym, len(erase_positions))
+    error_positions = _error_positions(locator[::-1], len(codeword))
+    codeword = _correct_errata(codeword, syndromes, erase_positions + error_positions)
+    if max(_syndromes(codeword, nsym)) != 0:
+        raise FecError("could not correct the codeword")
+    return codeword
@@ -1,38 +1,89 @@
+import functools
 import math
 import pathlib
 import struct
 from io import IOBase
 from typing import Optional, Generator
 
+import numpy as np
 from PIL import Image, ImageDraw
 
-from steg.util import generate_default_palette, list_fuzzy_search, fuzzy_equals, HEADER_LENGTH_BYTES
+from steg import fec as steg_fec
+from steg.cache import CacheEntry, FrameCache
+from steg.classifier import NO_MATCH
+from steg.palette import DEFAULT_PALETTE, Palette, get_palette
+from steg.util import PALETTE_VERSION, fuzzy_equals, header_length
+
+
+@functools.lru_cache(maxsize=32)
+def tile_centers(resolution: tuple[int, int], tile_width: int, tile_height: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the pixel coordinates sampled for each tile in a frame, in the order the tiles are drawn.
+    :return: arrays of y coordinates and x coordinates, suitable for indexing an image array
+    """
+    num_columns = resolution[0] // tile_width
+    num_rows = resolution[1] // tile_height
+    xs = np.arange(num_columns) * tile_width + math.ceil(tile_width / 2)
+    ys = np.arange(num_rows) * tile_height + math.ceil(tile_height / 2)
+    ys, xs = np.repeat(ys, num_columns), np.tile(xs, num_rows)
+    ys.flags.writeable = False
+    xs.flags.writeable = False
+    return ys, xs
 
 
 class Frame:
     version: int
+    # the frame's position in the payload. Version 1 headers only have room for the low byte, so it wraps at 256 there.
     frame_seqno: int
+    # id of the codec the payload was compressed with before it was split into frames, 0 if it wasn't (see steg.codec)
+    codec: int
+    # number of Reed-Solomon parity tiles per codeword, 0 if the body has no error correction (see steg.fec)
+    fec: int
     width: int
     height: int
     tile_width: int
     tile_height: int
+    # number of payload bytes in the body. With error correction the body takes more tiles than this, see body_tiles
     body_length: int
     x: int
     y: int
     is_full: bool
-    image: Image.Image
     drawable_image: ImageDraw.ImageDraw
-    palette: list[tuple[int, int, int]]
+    # the palette the body is drawn in. The header is always drawn in DEFAULT_PALETTE.
+    palette: Palette
+    # whether the header and body were restored from the frame cache instead of being decoded
+    from_cache: bool
+    # number of body tiles that error correction fixed when the frame was decoded
+    corrected_tiles: int
 
     default_tile_width = 16
     default_tile_height = 16
-    header_length_bytes = 13
+    # the header length of the version being read until the header says otherwise
+    header_length_bytes = header_length(1)
+    SUPPORTED_VERSIONS = (1, 2, 3, 4)
 
     _header_decoded = False
-
-    def __init__(self, frame_seqno: int, body_length: int, resolution: tuple[int, int], tile_width: int, tile_height: int, palette: Optional[list[tuple[int, int, int]]] = None, version: int = 1):
+    _pixels: Optional[np.ndarray] = None
+    _image: Optional[Image.Image] = None
+    _cache: Optional[FrameCache] = None
+    _pixel_digest: Optional[str] = None
+    _cache_entry: Optional[tuple[int, Optional[CacheEntry]]] = None
+
+    def __init__(self, frame_seqno: int, body_length: int, resolution: tuple[int, int], tile_width: int, tile_height: int, palette: Optional[Palette] = None, version: int = 1, codec: int = 0, fec: int = 0):
+        self.palette = palette if palette is not None else DEFAULT_PALETTE
+        if codec and version < 2:
+            raise Exception("version 1 headers have no room for a codec")
+        if fec:
+            if version < 3:
+                raise Exception(f"version {version} headers have no room for error correction")
+            steg_fec.check_nsym(fec)
+        if not self.palette.is_default and version < PALETTE_VERSION:
+            raise Exception(f"version {version} headers have no room for a palette id")
         self.version = version
+        self.header_length_bytes = header_length(version)
         self.frame_seqno = frame_seqno
+        self.codec = codec
+        self.fec = fec
         self.body_length = body_length
         self.width, self.height = resolution
         self.tile_width = tile_width
@@ -40,15 +91,18 @@ class Frame:
         self.x = 0
         self.y = 0
         self.is_full = False
-
-        if palette is not None:
-            self.palette = palette
-        else:
-            self.palette = generate_default_palette()
+        self.from_cache = False
+        self.corrected_tiles = 0
 
     @classmethod
-    def new(cls, frame_seqno: int, body_length: int, resolution: tuple[int, int], tile_width: int, tile_height: int, version: int = 1):
-        frame = cls(frame_seqno, body_length, resolution, tile_width, tile_height, version=version)
+    def new(cls, frame_seqno: int, body_length: int, resolution: tuple[int, int], tile_width: int, tile_height: int, version: int = 1, palette: Optional[Palette] = None):
+        """
+        Starts a frame whose body is then drawn tile by tile with write(). Error correction needs the whole body
+        up front to compute its parity, so frames with error correction are made with from_bytes() instead.
+        """
+        if version == 3:
+            raise Exception("version 3 headers are for error correction, which needs the whole body, see Frame.from_bytes()")
+        frame = cls(frame_seqno, body_length, resolution, tile_width, tile_height, palette=palette, version=version)
         frame.image = Image.new('RGB', resolution)
         frame.drawable_image = ImageDraw.Draw(frame.image)
 
@@ -57,19 +111,74 @@ class Frame:
         return frame
 
     @classmethod
-    def load_from_file(cls, file_handle: str | bytes | pathlib.Path | IOBase, fuzziness=17):
+    def from_bytes(cls, frame_seqno: int, data: bytes, resolution: tuple[int, int], tile_width: int, tile_height: int, version: int = 1, codec: int = 0, fec: int = 0, palette: Optional[Palette] = None):
+        """
+        Builds a complete frame (header and body) from a whole frame's worth of data in one pass.
+        Without error correction, produces the same image as Frame.new() followed by Frame.write(data).
+        """
+        frame = cls(frame_seqno, len(data), resolution, tile_width, tile_height, palette=palette, version=version, codec=codec, fec=fec)
+        frame._pixels = frame.render(data)
+        frame.image = Image.fromarray(frame._pixels, mode='RGB')
+        frame.drawable_image = ImageDraw.Draw(frame.image)
+        frame.is_full = True
+
+        return frame
+
+    @classmethod
+    def load_from_file(cls, file_handle: str | bytes | pathlib.Path | IOBase, fuzziness=17, tile_size: Optional[tuple[int, int]] = None, cache: Optional[FrameCache] = None):
         image = Image.open(file_handle)
         frame = cls(0, 0, (image.width, image.height), cls.default_tile_width, cls.default_tile_height)
         frame.image = image
         frame.drawable_image = ImageDraw.Draw(frame.image)
+        frame._cache = cache
+
+        frame.decode_header(fuzziness=fuzziness, tile_size=tile_size)
+
+        return frame
+
+    @classmethod
+    def load_from_array(cls, pixels: np.ndarray, fuzziness=17, tile_size: Optional[tuple[int, int]] = None, cache: Optional[FrameCache] = None):
+        """
+        Loads a frame from an RGB array of shape (height, width, 3), e.g. a raw video frame read from ffmpeg.
+        The array is used as-is, without copying. An image is only made from it if something asks for one.
+        :param tile_size: tile (width, height) of an earlier frame from the same video, see decode_header()
+        :param cache: if given, the header and body are taken from here when this frame has been decoded before
+        """
+        height, width = pixels.shape[:2]
+        frame = cls(0, 0, (width, height), cls.default_tile_width, cls.default_tile_height)
+        frame._pixels = pixels
+        frame._cache = cache
 
-        frame.decode_header(fuzziness=fuzziness)
+        frame.decode_header(fuzziness=fuzziness, tile_size=tile_size)
 
         return frame
 
     def __len__(self):
         return self.body_length
 
+    @property
+    def body_tiles(self) -> int:
+        """the number of tiles the body takes up, including any error correction parity"""
+        return steg_fec.encoded_length(self.body_length, self.fec) if self.fec else self.body_length
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            self._image = Image.fromarray(self._pixels, mode='RGB')
+        return self._image
+
+    @image.setter
+    def image(self, image: Image.Image):
+        self._image = image
+
+    @property
+    def pixels(self) -> np.ndarray:
+        """This frame's image as an array of shape (height, width, 3), converted once and reused."""
+        if self._pixels is None:
+            image = self.image if self.image.mode == 'RGB' else self.image.convert('RGB')
+            self._pixels = np.asarray(image)
+        return self._pixels
+
     def write(self, data: bytes | int) -> int:
         """
 
@@ -104,15 +213,49 @@ class Frame:
 
         return tiles_drawn
 
+    def render(self, data: bytes) -> np.ndarray:
+        """
+        Rasterizes this frame's header followed by the given data into an RGB buffer of shape (height, width, 3).
+        Bytes are mapped through the palettes and expanded into tile-sized blocks with array operations
+        instead of drawing each tile individually. Data that does not fit in the frame is dropped.
+        If the frame has error correction, the data is encoded with its parity first.
+        """
+        num_columns = self.width // self.tile_width
+        num_rows = self.height // self.tile_height
+        body = steg_fec.encode(bytes(data), self.fec) if self.fec else bytes(data)
+        header = self.generate_header_bytes(self.version, self.frame_seqno, self.tile_width, self.tile_height, len(body), self.codec, self.fec, self.palette.id)
+        tiles = np.frombuffer(header + body, dtype=np.uint8)[:num_columns * num_rows]
+
+        # tiles past the end of the data are left black, just like the undrawn parts of a new image
+        colors = np.zeros((num_rows * num_columns, 3), dtype=np.uint8)
+        num_header_tiles = min(len(header), len(tiles))
+        colors[:num_header_tiles] = DEFAULT_PALETTE.colors[tiles[:num_header_tiles]]
+        colors[num_header_tiles:len(tiles)] = self.palette.colors[tiles[num_header_tiles:]]
+        # widen each row of tiles to full tile width, then copy it into every pixel row the tiles cover
+        tile_rows = np.repeat(colors.reshape(num_rows, num_columns, 3), self.tile_width, axis=1)
+        buffer = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        pixel_rows = buffer[:num_rows * self.tile_height].reshape(num_rows, self.tile_height, self.width, 3)
+        pixel_rows[:, :, :num_columns * self.tile_width] = tile_rows[:, np.newaxis]
+        # leftover pixels that don't fit a whole tile stay black
+        buffer[:, num_columns * self.tile_width:] = 0
+        buffer[num_rows * self.tile_height:] = 0
+        return buffer
+
     def tile_from_byte(self, byte: int) -> tuple[int, int, int]:
         return self.palette[byte]
 
     def write_header(self):
-        self.draw_tiles(self.generate_header(self.version, self.frame_seqno, self.tile_width, self.tile_height, self.body_length))
+        # the header counts tiles, parity included
+        self.draw_tiles(self.generate_header(self.version, self.frame_seqno, self.tile_width, self.tile_height, self.body_tiles, self.codec, self.fec, self.palette.id))
+
+    def generate_header(self, version: int, frame_seqno: int, tile_width: int, tile_height: int, length: int, codec: int = 0, fec: int = 0, palette_id: int = 0) -> list[tuple[int, int, int]]:
+        """:return: the colors of the header tiles, which are always in the default palette. See generate_header_bytes()."""
+        return [DEFAULT_PALETTE[byte] for byte in self.generate_header_bytes(version, frame_seqno, tile_width, tile_height, length, codec, fec, palette_id)]
 
-    def generate_header(self, version: int, frame_seqno: int, tile_width: int, tile_height: int, length: int) -> list[tuple[int, int, int]]:
+    @staticmethod
+    def generate_header_bytes(version: int, frame_seqno: int, tile_width: int, tile_height: int, length: int, codec: int = 0, fec: int = 0, palette_id: int = 0) -> bytes:
         """
-        header:
+        version 1 header:
         magic bytes - black tile, white tile
         version - 1 byte
         reserved - 1 byte
@@ -122,20 +265,65 @@ class Frame:
         tile height - 1 byte
         body length - 2 bytes (big-endian) (does not include header)
         reserved - 3 bytes
-        """
-        length_bytes = struct.pack('>H', length)
 
-        return [
-            self.palette[0x0], self.palette[0xFF],  # magic bytes
-            self.palette[version],
-            self.palette[0x0], self.palette[0x0],  # reserved
-            self.palette[frame_seqno],
-            self.palette[tile_width],
-            self.palette[tile_height],
-            self.palette[length_bytes[0]],
-            self.palette[length_bytes[1]],
-            self.palette[0x0], self.palette[0x0], self.palette[0x0]  # reserved
-        ]
+        version 2 uses the reserved bytes to widen the seqno to an absolute 32-bit frame index and the body length
+        to 24 bits. The low bytes stay where version 1 has them, so version 1 readers still find the seqno,
+        and the body length too while it is under 65536:
+        magic bytes - black tile, white tile
+        version - 1 byte
+        body length, bits 16-23 - 1 byte
+        codec - 1 byte (0 if the payload isn't compressed)
+        frame index, bits 0-7 - 1 byte
+        tile width - 1 byte
+        tile height - 1 byte
+        body length, bits 0-15 - 2 bytes (big-endian)
+        frame index, bits 8-31 - 3 bytes (big-endian)
+
+        version 3 is the version 2 header followed by one more byte, for frames whose body has error correction.
+        The body length counts tiles, parity included:
+        parity tiles per Reed-Solomon codeword - 1 byte (see steg.fec)
+
+        version 4 is the version 3 header followed by the id of the palette the body is drawn in (see steg.palette),
+        for frames that don't use the default palette. Error correction is optional here, 0 parity tiles meaning none:
+        palette id - 4 bytes (big-endian)
+
+        Headers are always drawn in the default palette.
+        """
+        if version == 1:
+            length_bytes = struct.pack('>H', length)
+
+            return bytes([
+                0x0, 0xFF,  # magic bytes
+                version,
+                0x0, 0x0,  # reserved
+                frame_seqno % 256,
+                tile_width,
+                tile_height,
+                length_bytes[0],
+                length_bytes[1],
+                0x0, 0x0, 0x0  # reserved
+            ])
+
+        length_bytes = length.to_bytes(3, 'big')
+        index_bytes = frame_seqno.to_bytes(4, 'big')
+
+        header = bytes([
+            0x0, 0xFF,  # magic bytes
+            version,
+            length_bytes[0],
+            codec,
+            index_bytes[3],
+            tile_width,
+            tile_height,
+            length_bytes[1],
+            length_bytes[2],
+            index_bytes[0], index_bytes[1], index_bytes[2],
+        ])
+        if version >= 3:
+            header += bytes([fec])
+        if version >= 4:
+            header += palette_id.to_bytes(4, 'big')
+        return header
 
     def tiles(self) -> Generator[tuple]:
         """
@@ -164,7 +352,23 @@ class Frame:
         y = row * self.tile_height + math.ceil(self.tile_height / 2)
         return self.image.getpixel((x, y))
 
-    def decode_header(self, fuzziness=17):
+    def decode_header(self, fuzziness=17, tile_size: Optional[tuple[int, int]] = None):
+        """
+        Finds the header and reads the frame's geometry, seqno and body length from it.
+        :param tile_size: tile (width, height) of an earlier frame from the same video. Tile sizes don't change within
+            an encode, so the header is read straight from the known tile positions, and the pixel-by-pixel search for
+            the tile size only happens if that header doesn't check out.
+        """
+        entry = self.cached(fuzziness)
+        if entry is not None:
+            self.restore(entry)
+            return
+
+        # the header is in the default palette, and says which palette the body is in
+        self.palette = DEFAULT_PALETTE
+        if tile_size is not None and self.decode_known_header(tile_size, fuzziness=fuzziness):
+            return
+
         # find header -- starts with black
         # skip 8 rows and columns of pixels to try to avoid image edges
         if not fuzzy_equals(self.image.getpixel(xy=(8, 8)), self.palette[0x0], fuzziness=fuzziness):
@@ -191,23 +395,169 @@ class Frame:
         self.x = math.ceil(self.tile_width * 2.5)
         self.y = math.ceil(self.tile_height / 2)
         header_bytes = self.read(self.header_length_bytes - 2, fuzziness=fuzziness)
+        assert self.tile_width == header_bytes[4], f"ERROR: {self.tile_width} != {header_bytes[4]}"
+        # newer headers are longer, and the version says by how much
+        header_bytes += self.read(header_length(header_bytes[0]) - self.header_length_bytes, fuzziness=fuzziness)
+        self.parse_header(header_bytes)
+        # the header row was sampled as if the tiles were square, which works for the non-square tiles plan_layout()
+        # allows, but the read position should still be at the center of the row for anything read after it
+        self.y = math.ceil(self.tile_height / 2)
+
+    def decode_known_header(self, tile_size: tuple[int, int], fuzziness=17) -> bool:
+        """
+        Reads the header assuming the given tile size, sampling all header tiles at once.
+        :return: whether the magic bytes and the tile size recorded in the header matched
+        """
+        header = self.read_header_tiles(self.pixels, tile_size, fuzziness=fuzziness)
+        if header is None:
+            return False
+
+        tile_width, tile_height = tile_size
+        self.tile_width = tile_width
+        self.parse_header(bytes(header[2:].astype(np.uint8)))
+        # leave the read position where the full header search would, right after the header
+        self.x = math.ceil(tile_width * 2.5) + (self.header_length_bytes - 2) * tile_width
+        self.y = math.ceil(tile_height / 2)
+        return True
+
+    @classmethod
+    def read_header_tiles(cls, pixels: np.ndarray, tile_size: tuple[int, int], fuzziness=17) -> Optional[np.ndarray]:
+        """
+        Classifies the header tiles of a frame's pixels, assuming the given tile size, without parsing them.
+        :return: the header's values, magic bytes included, or None if the magic bytes, the version or the tile size
+                 recorded in the header don't match
+        """
+        tile_width, tile_height = tile_size
+        height, width = pixels.shape[:2]
+        ys, xs = tile_centers((width, height), tile_width, tile_height)
+        # sample enough tiles for the longest header, and only use as many as the version calls for
+        num_tiles = min(header_length(max(cls.SUPPORTED_VERSIONS)), len(ys))
+        if num_tiles < header_length(1):
+            return None
+
+        header = DEFAULT_PALETTE.classifier(fuzziness).classify(pixels[ys[:num_tiles], xs[:num_tiles], :3])
+        if header[2] not in cls.SUPPORTED_VERSIONS or header_length(header[2]) > num_tiles:
+            return None
+        header = header[:header_length(header[2])]
+        if NO_MATCH in header or header[0] != 0x0 or header[1] != 0xFF or header[6] != tile_width or header[7] != tile_height:
+            return None
+        return header
+
+    def parse_header(self, header_bytes: bytes):
+        """
+        Sets this frame's fields from the header, minus the magic bytes. See generate_header_bytes() for the layouts.
+        """
         self.version = header_bytes[0]
-        # [1] reserved
-        # [2] reserved
+        if self.version not in self.SUPPORTED_VERSIONS:
+            raise Exception(f"unsupported header version {self.version}")
+        self.header_length_bytes = header_length(self.version)
+
         self.frame_seqno = header_bytes[3]
-        assert self.tile_width == header_bytes[4], f"ERROR: {self.tile_width} != {header_bytes[4]}"
         self.tile_height = header_bytes[5]
         self.body_length = (header_bytes[6] << 8) + header_bytes[7]
-        # [8], [9], [10] reserved
+        self.codec = 0
+        self.fec = 0
+        if self.version >= 2:
+            self.body_length += header_bytes[1] << 16
+            self.codec = header_bytes[2]
+            self.frame_seqno += int.from_bytes(header_bytes[8:11], 'big') << 8
+        if self.version >= 3:
+            self.fec = header_bytes[11]
+        if self.version == 3 or self.fec:
+            steg_fec.check_nsym(self.fec)
+            # the header counts tiles, the frame counts payload bytes
+            self.body_length = steg_fec.data_length(self.body_length, self.fec)
+        self.palette = get_palette(int.from_bytes(header_bytes[12:16], 'big')) if self.version >= 4 else DEFAULT_PALETTE
 
         self._header_decoded = True
 
+    def cached(self, fuzziness=17) -> Optional[CacheEntry]:
+        """
+        :return: this frame's entry in the frame cache for the given fuzziness, if there is a cache and an entry
+        """
+        if self._cache is None:
+            return None
+        if self._cache_entry is None or self._cache_entry[0] != fuzziness:
+            self._cache_entry = (fuzziness, self._cache.get(self.cache_key(fuzziness)))
+        return self._cache_entry[1]
+
+    def cache_key(self, fuzziness=17) -> str:
+        # the pixels are only hashed once, however many times the frame is looked up
+        if self._pixel_digest is None:
+            self._pixel_digest = FrameCache.pixel_digest(self.pixels)
+        # the header is read in the default palette, and it decides the body's, so that's the one the entry depends on
+        return FrameCache.key(self._pixel_digest, DEFAULT_PALETTE.colors, fuzziness)
+
+    def restore(self, entry: CacheEntry):
+        """
+        Sets this frame's header fields from a cache entry, leaving the read position right after the header.
+        """
+        self.version = entry.version
+        self.header_length_bytes = header_length(entry.version)
+        self.frame_seqno = entry.frame_seqno
+        self.codec = entry.codec
+        self.fec = entry.fec
+        self.tile_width = entry.tile_width
+        self.tile_height = entry.tile_height
+        self.body_length = entry.body_length
+        self.palette = get_palette(entry.palette_id)
+        self.x = math.ceil(self.tile_width * 2.5) + (self.header_length_bytes - 2) * self.tile_width
+        self.y = math.ceil(self.tile_height / 2)
+        self._header_decoded = True
+
     def decode(self, ignore_errors: bool = False, fuzziness=17) -> bytes:
+        return self.decode_with_mask(ignore_errors=ignore_errors, fuzziness=fuzziness)[0]
+
+    def decode_with_mask(self, ignore_errors: bool = False, fuzziness=17) -> tuple[bytes, np.ndarray]:
+        """
+        Decodes the frame body by sampling every tile center at once and classifying them in a single lookup.
+        If the body has error correction, tiles that don't match the palette are corrected as erasures along with
+        any tiles that matched the wrong color, and only codewords with too many of either are errors.
+        :param ignore_errors: decode tiles that don't match the palette (or can't be corrected) as 0 instead of raising
+            an exception
+        :return: the body bytes, and a boolean array that is True for each body byte that couldn't be decoded
+        """
         if not self._header_decoded:
             self.decode_header(fuzziness=fuzziness)
-        return self.read(ignore_errors=ignore_errors, fuzziness=fuzziness)
+
+        # a cached frame with unmatched tiles is decoded again when errors matter, so the usual exception is raised
+        entry = self.cached(fuzziness)
+        if entry is not None and (ignore_errors or not entry.unmatched.any()):
+            self.from_cache = True
+            return entry.body, entry.unmatched
+
+        ys, xs = tile_centers((self.width, self.height), self.tile_width, self.tile_height)
+        ys = ys[self.header_length_bytes:self.header_length_bytes + self.body_tiles]
+        xs = xs[self.header_length_bytes:self.header_length_bytes + self.body_tiles]
+        samples = self.pixels[ys, xs, :3]
+        values = self.palette.classifier(fuzziness).classify(samples)
+
+        unmatched = values == NO_MATCH
+        if self.fec:
+            values[unmatched] = 0
+            values, unmatched, self.corrected_tiles = steg_fec.decode(values.astype(np.uint8), unmatched, self.fec)
+            if unmatched.any():
+                if not ignore_errors:
+                    raise Exception(f"image was too messed up, {np.count_nonzero(unmatched)} bytes couldn't be corrected")
+                print(f"{np.count_nonzero(unmatched)} bytes couldn't be corrected, ignoring")
+        else:
+            for tile_index in np.flatnonzero(unmatched):
+                color = tuple(int(channel) for channel in samples[tile_index])
+                if not ignore_errors:
+                    raise Exception(f"image was too messed up, couldn't find value for color {color}")
+                print(f"invalid tile {tile_index} at ({xs[tile_index]},{ys[tile_index]}) {color}, ignoring")
+        values[unmatched] = 0
+        body = values.astype(np.uint8).tobytes()
+
+        if self._cache is not None:
+            entry = CacheEntry(self.version, self.frame_seqno, self.codec, self.fec, self.tile_width, self.tile_height, self.palette.id, body, unmatched)
+            self._cache.put(self.cache_key(fuzziness), entry)
+            self._cache_entry = (fuzziness, entry)
+
+        return body, unmatched
 
     def read(self, num_tiles_to_read: Optional[int] = None, ignore_errors: bool = False, fuzziness: int = 17) -> bytes:
+        classifier = self.palette.classifier(fuzziness)
         num_tiles_read = 0
         pixels = []
         if num_tiles_to_read is None:
@@ -222,7 +572,7 @@ class Frame:
             pixel = self.image.getpixel((self.x, self.y))
 
             try:
-                pixels.append(list_fuzzy_search(self.palette, pixel, fuzziness=fuzziness))
+                pixels.append(classifier.lookup(pixel))
             except:
                 if ignore_errors:
                     print(f"invalid tile {num_tiles_read} at ({self.x},{self.y}) {pixel}, ignoring")
@@ -0,0 +1,70 @@
+import bisect
+import json
+from typing import Optional
+
+
+class FrameIndex:
+    """
+    Maps payload byte offsets to the video frames that hold them, so a byte range can be decoded by seeking
+    straight to the frames it needs. Every frame is a keyframe (see VIDEO_OUTPUT_OPTIONS), so any frame can be seeked to.
+
+    Indexes are written as a JSON sidecar next to the video at encode time, or built by scanning the frame headers.
+    """
+    framerate: float
+    # (payload offset, body length, frame number within the video) for each unique frame, in payload order
+    frames: list[tuple[int, int, int]]
+
+    def __init__(self, framerate: float, frames: Optional[list[tuple[int, int, int]]] = None):
+        self.framerate = framerate
+        self.frames = frames if frames is not None else []
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def total_bytes(self) -> int:
+        if not self.frames:
+            return 0
+        offset, length, _ = self.frames[-1]
+        return offset + length
+
+    def add_frame(self, body_length: int, video_frame: int):
+        self.frames.append((self.total_bytes, body_length, video_frame))
+
+    def positions_for_range(self, start: int, end: int) -> range:
+        """
+        :return: the positions in the index of the frames holding payload bytes start (inclusive) through end (exclusive)
+        """
+        if start >= end:
+            return range(0)
+        offsets = [offset for offset, _, _ in self.frames]
+        first = max(bisect.bisect_right(offsets, start) - 1, 0)
+        last = bisect.bisect_left(offsets, end)
+        return range(first, last)
+
+    def frames_for_range(self, start: int, end: int) -> list[tuple[int, int, int]]:
+        """
+        :return: the index entries of the frames holding payload bytes start (inclusive) through end (exclusive)
+        """
+        positions = self.positions_for_range(start, end)
+        return self.frames[positions.start:positions.stop]
+
+    def timestamp(self, video_frame: int) -> float:
+        """
+        :return: a seek position that lands on the given frame. It is half a frame early, so rounding can't skip past it.
+        """
+        return max(video_frame - 0.5, 0) / self.framerate
+
+    @staticmethod
+    def sidecar_path(video_path: str) -> str:
+        return f'{video_path}.index.json'
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'version': 1, 'framerate': self.framerate, 'frames': self.frames}, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'FrameIndex':
+        with open(path) as f:
+            index = json.load(f)
+        return cls(index['framerate'], [tuple(frame) for frame in index['frames']])
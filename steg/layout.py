@@ -0,0 +1,117 @@
+import math
+from typing import Optional
+
+from steg import fec as steg_fec
+from steg.util import header_length, header_version
+
+# tile dimensions are stored in one header byte each
+MAX_TILE_SIZE = 255
+
+
+class Layout:
+    """
+    How a payload is laid out in frames: the tile size, the grid of tiles it gives, how many parity tiles each
+    error correction codeword has (0 for none, see steg.fec), whether the header has to name a custom palette,
+    and how many frames it takes.
+    """
+    tile_width: int
+    tile_height: int
+    columns: int
+    rows: int
+    frames: int
+    fec: int
+    custom_palette: bool
+
+    def __init__(self, tile_width: int, tile_height: int, columns: int, rows: int, frames: int, fec: int = 0, custom_palette: bool = False):
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.columns = columns
+        self.rows = rows
+        self.frames = frames
+        self.fec = fec
+        self.custom_palette = custom_palette
+
+    @classmethod
+    def for_tile_size(cls, resolution: tuple[int, int], tile_width: int, tile_height: int, data_length: Optional[float] = None, fec: int = 0, custom_palette: bool = False) -> 'Layout':
+        """:return: the layout given by a fixed tile size. The frame count is 0 if the data length isn't known."""
+        layout = cls(tile_width, tile_height, resolution[0] // tile_width, resolution[1] // tile_height, 0, fec, custom_palette)
+        if data_length is not None and data_length != math.inf:
+            layout.frames = math.ceil(data_length / layout.capacity)
+        return layout
+
+    @property
+    def capacity(self) -> int:
+        """the number of payload bytes that fit in one frame, after the header and any error correction"""
+        return body_capacity(self.columns * self.rows, self.fec, self.custom_palette)
+
+    def __repr__(self):
+        fec = f", {self.fec} parity tiles per codeword" if self.fec else ""
+        return f"Layout({self.tile_width}x{self.tile_height} tiles, {self.columns}x{self.rows} grid{fec}, {self.frames} frames)"
+
+
+def body_capacity(tiles: int, fec: int = 0, custom_palette: bool = False) -> int:
+    """:return: the number of payload bytes that fit in a frame of the given number of tiles"""
+    body_tiles = tiles - header_length(header_version(fec, custom_palette))
+    if not fec:
+        return body_tiles
+    return steg_fec.data_capacity(body_tiles, fec)
+
+
+def plan_layout(data_length: float, resolution: tuple[int, int], min_tile_size: tuple[int, int] = (16, 16), square: bool = False, fec: int = 0, custom_palette: bool = False) -> Layout:
+    """
+    Picks the tile size for a payload: the fewest frames first, then the largest tiles (which survive compression
+    best), then the squarest tiles. Payloads of unknown length (math.inf) get the smallest tiles.
+
+    Only tile sizes that fill the frame are considered, i.e. the largest width for each number of columns and the
+    largest height for each number of rows, so the search is over grid sizes rather than every pixel dimension.
+
+    Non-square tiles are kept to less than 2:1 either way and to a first row that holds the whole header,
+    which is what Frame.decode_header() needs to find the header before it knows the tile height.
+
+    :param data_length: the number of payload bytes, or math.inf if it isn't known
+    :param resolution: the frame (width, height)
+    :param min_tile_size: the smallest tile (width, height) to use
+    :param square: only consider square tiles
+    :param fec: parity tiles per error correction codeword, 0 for none
+    :param custom_palette: whether the frames are drawn in a palette other than the default one,
+                           which makes their headers longer
+    """
+    width, height = resolution
+    min_tile_width, min_tile_height = min_tile_size
+    if min_tile_width > width or min_tile_height > height:
+        raise Exception(f"{min_tile_width}x{min_tile_height} tiles don't fit in a {width}x{height} frame")
+
+    # smallest tiles give the most capacity, and so the fewest frames that any layout can manage
+    smallest = Layout.for_tile_size(resolution, min_tile_width, min_tile_height, fec=fec, custom_palette=custom_palette)
+    if smallest.capacity < 1:
+        raise Exception(f"{min_tile_width}x{min_tile_height} tiles leave no room for data after the header in a {width}x{height} frame")
+    if data_length == math.inf:
+        return smallest
+    frames = max(math.ceil(data_length / smallest.capacity), 1)
+    # every frame but the last is full, so this is the capacity each frame needs for the data to fit in that many
+    needed_capacity = math.ceil(data_length / frames)
+
+    best = (min_tile_width, min_tile_height)
+    best_key = None
+    for columns in range(1, smallest.columns + 1):
+        for rows in range(1, smallest.rows + 1):
+            if body_capacity(columns * rows, fec, custom_palette) < max(needed_capacity, 1):
+                continue
+            tile_width = min(width // columns, MAX_TILE_SIZE)
+            tile_height = min(height // rows, MAX_TILE_SIZE)
+            if square:
+                tile_width = tile_height = min(tile_width, tile_height)
+            elif tile_width != tile_height and not _decodable(tile_width, tile_height, columns, fec, custom_palette):
+                continue
+
+            key = (tile_width * tile_height, min(tile_width, tile_height))
+            if best_key is None or key > best_key:
+                best_key = key
+                best = (tile_width, tile_height)
+
+    return Layout.for_tile_size(resolution, best[0], best[1], data_length, fec, custom_palette)
+
+
+def _decodable(tile_width: int, tile_height: int, columns: int, fec: int = 0, custom_palette: bool = False) -> bool:
+    """whether a header of non-square tiles can be read by sampling the first row as if the tiles were square"""
+    return columns >= header_length(header_version(fec, custom_palette)) and math.ceil(tile_width / 2) < tile_height < tile_width * 2
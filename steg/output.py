@@ -0,0 +1,105 @@
+import mmap
+import pathlib
+from typing import Optional
+
+import numpy as np
+
+
+class MappedOutput:
+    """
+    An output file that decoded frame bodies are written straight into at their offset in the payload,
+    in whatever order they're decoded. Every frame but the last carries exactly frame_capacity bytes,
+    so the frame with index i starts at i * frame_capacity.
+
+    The file is preallocated and memory-mapped, and grown (and mapped again) if a frame lands past its end.
+    A bitmap records which frames have been written, so the ones that never turned up can be listed at the end,
+    and close() trims the file to the end of the payload.
+    """
+    path: pathlib.Path
+    frame_capacity: int
+    # True for each frame index that has been written
+    completed: np.ndarray
+    # number of frames in the payload, known once the last frame (the only one that can be short) has been written
+    total_frames: Optional[int]
+    # end of the payload written so far
+    end: int
+    # the payload length given up front, or 0 if it isn't known
+    size_hint: int
+
+    def __init__(self, path: str | pathlib.Path, frame_capacity: int, size_hint: int = 0):
+        """
+        :param frame_capacity: the number of payload bytes in every frame but the last
+        :param size_hint: the number of bytes to preallocate, e.g. the payload length from the video's FrameIndex
+        """
+        if frame_capacity < 1:
+            raise Exception(f"frames must hold at least 1 byte, got {frame_capacity}")
+        self.path = pathlib.Path(path)
+        self.frame_capacity = frame_capacity
+        self.completed = np.zeros(max(-(-size_hint // frame_capacity), 1), dtype=bool)
+        self.total_frames = None
+        self.end = 0
+        self.size_hint = size_hint
+
+        self._file = open(self.path, 'w+b')
+        self._size = 0
+        self._map: Optional[mmap.mmap] = None
+        self._grow(size_hint)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, frame_index: int, body: bytes) -> bool:
+        """
+        Writes a frame's body at its offset.
+        :return: False if the frame had already been written, in which case nothing is written
+        """
+        if len(body) > self.frame_capacity:
+            raise Exception(f"frame {frame_index} holds {len(body)} bytes, more than the {self.frame_capacity} every frame should")
+        if frame_index < len(self.completed) and self.completed[frame_index]:
+            return False
+
+        offset = frame_index * self.frame_capacity
+        self._grow(offset + len(body))
+        self._map[offset:offset + len(body)] = body
+
+        if frame_index >= len(self.completed):
+            self.completed = np.concatenate([self.completed, np.zeros(max(frame_index + 1, len(self.completed) * 2) - len(self.completed), dtype=bool)])
+        self.completed[frame_index] = True
+        if len(body) < self.frame_capacity:
+            self.total_frames = frame_index + 1
+        self.end = max(self.end, offset + len(body))
+        return True
+
+    def missing(self) -> list[int]:
+        """
+        :return: the indexes of the frames that haven't been written. Without the last frame, the number of frames
+                 comes from the size hint, or if there wasn't one, only frames before the last one written can be listed.
+        """
+        total_frames = self.total_frames if self.total_frames is not None else -(-max(self.end, self.size_hint) // self.frame_capacity)
+        written = self.completed[:total_frames]
+        return np.flatnonzero(~written).tolist() + list(range(len(written), total_frames))
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        self._file.truncate(self.end)
+        self._file.close()
+
+    def _grow(self, size: int):
+        if size <= self._size:
+            return
+        # at least double, so a payload of unknown length is only mapped again a handful of times
+        size = max(size, self._size * 2)
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._size = size
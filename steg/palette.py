@@ -0,0 +1,197 @@
+"""
+Palettes map byte values to tile colors. Every frame header is drawn in the default palette, so a decoder can always
+read it, and the body is drawn in whichever palette the header names. Frames in the default palette use the usual
+header versions, while frames in any other palette use a version 4 header that carries the palette's id.
+
+Palettes other than the default one can be:
+    * loaded from a 768-byte file of (R, G, B) for each value in order, the color of 0 first
+    * loaded from a 256-byte file that permutes the default palette: the first byte is the value given the first
+      color of the default palette, and so on
+    * derived from a seed, which permutes the default palette in an order only that seed gives
+
+A decoder finds a palette by its id once it has been registered with register_palette(), which encoding does too.
+Registered palettes are also saved in the cache directory, so later runs (and worker processes) find them as well.
+A video made with a palette can't be decoded anywhere it hasn't been registered, which is the point of scrambling one.
+"""
+import hashlib
+import os
+import pathlib
+import tempfile
+from collections.abc import Iterable, Sequence
+from typing import Optional
+
+import numpy as np
+
+from steg.classifier import PaletteClassifier, get_classifier
+from steg.util import cache_dir, generate_default_palette
+
+NUM_COLORS = 256
+# length of a palette file: one (R, G, B) per value
+PALETTE_FILE_LENGTH = NUM_COLORS * 3
+# length of a file that permutes the default palette: one value per default color
+PERMUTATION_FILE_LENGTH = NUM_COLORS
+
+_registry: dict[int, 'Palette'] = {}
+
+
+class Palette:
+    """
+    An immutable set of 256 tile colors, along with the lookups built from it. The colors array is what encoding
+    indexes by byte value, and the classifiers that decoding uses are built once per fuzziness and then shared by
+    every frame drawn in this palette.
+    """
+    # the color of each byte value, shape (256, 3). Read-only.
+    colors: np.ndarray
+    # 32-bit fingerprint of the colors, which version 4 headers carry
+    id: int
+
+    def __init__(self, colors: bytes | Sequence[tuple[int, int, int]]):
+        """
+        :param colors: the (R, G, B) of each byte value, as a sequence of tuples or 768 bytes
+        """
+        if isinstance(colors, (bytes, bytearray, memoryview)):
+            array = np.frombuffer(bytes(colors), dtype=np.uint8)
+        else:
+            array = np.asarray(colors, dtype=np.uint8)
+        if array.size != PALETTE_FILE_LENGTH:
+            raise Exception(f"a palette needs {NUM_COLORS} colors, got {array.size / 3:g}")
+        array = array.reshape(NUM_COLORS, 3).copy()
+        array.flags.writeable = False
+        if len(np.unique(array, axis=0)) != NUM_COLORS:
+            raise Exception("a palette can't give the same color to more than one value")
+
+        self.colors = array
+        self.id = int.from_bytes(hashlib.blake2b(array.tobytes(), digest_size=4).digest(), 'big')
+        self._tuples = tuple((int(r), int(g), int(b)) for r, g, b in array)
+        self._classifiers: dict[int, PaletteClassifier] = {}
+
+    @classmethod
+    def from_file(cls, path: str | pathlib.Path) -> 'Palette':
+        """Loads a 768-byte palette file, or a 256-byte file that permutes the default palette."""
+        data = pathlib.Path(path).read_bytes()
+        if len(data) == PALETTE_FILE_LENGTH:
+            return cls(data)
+        if len(data) == PERMUTATION_FILE_LENGTH:
+            return DEFAULT_PALETTE.permuted(data)
+        raise Exception(f"{path} is {len(data)} bytes, but palette files are {PALETTE_FILE_LENGTH} bytes "
+                        f"(a color for each value) or {PERMUTATION_FILE_LENGTH} bytes (a value for each default color)")
+
+    @classmethod
+    def scrambled(cls, seed: str | bytes) -> 'Palette':
+        """
+        :return: the default palette permuted by the given seed. The order is set by a keyed hash of each value,
+                 so it's the same everywhere for the same seed, and can't be worked out without it.
+        """
+        seed = seed.encode() if isinstance(seed, str) else seed
+        # blake2b keys are at most 64 bytes, which a hash of the seed always is
+        key = hashlib.blake2b(seed).digest()
+        order = sorted(range(NUM_COLORS), key=lambda value: hashlib.blake2b(bytes([value]), key=key, person=b'steg palette').digest())
+        return DEFAULT_PALETTE.permuted(order)
+
+    def permuted(self, order: bytes | Iterable[int]) -> 'Palette':
+        """
+        :param order: the value to give each of this palette's colors, in the order of the colors
+        :return: a palette with the same colors assigned to different values
+        """
+        order = list(order)
+        if sorted(order) != list(range(NUM_COLORS)):
+            raise Exception(f"a palette permutation has to list every value from 0 to {NUM_COLORS - 1} once")
+        colors = np.empty_like(self.colors)
+        colors[order] = self.colors
+        return Palette(colors)
+
+    def classifier(self, fuzziness: int = 17) -> PaletteClassifier:
+        """:return: the lookup table that maps sampled colors to this palette's values, built on first use"""
+        if fuzziness not in self._classifiers:
+            self._classifiers[fuzziness] = get_classifier(self._tuples, fuzziness)
+        return self._classifiers[fuzziness]
+
+    @property
+    def is_default(self) -> bool:
+        return self.id == DEFAULT_PALETTE.id
+
+    def to_bytes(self) -> bytes:
+        """:return: the palette in the 768-byte file format"""
+        return self.colors.tobytes()
+
+    def __getitem__(self, value: int) -> tuple[int, int, int]:
+        return self._tuples[value]
+
+    def __len__(self):
+        return NUM_COLORS
+
+    def __iter__(self):
+        return iter(self._tuples)
+
+    def __eq__(self, other):
+        return isinstance(other, Palette) and np.array_equal(self.colors, other.colors)
+
+    def __hash__(self):
+        return self.id
+
+    def __reduce__(self):
+        # only the colors go to worker processes, which build their own lookups
+        return Palette, (self.to_bytes(),)
+
+    def __repr__(self):
+        return f"Palette(id={self.id:08x})"
+
+
+DEFAULT_PALETTE = Palette(generate_default_palette())
+
+
+def palette_path(palette_id: int) -> pathlib.Path:
+    """:return: where a registered palette is saved for later runs"""
+    return cache_dir() / 'palettes' / f'{palette_id:08x}.pal'
+
+
+def register_palette(palette: Palette):
+    """Lets frames drawn in the given palette be decoded, in this process and in later ones on this machine."""
+    _registry[palette.id] = palette
+    if palette.is_default or palette_path(palette.id).exists():
+        return
+
+    # the saved copy is best-effort, so a read-only or missing cache directory is not an error
+    try:
+        os.makedirs(palette_path(palette.id).parent, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=palette_path(palette.id).parent, suffix='.pal.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(palette.to_bytes())
+        os.replace(temp_path, palette_path(palette.id))
+    except OSError:
+        pass
+
+
+def get_palette(palette_id: int) -> Palette:
+    """:return: the registered palette with the given id, see register_palette()"""
+    if palette_id in _registry:
+        return _registry[palette_id]
+
+    path = palette_path(palette_id)
+    palette = Palette(path.read_bytes()) if path.exists() else None
+    if palette is None or palette.id != palette_id:
+        raise Exception(f"frame is drawn in palette {palette_id:08x}, which hasn't been loaded. "
+                        f"Pass the palette file or seed it was encoded with (e.g. --palette or --palette-seed)")
+    _registry[palette_id] = palette
+    return palette
+
+
+def load_palette(path: Optional[str] = None, seed: Optional[str] = None) -> Optional[Palette]:
+    """
+    Loads the palette given on the command line, if any, and registers it so frames drawn in it can be decoded.
+    :param path: a palette file, see Palette.from_file()
+    :param seed: a seed to scramble the default palette with, see Palette.scrambled()
+    """
+    if path is not None and seed is not None:
+        raise Exception("give a palette file or a palette seed, not both")
+    if path is not None:
+        palette = Palette.from_file(path)
+    elif seed is not None:
+        palette = Palette.scrambled(seed)
+    else:
+        return None
+    register_palette(palette)
+    return palette
+
+
+register_palette(DEFAULT_PALETTE)
@@ -0,0 +1,158 @@
+import bisect
+import functools
+import glob
+import itertools
+import os
+import re
+from collections.abc import Generator, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from steg.cache import FrameCache
+from steg.codec import flush_decompressor, get_codec
+from steg.frame import Frame
+from steg.stats import Stats
+from steg.steg import DECODE_BATCH_SIZE, _decode_frame_batch, _drop_repeats, _merge_batches, sequencer_for, video_frames
+from steg.util import bounded_map
+
+
+class Match:
+    """Where a needle was found: its offset in the decoded payload, and the frame that it starts in."""
+    offset: int
+    # position of the frame in the payload, i.e. how many unique frames come before it
+    frame: int
+    # the PNG the frame was read from, or the video and the frame's index from its header
+    source: str
+
+    def __init__(self, offset: int, frame: int, source: str):
+        self.offset = offset
+        self.frame = frame
+        self.source = source
+
+    def __repr__(self):
+        return f"Match(offset={self.offset}, frame={self.frame}, source={self.source!r})"
+
+
+def search_chunks(chunks: Iterable[tuple[str, bytes]], needle: bytes) -> Generator[Match, None, None]:
+    """
+    Finds every occurrence of the needle in a sequence of decoded frame bodies, in payload order.
+    The last len(needle) - 1 bytes of the data seen so far are carried over into the next frame,
+    so needles that straddle two (or more) frames are still found.
+
+    :param chunks: (source, body) for each frame, in payload order
+    :param needle: the bytes to search for
+    """
+    if not needle:
+        raise Exception("needle must not be empty")
+
+    overlap = len(needle) - 1
+    tail = b''
+    offset = 0
+    # payload offset and source of the frames that the tail still overlaps
+    frame_offsets: list[int] = []
+    frame_sources: list[str] = []
+    first_frame = 0
+
+    for source, body in chunks:
+        frame_offsets.append(offset)
+        frame_sources.append(source)
+
+        window = tail + body
+        window_offset = offset - len(tail)
+        position = window.find(needle)
+        while position != -1:
+            # anything that ends within the tail was already reported with the previous frame
+            if position + len(needle) > len(tail):
+                match_offset = window_offset + position
+                frame = bisect.bisect_right(frame_offsets, match_offset) - 1
+                yield Match(match_offset, first_frame + frame, frame_sources[frame])
+            position = window.find(needle, position + 1)
+
+        offset += len(body)
+        tail = window[max(len(window) - overlap, 0):]
+
+        # forget frames that are no longer part of the tail
+        keep_from = bisect.bisect_right(frame_offsets, offset - len(tail)) - 1
+        if keep_from > 0:
+            del frame_offsets[:keep_from]
+            del frame_sources[:keep_from]
+            first_frame += keep_from
+
+
+def search_video(video_path: str, needle: bytes, fuzziness: int = 17, workers: int = 1, stats: Optional[Stats] = None, cache: Optional[FrameCache] = None, ignore_errors: bool = False) -> Generator[Match, None, None]:
+    """
+    Searches the payload of a video for the needle, decoding frames straight from the video like decode_chunks() does.
+    Matches name the frame they start in by the index in its header (the 1-byte seqno in version 1 headers), which
+    stays right when frames are repeated or lost, and for compressed payloads.
+    :param ignore_errors: search frames with tiles that couldn't be decoded too, as if those bytes were 0,
+                          instead of raising. Needles that overlap them can then be missed, or found where they aren't.
+    """
+    stats = stats if stats is not None else Stats()
+    frames = _drop_repeats(video_frames(video_path), fuzziness=fuzziness, stats=stats)
+    decode_batch = functools.partial(_decode_frame_batch, fuzziness=fuzziness, ignore_errors=ignore_errors, cache=cache)
+    batches = itertools.batched(frames, DECODE_BATCH_SIZE)
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            decoded = _merge_batches(bounded_map(executor, decode_batch, batches, max_pending=workers * 2), stats)
+            yield from search_chunks(_sequence(_label_frames(video_path, decoded), stats), needle)
+    else:
+        decoded = _merge_batches(map(decode_batch, batches), stats)
+        yield from search_chunks(_sequence(_label_frames(video_path, decoded), stats), needle)
+
+
+def search_images(frames_path: str, needle: bytes, fuzziness: int = 17, workers: int = 1, stats: Optional[Stats] = None, cache: Optional[FrameCache] = None, ignore_errors: bool = False) -> Generator[Match, None, None]:
+    """
+    Searches the payload of a directory of PNG frames for the needle. Frames are read in the order of the
+    last number in their file name, and repeated frames are skipped the same way they are when decoding a video.
+    :param ignore_errors: see search_video()
+    """
+    stats = stats if stats is not None else Stats()
+    frame_paths = glob.glob(os.path.join(frames_path, '*.png'))
+    frame_paths = sorted(frame_paths, key=lambda x: float(re.findall(r"(\d+)", x)[-1]))
+    decode_image = functools.partial(_decode_image, fuzziness=fuzziness, cache=cache, ignore_errors=ignore_errors)
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            decoded = bounded_map(executor, decode_image, frame_paths, max_pending=workers * 2)
+            yield from search_chunks(_sequence(zip(frame_paths, decoded), stats), needle)
+    else:
+        decoded = map(decode_image, frame_paths)
+        yield from search_chunks(_sequence(zip(frame_paths, decoded), stats), needle)
+
+
+def _decode_image(frame_path: str, fuzziness: int = 17, cache: Optional[FrameCache] = None, ignore_errors: bool = False) -> tuple[int, int, int, bytes]:
+    frame = Frame.load_from_file(frame_path, fuzziness=fuzziness, cache=cache)
+    body, _ = frame.decode_with_mask(ignore_errors=ignore_errors, fuzziness=fuzziness)
+    return frame.version, frame.codec, frame.frame_seqno, body
+
+
+def _label_frames(video_path: str, frames: Iterable[tuple[int, int, int, bytes]]) -> Generator[tuple[str, tuple[int, int, int, bytes]], None, None]:
+    for frame in frames:
+        yield f"{video_path} frame {frame[2]}", frame
+
+
+def _sequence(frames: Iterable[tuple[str, tuple[int, int, int, bytes]]], stats: Stats) -> Generator[tuple[str, bytes], None, None]:
+    """Puts frames in order and decompresses them, so the needle is searched for in the original data."""
+    sequencer = None
+    decompressor = None
+    frame_path = None
+    for frame_path, (version, codec, frame_seqno, body) in frames:
+        stats.count('frames')
+        if sequencer is None:
+            sequencer = sequencer_for(version, stats)
+            decompressor = get_codec(codec).decompressor() if codec else None
+        for ready in sequencer.add(frame_seqno, (frame_path, body), frame_path):
+            yield _decompress(ready, decompressor)
+
+    if sequencer is not None:
+        for ready in sequencer.flush():
+            yield _decompress(ready, decompressor)
+    remaining = flush_decompressor(decompressor) if decompressor is not None else b''
+    if remaining:
+        yield frame_path, remaining
+
+
+def _decompress(frame: tuple[str, bytes], decompressor) -> tuple[str, bytes]:
+    frame_path, body = frame
+    return frame_path, decompressor.decompress(body) if decompressor is not None else body
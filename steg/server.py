@@ -0,0 +1,562 @@
+"""
+A long-running encode/decode service, so small jobs don't each pay for starting Python, importing numpy, PIL and
+ffmpeg-python, building the palette lookup table and starting worker processes. The workers are started and warmed
+up once, then shared by every job.
+
+Jobs are HTTP requests, over TCP or a Unix socket:
+
+    POST /encode/frame   body: a payload that fits in one frame -> the frame as a PNG
+    POST /decode/frame   body: an image of one frame -> its payload
+    POST /encode?output=PATH   body: a payload -> JSON describing the video written to PATH
+    POST /decode?input=PATH    -> the video's payload, streamed as it's decoded
+    GET /status                -> JSON: workers, queue depth, running jobs and the timings of recent jobs
+
+Encodes take width, height, tile_size, fec, compression and palette parameters (and framerate for videos),
+decodes take fuzziness (and range=START:END for videos), like the encode_file and decode_video flags of the same
+names. Palettes other than the default one are loaded when the server starts, and encodes name theirs by its id in hex.
+Decodes find them by the id in each frame's header.
+Single frames can be sent as raw RGB pixels with format=raw (and width and height, when decoding), which skips
+the PNG encoding and decoding that otherwise take most of the time.
+Responses carry a X-Steg-Job id to look the job up by in /status, and all but streamed ones a Server-Timing header
+with the time spent in each stage.
+
+Video paths are relative to the server's root directory, and paths that lead out of it are refused. Requests have to
+name a local host in their Host header (and Origin, if they have one), so web pages can't send jobs to the server from
+a browser on the same machine. A server started with a token also wants it in a X-Steg-Token header.
+"""
+import collections
+import contextlib
+import hmac
+import io
+import json
+import math
+import multiprocessing
+import os
+import socketserver
+import stat
+import threading
+import time
+import urllib.parse
+from collections.abc import Callable, Generator, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from steg.cache import FrameCache
+from steg.codec import PIECE_SIZE, compress_source, flush_decompressor, get_codec
+from steg.frame import Frame
+from steg.index import FrameIndex
+from steg.palette import DEFAULT_PALETTE, Palette, register_palette
+from steg.stats import Stats
+from steg.steg import _decode_body, _render_frame, decode_chunks, encode_video, frame_capacity, resolve_tile_size
+
+# number of finished jobs listed in /status
+JOB_HISTORY = 100
+# names a request's Host and Origin headers can give for this machine
+LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1'}
+
+
+class Job:
+    id: int
+    kind: str
+    # time.time() when the job arrived
+    submitted: float
+    # seconds spent waiting for a free slot, and running once it had one
+    queued_seconds: float
+    run_seconds: float
+    stats: Stats
+    # why the job failed, if it did
+    error: Optional[str]
+
+    def __init__(self, id: int, kind: str):
+        self.id = id
+        self.kind = kind
+        self.submitted = time.time()
+        self.queued_seconds = 0.0
+        self.run_seconds = 0.0
+        self.stats = Stats()
+        self.error = None
+
+    def server_timing(self) -> str:
+        """:return: the job's stage timings as a Server-Timing header, in milliseconds"""
+        timings = [('queue', self.queued_seconds)] + list(self.stats.stage_seconds.items()) + [('total', self.run_seconds)]
+        return ', '.join(f'{name};dur={seconds * 1000:.3f}' for name, seconds in timings)
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'submitted': self.submitted,
+            'queued_seconds': self.queued_seconds,
+            'run_seconds': self.run_seconds,
+            'error': self.error,
+            **self.stats.to_dict(),
+        }
+
+
+class JobQueue:
+    """
+    Lets at most max_running jobs run at a time. The rest wait for a slot, which is what the queue depth counts.
+    Jobs share the service's worker pool, so this bounds how many are interleaved in it at once.
+    """
+    max_running: int
+    queued: int
+    running: dict[int, Job]
+    # the most recently finished jobs, oldest first
+    finished: collections.deque[Job]
+    # number of jobs that have finished, and of those that failed
+    completed: int
+    failed: int
+
+    def __init__(self, max_running: int):
+        self.max_running = max_running
+        self.queued = 0
+        self.running = {}
+        self.finished = collections.deque(maxlen=JOB_HISTORY)
+        self.completed = 0
+        self.failed = 0
+        self._slots = threading.Semaphore(max_running)
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    @contextlib.contextmanager
+    def run(self, kind: str) -> Generator[Job, None, None]:
+        """Waits for a slot, then runs the body of the with block as a job of the given kind."""
+        with self._lock:
+            job = Job(self._next_id, kind)
+            self._next_id += 1
+            self.queued += 1
+        start = time.perf_counter()
+        self._slots.acquire()
+        job.queued_seconds = time.perf_counter() - start
+        with self._lock:
+            self.queued -= 1
+            self.running[job.id] = job
+
+        start = time.perf_counter()
+        try:
+            yield job
+        except BaseException as e:
+            job.error = str(e) or type(e).__name__
+            raise
+        finally:
+            job.run_seconds = time.perf_counter() - start
+            self._slots.release()
+            with self._lock:
+                del self.running[job.id]
+                self.finished.append(job)
+                if job.error is None:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'queued': self.queued,
+                'running': [job.to_dict() for job in self.running.values()],
+                'max_running': self.max_running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'recent': [job.to_dict() for job in self.finished],
+            }
+
+
+class StegService:
+    """
+    The jobs the server runs, with a pool of worker processes that is started and warmed up once.
+    Videos are spread across the whole pool, like with the --jobs flag of encode_file and decode_video, while ffmpeg
+    runs alongside in a process of its own. Single frames take a couple of milliseconds to encode or decode, less than
+    it takes to send a raw frame to a worker and back, so they're done right away in the server process instead.
+    """
+    workers: int
+    fuzziness: int
+    executor: ProcessPoolExecutor
+    jobs: JobQueue
+    cache: Optional[FrameCache]
+    # the directory video paths are relative to, which they can't lead out of
+    root: str
+    # the palettes jobs can use, by id
+    palettes: dict[int, Palette]
+
+    def __init__(self, workers: int = 0, max_jobs: int = 0, fuzziness: int = 17, cache: Optional[FrameCache] = None, root: Optional[str] = None, palettes: Iterable[Palette] = ()):
+        """
+        :param workers: number of worker processes, one per CPU by default
+        :param max_jobs: number of jobs to run at once, twice the number of workers by default
+        :param fuzziness: the fuzziness to build the palette lookup table for up front. Jobs can ask for others,
+                          whose tables are then built (or loaded from disk) by each worker the first time.
+        :param cache: if given, decoded frames are cached here, see FrameCache
+        :param root: the directory video paths are relative to, the current directory by default
+        :param palettes: palettes other than the default one to encode and decode with. They're registered once here
+                         and in each worker, rather than by the jobs themselves.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.fuzziness = fuzziness
+        self.cache = cache
+        self.root = os.path.realpath(root if root is not None else os.getcwd())
+        self.palettes = {DEFAULT_PALETTE.id: DEFAULT_PALETTE}
+        for palette in palettes:
+            register_palette(palette)
+            self.palettes[palette.id] = palette
+        self.jobs = JobQueue(max_jobs or self.workers * 2)
+        # the server's threads would be copied into forked workers mid-flight, so workers come from a fork server
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('forkserver'),
+                                            initializer=_warm_worker, initargs=(fuzziness, list(self.palettes.values())))
+
+    def warm(self):
+        """Starts every worker and waits until they've all built their lookup tables, so the first jobs don't have to."""
+        _warm_worker(self.fuzziness, list(self.palettes.values()))
+        # each task holds on to its worker for long enough that the next one has to start another
+        for future in [self.executor.submit(time.sleep, 0.1) for _ in range(self.workers)]:
+            future.result()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def status(self) -> dict:
+        return {'workers': self.workers, **self.jobs.status()}
+
+    def resolve_path(self, path: str) -> str:
+        """:return: the given video path within the root directory, after following any symlinks"""
+        full_path = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([full_path, self.root]) != self.root:
+            raise Exception(f"{path} is outside of {self.root}")
+        return full_path
+
+    def palette(self, palette_id: Optional[str]) -> Optional[Palette]:
+        """:return: the palette with the given id in hex, which has to be one the service was started with"""
+        if not palette_id:
+            return None
+        palette = self.palettes.get(int(palette_id, 16))
+        if palette is None:
+            raise Exception(f"palette {palette_id} wasn't loaded when the server started")
+        return palette
+
+    def encode_frame(self, data: bytes, job: Job, resolution: tuple[int, int] = (1280, 720), tile_width: Optional[int] = None, tile_height: Optional[int] = None, fec: int = 0, compression: Optional[str] = None, raw: bool = False, palette: Optional[Palette] = None) -> bytes:
+        """
+        :param raw: return the frame's raw RGB pixels (like ffmpeg's rgb24) instead of a PNG, which takes longer
+                    to encode than the frame takes to render
+        :return: a payload that fits in one frame, encoded as a PNG
+        """
+        image, stats = _encode_frame_job(data, resolution, tile_width, tile_height, fec, compression, raw, palette)
+        job.stats.merge(stats)
+        return image
+
+    def decode_frame(self, image: bytes, job: Job, fuzziness: Optional[int] = None, resolution: Optional[tuple[int, int]] = None) -> bytes:
+        """
+        :param image: an image file (PNG etc.) of the frame, or its raw RGB pixels if the resolution is given
+        :return: the payload of the frame
+        """
+        fuzziness = fuzziness if fuzziness is not None else self.fuzziness
+        body, stats = _decode_frame_job(image, fuzziness, self.cache, resolution)
+        job.stats.merge(stats)
+        return body
+
+    def encode_video(self, data: Iterable[bytes], data_length: int, output_path: str, job: Job, **kwargs) -> int:
+        """
+        Encodes the data into a video, with a FrameIndex sidecar next to it. See steg.steg.encode_video() for the parameters.
+        :return: the number of frames written
+        """
+        return encode_video(data, output_path, data_length=data_length, workers=self.workers, stats=job.stats,
+                            index_path=FrameIndex.sidecar_path(output_path), executor=self.executor, **kwargs)
+
+    def decode_video(self, video_path: str, job: Job, fuzziness: Optional[int] = None, byte_range: Optional[tuple[int, int]] = None) -> Generator[bytes, None, None]:
+        """Yields the data stored in a video as it's decoded, see steg.steg.decode_chunks()."""
+        fuzziness = fuzziness if fuzziness is not None else self.fuzziness
+        yield from decode_chunks(video_path, fuzziness=fuzziness, workers=self.workers, stats=job.stats, progress=None,
+                                 byte_range=byte_range, cache=self.cache, executor=self.executor)
+
+
+def _warm_worker(fuzziness: int, palettes: list[Palette]):
+    # loads (or builds and saves) the lookup tables, so they're ready before the first job needs them
+    for palette in palettes:
+        register_palette(palette)
+        palette.classifier(fuzziness)
+
+
+def _encode_frame_job(data: bytes, resolution: tuple[int, int], tile_width: Optional[int], tile_height: Optional[int], fec: int, compression: Optional[str], raw: bool, palette: Optional[Palette] = None) -> tuple[bytes, Stats]:
+    stats = Stats()
+    data, codec, data_length = compress_source(data, compression, len(data))
+    tile_width, tile_height = resolve_tile_size(data, resolution, tile_width, tile_height, data_length, fec, palette)
+    capacity = frame_capacity(resolution, tile_width, tile_height, fec, palette)
+    if data_length > capacity:
+        raise Exception(f"{data_length} bytes don't fit in one frame, which holds {capacity} with {tile_width}x{tile_height} tiles")
+
+    with stats.stage('render'):
+        pixels = _render_frame((0, data), resolution, tile_width, tile_height, codec, fec, palette)
+    stats.count('frames')
+    stats.count('bytes', data_length)
+    if raw:
+        return pixels.tobytes(), stats
+
+    with stats.stage('write'):
+        image = io.BytesIO()
+        # the palette compresses well enough even at the fastest level
+        Image.fromarray(pixels, mode='RGB').save(image, format='PNG', compress_level=1)
+    return image.getvalue(), stats
+
+
+def _decode_frame_job(image: bytes, fuzziness: int, cache: Optional[FrameCache], resolution: Optional[tuple[int, int]]) -> tuple[bytes, Stats]:
+    stats = Stats()
+    with stats.stage('read'):
+        if resolution is not None:
+            width, height = resolution
+            if len(image) != width * height * 3:
+                raise Exception(f"{width}x{height} RGB pixels take {width * height * 3} bytes, got {len(image)}")
+            pixels = np.frombuffer(image, dtype=np.uint8).reshape(height, width, 3)
+        else:
+            pixels = np.asarray(Image.open(io.BytesIO(image)).convert('RGB'))
+    with stats.stage('decode_header'):
+        frame = Frame.load_from_array(pixels, fuzziness=fuzziness, cache=cache)
+    body = _decode_body(frame, fuzziness=fuzziness, stats=stats)
+    if frame.codec:
+        with stats.stage('decompress'):
+            decompressor = get_codec(frame.codec).decompressor()
+            body = decompressor.decompress(body) + flush_decompressor(decompressor)
+    stats.count('frames')
+    stats.count('bytes', len(body))
+    return body, stats
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a client sending many small jobs only connects once
+    protocol_version = 'HTTP/1.1'
+    server: '_TCPServer | _UnixServer'
+    # request body bytes that haven't been read yet
+    _unread: int
+    # whether a streamed response has started, after which errors can't be reported
+    _streaming: bool
+
+    def do_GET(self):
+        if not self._allowed():
+            return
+        if urllib.parse.urlsplit(self.path).path == '/status':
+            self._send(200, json.dumps(self.server.service.status()).encode(), 'application/json')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        routes: dict[str, Callable[[dict[str, str]], None]] = {
+            '/encode/frame': self._encode_frame,
+            '/decode/frame': self._decode_frame,
+            '/encode': self._encode_video,
+            '/decode': self._decode_video,
+        }
+        if not self._allowed():
+            return
+        route = routes.get(url.path)
+        if route is None:
+            self.close_connection = True
+            self.send_error(404)
+            return
+
+        self._unread = int(self.headers.get('Content-Length', 0))
+        self._streaming = False
+        try:
+            route({name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()})
+        except Exception as e:
+            # the connection can only be reused if the next request is where it's expected to be
+            if self._unread:
+                self.close_connection = True
+            # once a stream has started there's no status code left to send, so the response is cut short instead
+            if self._streaming:
+                self.close_connection = True
+            else:
+                self._send(400, f"{e}\n".encode(), 'text/plain')
+
+    def _allowed(self) -> bool:
+        """:return: whether the request comes from this machine and has the token, if one is needed. If not, it's refused."""
+        allowed_hosts = LOCAL_HOSTS | self.server.allowed_hosts
+        host = urllib.parse.urlsplit('//' + self.headers.get('Host', '')).hostname
+        origin = self.headers.get('Origin')
+        if host not in allowed_hosts or (origin is not None and urllib.parse.urlsplit(origin).hostname not in allowed_hosts):
+            message = "requests have to come from this machine"
+        elif self.server.token is not None and not hmac.compare_digest(self.headers.get('X-Steg-Token', '').encode(), self.server.token.encode()):
+            message = "a valid X-Steg-Token header is required"
+        else:
+            return True
+        # the request body is never read, so the connection can't be reused
+        self.close_connection = True
+        self.send_error(403, message)
+        return False
+
+    def _encode_frame(self, params: dict[str, str]):
+        data = self._read_body()
+        raw = _raw_format(params)
+        options = _encode_options(params, self.server.service)
+        with self.server.service.jobs.run('encode_frame') as job:
+            image = self.server.service.encode_frame(data, job, raw=raw, **options)
+        self._send(200, image, 'application/octet-stream' if raw else 'image/png', job)
+
+    def _decode_frame(self, params: dict[str, str]):
+        image = self._read_body()
+        resolution = None
+        if _raw_format(params):
+            if not (params.get('width') and params.get('height')):
+                raise Exception("raw frames need their width and height")
+            resolution = (int(params['width']), int(params['height']))
+        with self.server.service.jobs.run('decode_frame') as job:
+            body = self.server.service.decode_frame(image, job, _int_param(params, 'fuzziness'), resolution)
+        self._send(200, body, 'application/octet-stream', job)
+
+    def _encode_video(self, params: dict[str, str]):
+        if 'output' not in params:
+            raise Exception("the output parameter is required")
+        output_path = self.server.service.resolve_path(params['output'])
+        options = _encode_options(params, self.server.service)
+        if 'framerate' in params:
+            options['framerate'] = int(params['framerate'])
+        data_length = self._content_length()
+        with self.server.service.jobs.run('encode') as job:
+            frames = self.server.service.encode_video(self._body_pieces(data_length), data_length, output_path, job, **options)
+        self._send(200, json.dumps({'frames': frames, **job.to_dict()}).encode(), 'application/json', job)
+
+    def _decode_video(self, params: dict[str, str]):
+        if 'input' not in params:
+            raise Exception("the input parameter is required")
+        input_path = self.server.service.resolve_path(params['input'])
+        byte_range = None
+        if params.get('range'):
+            start, end = params['range'].split(':')
+            byte_range = (int(start or 0), int(end) if end else math.inf)
+        self._read_body()
+
+        with self.server.service.jobs.run('decode') as job, \
+                contextlib.closing(self.server.service.decode_video(input_path, job, _int_param(params, 'fuzziness'), byte_range)) as chunks:
+            # the first frame is decoded before answering, so a video that can't be read still gets an error status
+            first = next(chunks, b'')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.send_header('X-Steg-Job', str(job.id))
+            self.end_headers()
+            self._streaming = True
+            for chunk in _prepend(first, chunks):
+                if chunk:
+                    self.wfile.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _content_length(self) -> int:
+        if 'Content-Length' not in self.headers:
+            raise Exception("a Content-Length is required")
+        return int(self.headers['Content-Length'])
+
+    def _read_body(self) -> bytes:
+        return b''.join(self._body_pieces(self._unread))
+
+    def _body_pieces(self, length: int) -> Generator[bytes, None, None]:
+        """Yields the request body as it arrives, so a large payload is never held in memory all at once."""
+        while length > 0:
+            piece = self.rfile.read(min(PIECE_SIZE, length))
+            if not piece:
+                raise Exception("the request body ended early")
+            length -= len(piece)
+            self._unread -= len(piece)
+            yield piece
+
+    def _send(self, status: int, body: bytes, content_type: str, job: Optional[Job] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        if job is not None:
+            self.send_header('X-Steg-Job', str(job.id))
+            self.send_header('Server-Timing', job.server_timing())
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def _encode_options(params: dict[str, str], service: StegService) -> dict:
+    tile_size = _int_param(params, 'tile_size')
+    return {
+        'resolution': (int(params.get('width', 1280)), int(params.get('height', 720))),
+        'tile_width': tile_size,
+        'tile_height': tile_size,
+        'fec': int(params.get('fec', 0)),
+        'compression': params.get('compression') or None,
+        'palette': service.palette(params.get('palette')),
+    }
+
+
+def _raw_format(params: dict[str, str]) -> bool:
+    """:return: whether single frames are sent as raw RGB pixels (format=raw) rather than as PNGs (format=png, the default)"""
+    image_format = params.get('format', 'png')
+    if image_format not in ('png', 'raw'):
+        raise Exception(f"unknown format {image_format!r}, expected png or raw")
+    return image_format == 'raw'
+
+
+def _int_param(params: dict[str, str], name: str) -> Optional[int]:
+    return int(params[name]) if params.get(name) else None
+
+
+def _prepend(first: bytes, rest: Iterable[bytes]) -> Generator[bytes, None, None]:
+    yield first
+    yield from rest
+
+
+class _TCPRequestHandler(_RequestHandler):
+    # responses are written in a few pieces, which Nagle's algorithm would hold back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+
+class _TCPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    service: StegService
+    quiet: bool
+    token: Optional[str]
+    # names other than LOCAL_HOSTS that requests can give in their Host and Origin headers
+    allowed_hosts: set[str]
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    service: StegService
+    quiet: bool
+    token: Optional[str]
+    allowed_hosts: set[str]
+
+
+def make_server(service: StegService, host: str = '127.0.0.1', port: int = 8375, unix_socket: Optional[str] = None, quiet: bool = False, token: Optional[str] = None) -> _TCPServer | _UnixServer:
+    """
+    :param host: the address to listen on. Requests can name it in their Host header as well as the local host names.
+    :param unix_socket: listen on a Unix socket at this path instead of on host and port. A stale socket file
+                        left at the path by a server that didn't shut down cleanly is replaced, but anything else
+                        there is an error.
+    :param quiet: don't log each request to stderr
+    :param token: if given, requests are refused unless they send it in a X-Steg-Token header
+    :return: a server for the service's jobs, started with serve_forever()
+    """
+    if unix_socket is not None:
+        _remove_stale_socket(unix_socket)
+        server = _UnixServer(unix_socket, _RequestHandler)
+    else:
+        server = _TCPServer((host, port), _TCPRequestHandler)
+    server.service = service
+    server.quiet = quiet
+    server.token = token
+    server.allowed_hosts = {host} if unix_socket is None and host not in ('', '0.0.0.0', '::') else set()
+    return server
+
+
+def _remove_stale_socket(path: str):
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise Exception(f"{path} already exists and isn't a socket, so it won't be replaced")
+    os.unlink(path)
@@ -0,0 +1,87 @@
+import collections
+import contextlib
+import json
+import sys
+import time
+from collections.abc import AsyncGenerator, AsyncIterable, Generator, Iterable
+from typing import Optional
+
+
+class Stats:
+    """
+    Wall time spent in each pipeline stage plus counters (frames, tiles, duplicates, etc.) collected while
+    encoding or decoding. Pass one to encode_video()/decode_chunks() and friends to have it filled in.
+
+    Work done in worker processes is timed there and merged in, so with more than one worker
+    the stage times are summed across processes and can add up to more than the elapsed time.
+    """
+    stage_seconds: dict[str, float]
+    counters: dict[str, int]
+    total_frames: Optional[int]
+
+    def __init__(self):
+        self.stage_seconds = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        self.total_frames = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] += time.perf_counter() - start
+
+    def timed(self, name: str, iterable: Iterable) -> Generator:
+        """Yields from the iterable, counting the time spent waiting for each item towards the given stage."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    async def timed_async(self, name: str, iterable: AsyncIterable) -> AsyncGenerator:
+        """Like timed(), for async iterables."""
+        iterator = aiter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = await anext(iterator)
+                except StopAsyncIteration:
+                    return
+            yield item
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def merge(self, other: 'Stats'):
+        for name, seconds in other.stage_seconds.items():
+            self.stage_seconds[name] += seconds
+        self.counters.update(other.counters)
+
+    def to_dict(self) -> dict:
+        return {
+            'stage_seconds': dict(self.stage_seconds),
+            'counters': dict(self.counters),
+            'total_frames': self.total_frames,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def __str__(self):
+        lines = [f"{name}: {seconds:.3f}s" for name, seconds in self.stage_seconds.items()]
+        lines += [f"{name}: {value}" for name, value in self.counters.items()]
+        return '\n'.join(lines)
+
+
+def print_progress(stats: Stats):
+    """Default progress hook, prints how many frames have been processed so far on a single line of stderr."""
+    frames = stats.counters['frames']
+    if stats.total_frames:
+        print(f"{frames}/{stats.total_frames} ({frames/stats.total_frames*100:.1f}%)", end="\r", file=sys.stderr)
+    else:
+        print(f"{frames} frames", end="\r", file=sys.stderr)
@@ -1,17 +1,44 @@
-import glob
+import contextlib
+import functools
+import itertools
 import math
 import os
 import pathlib
-import re
-import shutil
 import tempfile
+from collections.abc import Callable, Generator, Iterable
+from concurrent.futures import Executor, ProcessPoolExecutor
+from fractions import Fraction
+from typing import BinaryIO, Optional
 
 import ffmpeg  # type: ignore
+import numpy as np
+from PIL import Image
 
+from steg.cache import FrameCache
+from steg.codec import compress_source, flush_decompressor, get_codec
 from steg.frame import Frame
-from steg.util import factors, HEADER_LENGTH_BYTES
-
-VERSION = 1
+from steg.index import FrameIndex
+from steg.layout import Layout, body_capacity, plan_layout
+from steg.output import MappedOutput
+from steg.palette import Palette, register_palette
+from steg.stats import Stats, print_progress
+from steg.util import bounded_map, bounded_map_unordered, header_version, read_chunks, ByteSource
+
+# number of frames handed to a worker process at a time when decoding in parallel
+DECODE_BATCH_SIZE = 4
+
+# x264 settings shared by everything that produces a video. See images_to_video for notes on what has worked.
+VIDEO_OUTPUT_OPTIONS = {
+    'vcodec': 'libx264',
+    'video_bitrate': '600k',
+    # 'crf': 36,
+    'pix_fmt': 'yuv420p',
+    'color_primaries': 'bt709',
+    'color_trc': 'bt709',
+    'colorspace': 'bt709',
+    'vf': 'scale=in_range=full:in_color_matrix=bt709:out_range=tv:out_color_matrix=bt709',
+    'x264-params': 'keyint=1:scenecut=0',
+}
 
 
 """
@@ -23,141 +50,833 @@ ideas:
         - example: a command to skip the next n tiles (decorative tiles)
 - improve fuzzy matching
     - calculate the distance to all the colors in the palette, sort by distance, pick the lowest if it meets a certain threshold?
-* allow customizing the palette via a (256*3)-byte file. the first three bytes represent R, G, and B of the
-    color assigned to the value 0,
-* allow scrambling of the default palette in a 256-byte file. The first byte represents the 8-bit value assigned to the 
-    first color in the default palette, and so on.
-* allow scrambling of the default palette by way of a seed provided to a cryptographically secure RNG
 * add optional extras to header, i.e. make header variable length
 
 default palette 2025-04-06: [(0, 0, 42), (0, 0, 84), (0, 0, 126), (0, 0, 168), (0, 0, 210), (0, 0, 252), (0, 42, 0), (0, 42, 42), (0, 42, 84), (0, 42, 126), (0, 42, 168), (0, 42, 210), (0, 42, 252), (0, 84, 0), (0, 84, 42), (0, 84, 84), (0, 84, 126), (0, 84, 168), (0, 84, 210), (0, 84, 252), (0, 126, 0), (0, 126, 42), (0, 126, 84), (0, 126, 126), (0, 126, 168), (0, 126, 210), (0, 126, 252), (0, 168, 0), (0, 168, 42), (0, 168, 84), (0, 168, 126), (0, 168, 168), (0, 168, 210), (0, 168, 252), (0, 210, 0), (0, 210, 42), (0, 210, 84), (0, 210, 126), (0, 210, 168), (0, 210, 210), (0, 210, 252), (0, 252, 0), (0, 252, 42), (0, 252, 84), (0, 252, 126), (0, 252, 168), (0, 252, 210), (0, 252, 252), (42, 0, 0), (42, 0, 42), (42, 0, 84), (42, 0, 126), (42, 0, 168), (42, 0, 210), (42, 0, 252), (42, 42, 0), (42, 42, 42), (42, 42, 84), (42, 42, 126), (42, 42, 168), (42, 42, 210), (42, 42, 252), (42, 84, 0), (42, 84, 42), (42, 84, 84), (42, 84, 126), (42, 84, 168), (42, 84, 210), (42, 84, 252), (42, 126, 0), (42, 126, 42), (42, 126, 84), (42, 126, 126), (42, 126, 168), (42, 126, 210), (42, 126, 252), (42, 168, 0), (42, 168, 42), (42, 168, 84), (42, 168, 126), (42, 168, 168), (42, 168, 210), (42, 168, 252), (42, 210, 0), (42, 210, 42), (42, 210, 84), (42, 210, 126), (42, 210, 168), (42, 210, 210), (42, 210, 252), (42, 252, 0), (42, 252, 42), (42, 252, 84), (42, 252, 126), (42, 252, 168), (42, 252, 210), (42, 252, 252), (84, 0, 0), (84, 0, 42), (84, 0, 84), (84, 0, 126), (84, 0, 168), (84, 0, 210), (84, 0, 252), (84, 42, 0), (84, 42, 42), (84, 42, 84), (84, 42, 126), (84, 42, 168), (84, 42, 210), (84, 42, 252), (84, 84, 0), (84, 84, 42), (84, 84, 84), (84, 84, 126), (84, 84, 168), (84, 84, 210), (84, 84, 252), (84, 126, 0), (84, 126, 42), (84, 126, 84), (84, 126, 126), (84, 126, 168), (84, 126, 210), (84, 126, 252), (84, 168, 0), (84, 168, 42), (84, 168, 84), (84, 168, 126), (84, 168, 168), (84, 168, 210), (84, 168, 252), (84, 210, 0), (84, 210, 42), (84, 210, 84), (84, 210, 126), (84, 210, 168), (84, 210, 210), (84, 210, 252), (84, 252, 0), (84, 252, 42), (84, 252, 84), (84, 252, 126), (84, 252, 168), (84, 252, 210), (84, 252, 252), (126, 0, 0), (126, 0, 42), (126, 0, 84), (126, 0, 126), (126, 0, 168), (126, 0, 210), (126, 0, 252), (126, 42, 0), (126, 42, 42), (126, 42, 84), (126, 42, 126), (126, 42, 168), (126, 42, 210), (126, 42, 252), (126, 84, 0), (126, 84, 42), (126, 84, 84), (126, 84, 126), (126, 84, 168), (126, 84, 210), (126, 84, 252), (126, 126, 0), (126, 126, 42), (126, 126, 84), (126, 126, 126), (126, 126, 168), (126, 126, 210), (126, 126, 252), (126, 168, 0), (126, 168, 42), (126, 168, 84), (126, 168, 126), (126, 168, 168), (126, 168, 210), (126, 168, 252), (126, 210, 0), (126, 210, 42), (126, 210, 84), (126, 210, 126), (126, 210, 168), (126, 210, 210), (126, 210, 252), (126, 252, 0), (126, 252, 42), (126, 252, 84), (126, 252, 126), (126, 252, 168), (126, 252, 210), (126, 252, 252), (168, 0, 0), (168, 0, 42), (168, 0, 84), (168, 0, 126), (168, 0, 168), (168, 0, 210), (168, 0, 252), (168, 42, 0), (168, 42, 42), (168, 42, 84), (168, 42, 126), (168, 42, 168), (168, 42, 210), (168, 42, 252), (168, 84, 0), (168, 84, 42), (168, 84, 84), (168, 84, 126), (168, 84, 168), (168, 84, 210), (168, 84, 252), (168, 126, 0), (168, 126, 42), (168, 126, 84), (168, 126, 126), (168, 126, 168), (168, 126, 210), (168, 126, 252), (168, 168, 0), (168, 168, 42), (168, 168, 84), (168, 168, 126), (168, 168, 168), (168, 168, 210), (168, 168, 252), (168, 210, 0), (168, 210, 42), (168, 210, 84), (168, 210, 126), (168, 210, 168), (168, 210, 210), (168, 210, 252), (168, 252, 0), (168, 252, 42), (168, 252, 84), (168, 252, 126), (168, 252, 168), (168, 252, 210), (168, 252, 252), (210, 0, 0), (210, 0, 42), (210, 0, 84), (210, 0, 126), (210, 0, 168), (210, 0, 210), (210, 0, 252), (210, 42, 0), (210, 42, 42), (210, 42, 84), (210, 42, 126), (210, 42, 168), (210, 42, 210), (210, 42, 252), (210, 84, 0), (210, 84, 42), (210, 84, 84), (210, 84, 126), (210, 84, 168), (210, 84, 210), (210, 84, 252), (210, 126, 0), (210, 126, 42), (210, 126, 84), (210, 126, 126), (210, 126, 168), (210, 126, 210), (210, 126, 252), (210, 168, 0), (210, 168, 42), (210, 168, 84), (210, 168, 126), (210, 168, 168), (210, 168, 210), (210, 168, 252), (210, 210, 0), (210, 210, 42), (210, 210, 84), (210, 210, 126), (210, 210, 168), (210, 210, 210), (210, 210, 252), (210, 252, 0), (210, 252, 42), (210, 252, 84), (210, 252, 126), (210, 252, 168), (210, 252, 210), (210, 252, 252), (252, 0, 0), (252, 0, 42), (252, 0, 84), (252, 0, 126), (252, 0, 168), (252, 0, 210), (252, 0, 252), (252, 42, 0), (252, 42, 42), (252, 42, 84), (252, 42, 126), (252, 42, 168), (252, 42, 210), (252, 42, 252), (252, 84, 0), (252, 84, 42), (252, 84, 84), (252, 84, 126), (252, 84, 168), (252, 84, 210), (252, 84, 252), (252, 126, 0), (252, 126, 42), (252, 126, 84), (252, 126, 126), (252, 126, 168), (252, 126, 210), (252, 126, 252), (252, 168, 0), (252, 168, 42), (252, 168, 84), (252, 168, 126), (252, 168, 168), (252, 168, 210), (252, 168, 252), (252, 210, 0), (252, 210, 42), (252, 210, 84), (252, 210, 126), (252, 210, 168), (252, 210, 210), (252, 210, 252), (252, 252, 0), (252, 252, 42), (252, 252, 84), (252, 252, 126), (252, 252, 168), (252, 252, 210), (252, 252, 252)]
 """
 
-def determine_tile_size(data_length: int, resolution: tuple[int, int]) -> tuple[int, int]:
-    min_tile_width = 16
-    min_tile_height = 16
-    max_total_tiles_per_frame = (resolution[0] // min_tile_width) * (resolution[1] // min_tile_height)
-    max_body_tiles_per_frame = max_total_tiles_per_frame - HEADER_LENGTH_BYTES
+def determine_tile_size(data_length: int, resolution: tuple[int, int], fec: int = 0, palette: Optional[Palette] = None) -> tuple[int, int]:
+    """
+    :return: the tile size that fits the data in the fewest frames with the largest tiles, see plan_layout()
+    """
+    layout = plan_layout(data_length, resolution, fec=fec, custom_palette=_is_custom(palette))
+    return layout.tile_width, layout.tile_height
+
+
+def render_frames(data: ByteSource, resolution: tuple[int, int] = (1280, 720), tile_width: int = None, tile_height: int = None, workers: int = 1, data_length: Optional[int] = None, stats: Optional[Stats] = None, compression: Optional[str] = None, fec: int = 0, executor: Optional[Executor] = None, palette: Optional[Palette] = None) -> Generator[np.ndarray, None, None]:
+    """
+    Splits the data into frame-sized chunks and yields each rendered frame as an RGB array of shape (height, width, 3).
+    Streams and iterables are read one frame's worth at a time, so the whole input never has to be in memory.
+
+    The tile width/height are constrained to a minimum of 1 and a maximum that depends on the resolution given.
+    The full header (13 bytes, 14 with error correction, or 18 with a custom palette) and at least one data tile
+    must fit in each frame.
 
-    # if we can't fit all the data in a single frame,
-    # clamp the tile size to the minimum to fit as many as possible into each frame and minimize the number of frames
-    if data_length >= max_body_tiles_per_frame:
-        return min_tile_width, min_tile_height
+    :param data: the data to encode, or a binary stream or iterable of byte strings to read it from
+    :param resolution: the desired resolution of each frame
+    :param tile_width: the width in pixels of each byte tile
+    :param tile_height: the height in pixels of each byte tile
+    :param workers: number of processes to render frames with. Frames are still yielded in order,
+                    with at most two per worker rendered ahead of the consumer.
+    :param data_length: total length of a streamed input, if known. Only used to pick a tile size;
+                        inputs of unknown length use the smallest tiles.
+    :param stats: if given, the number of frames and bytes encoded are counted here
+    :param compression: name of a codec (see steg.codec) to compress the data with before it is split into frames.
+                        Data that already looks compressed is left as it is.
+    :param fec: number of Reed-Solomon parity tiles to add to every codeword of up to 255 tiles (see steg.fec),
+                or 0 for no error correction. A codeword can fix half that many wrong tiles, or that many tiles
+                that don't match the palette at all, so e.g. 32 costs 1/8 of each frame and fixes 1/16 of it.
+    :param executor: a pool of worker processes to render frames with instead of starting new ones,
+                     with workers saying how many frames to keep in flight
+    :param palette: the palette to draw the data in, the default one if not given. Frames drawn in any other palette
+                    name it in their header, and can only be decoded where it has been registered (see steg.palette),
+                    which this does for the current machine.
+    """
+    data, codec, data_length = compress_source(data, compression, data_length)
+    yield from _render_frames(data, codec, resolution, tile_width, tile_height, workers=workers, data_length=data_length, stats=stats, fec=fec, executor=executor, palette=palette)
 
-    # ...otherwise, if we can fit it all in one frame, try to maximize the size of each tile to ensure data integrity.
-    # make sure we take the header into account when determining the max size of the tiles
-    tiles_to_draw_per_frame = data_length + HEADER_LENGTH_BYTES
 
-    factorized = [x for x in factors(tiles_to_draw_per_frame)]
+def _render_frames(data: ByteSource, codec: int, resolution: tuple[int, int], tile_width: Optional[int], tile_height: Optional[int], workers: int = 1, data_length: Optional[int] = None, stats: Optional[Stats] = None, fec: int = 0, executor: Optional[Executor] = None, palette: Optional[Palette] = None) -> Generator[np.ndarray, None, None]:
+    stats = stats if stats is not None else Stats()
+    tile_width, tile_height = resolve_tile_size(data, resolution, tile_width, tile_height, data_length, fec, palette)
+    tiles_to_draw_per_frame = frame_capacity(resolution, tile_width, tile_height, fec, palette)
+    if palette is not None:
+        register_palette(palette)
 
-    if len(factorized) == 0:
-        # the number of tiles to draw ended up being a prime number, add one to make it not prime and try again
-        factorized = [x for x in factors(tiles_to_draw_per_frame + 1)]
+    # the final frame only carries whatever data is left over
+    chunks = enumerate(read_chunks(data, tiles_to_draw_per_frame))
+    chunks = _count_chunks(chunks, stats)
+    render = functools.partial(_render_frame, resolution=resolution, tile_width=tile_width, tile_height=tile_height, codec=codec, fec=fec, palette=palette)
 
-    factorized_list_middle_index = len(factorized) // 2 - 1
-    # TODO: find the pair of factors that most closely matches the aspect ratio of the image? right now it's just grabbing from the middle
-    small_axis_num_tiles, large_axis_num_tiles = factorized[
-                                                 factorized_list_middle_index:factorized_list_middle_index + 2]
-    max_tile_width = max(min_tile_width, resolution[0] // large_axis_num_tiles)
-    max_tile_height = max(min_tile_height, resolution[1] // small_axis_num_tiles)
-    tile_scale = max_tile_width if max_tile_width < max_tile_height else max_tile_height
-    # this function only returns square dimensions
-    return tile_scale, tile_scale
+    if workers > 1 or executor is not None:
+        with _worker_pool(workers, executor) as executor:
+            yield from bounded_map(executor, render, chunks, max_pending=workers * 2)
+    else:
+        yield from map(render, chunks)
 
 
-def encode(data: bytes, resolution: tuple[int, int] = (1280, 720), tile_width: int = None, tile_height: int = None, output_path: str = "./") -> list[str]:
+def resolve_tile_size(data: ByteSource, resolution: tuple[int, int], tile_width: Optional[int] = None, tile_height: Optional[int] = None, data_length: Optional[int] = None, fec: int = 0, palette: Optional[Palette] = None) -> tuple[int, int]:
     """
-    Encodes the given data into one or more images, writing them as files.
+    :return: the tile size that render_frames() will use for the given data, which is the one given if any
+    """
+    if tile_width and tile_height:
+        return tile_width, tile_height
 
-    The tile width/height are constrained to a minimum of 1 and a maximum that depends on the resolution given.
-    The full header (13 bytes) and at least one data tile must fit in each image.
+    if data_length is None and isinstance(data, (bytes, bytearray, memoryview)):
+        data_length = len(data)
+    # without a known length, assume the data won't fit in one frame, which means using the smallest tiles
+    return determine_tile_size(math.inf if data_length is None else data_length, resolution, fec, palette)
+
+
+def frame_capacity(resolution: tuple[int, int], tile_width: int, tile_height: int, fec: int = 0, palette: Optional[Palette] = None) -> int:
+    """
+    :return: the number of payload bytes that fit in one frame, after the header and any error correction
+    """
+    return body_capacity((resolution[0] // tile_width) * (resolution[1] // tile_height), fec, _is_custom(palette))
+
+
+def _is_custom(palette: Optional[Palette]) -> bool:
+    """whether frames drawn in the given palette need a header that names it"""
+    return palette is not None and not palette.is_default
+
+
+def estimate_encode(data_length: int, resolution: tuple[int, int] = (1280, 720), tile_width: int = None, tile_height: int = None, framerate: int = 20, fec: int = 0, palette: Optional[Palette] = None) -> dict:
+    """
+    Predicts what encode_video() would produce for a payload of the given length, without rendering anything.
+    The video size assumes the encoder hits the bitrate in VIDEO_OUTPUT_OPTIONS exactly, so treat it as approximate.
+    """
+    tile_width, tile_height = resolve_tile_size(b'', resolution, tile_width, tile_height, data_length, fec, palette)
+    layout = Layout.for_tile_size(resolution, tile_width, tile_height, data_length, fec, _is_custom(palette))
+    duration = layout.frames / framerate
+    return {
+        'tile_width': layout.tile_width,
+        'tile_height': layout.tile_height,
+        'columns': layout.columns,
+        'rows': layout.rows,
+        'bytes_per_frame': layout.capacity,
+        'frames': layout.frames,
+        'duration_seconds': duration,
+        'video_bytes': int(_parse_bitrate(VIDEO_OUTPUT_OPTIONS['video_bitrate']) * duration / 8),
+    }
+
+
+def _parse_bitrate(bitrate: str) -> int:
+    """converts an ffmpeg bitrate like '600k' to bits per second"""
+    multipliers = {'k': 1_000, 'M': 1_000_000}
+    if bitrate[-1] in multipliers:
+        return int(float(bitrate[:-1]) * multipliers[bitrate[-1]])
+    return int(bitrate)
+
+
+def _count_chunks(chunks: Iterable[tuple[int, bytes]], stats: Stats) -> Generator[tuple[int, bytes], None, None]:
+    for chunk in chunks:
+        stats.count('frames')
+        stats.count('bytes', len(chunk[1]))
+        yield chunk
+
+
+def _render_frame(chunk: tuple[int, bytes], resolution: tuple[int, int], tile_width: int, tile_height: int, codec: int = 0, fec: int = 0, palette: Optional[Palette] = None) -> np.ndarray:
+    frame_seqno, data = chunk
+    version = header_version(fec, _is_custom(palette))
+    return Frame(frame_seqno, len(data), resolution, tile_width, tile_height, palette=palette, version=version, codec=codec, fec=fec).render(data)
+
+
+def encode(data: ByteSource, resolution: tuple[int, int] = (1280, 720), tile_width: int = None, tile_height: int = None, output_path: str = "./", workers: int = 1, data_length: Optional[int] = None, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = None, compression: Optional[str] = None, fec: int = 0, palette: Optional[Palette] = None) -> list[str]:
+    """
+    Encodes the given data into one or more images, writing them as files.
 
-    :param data: the data to encode
+    :param data: the data to encode, or a binary stream or iterable of byte strings to read it from
     :param resolution: the desired resolution of each image
     :param tile_width: the width in pixels of each byte tile
     :param tile_height: the height in pixels of each byte tile
     :param output_path: the path to write encoded image files to
+    :param workers: number of processes to render frames with
+    :param data_length: total length of a streamed input, if known
+    :param stats: if given, stage timings and counters are collected here
+    :param progress: called with the stats after each frame is written
+    :param compression: name of a codec to compress the data with first, see render_frames()
+    :param fec: number of error correction parity tiles per codeword, see render_frames()
+    :param palette: the palette to draw the data in, see render_frames()
     :return: a list of relative paths to the encoded image files
     """
-    total_data_length = len(data)
-
-    if not tile_width or not tile_height:
-        tile_width, tile_height = determine_tile_size(total_data_length, resolution)
-
-    tiles_to_draw_per_frame = (resolution[0] // tile_width) * (resolution[1] // tile_height) - HEADER_LENGTH_BYTES
-    if tiles_to_draw_per_frame >= total_data_length:
-        tiles_to_draw_per_frame = total_data_length
-    expected_total_num_frames = math.ceil(total_data_length / tiles_to_draw_per_frame)
-
-    frame_seqno = 0
-    frame_num = 1
-    frame = Frame.new(frame_seqno, tiles_to_draw_per_frame, resolution, tile_width, tile_height)
+    stats = stats if stats is not None else Stats()
+    frames = render_frames(data, resolution, tile_width, tile_height, workers=workers, data_length=data_length, stats=stats, compression=compression, fec=fec, palette=palette)
 
     saved_frame_paths = []
-    for byte in data:
-        if frame.write(byte) == 0:
-            path = pathlib.Path(output_path, f'test_{frame_num:03d}.png')
-            frame.image.save(path)
-            frame.image.close()
-            saved_frame_paths.append(path)
-            frame_num += 1
-
-            frame_seqno = (frame_seqno + 1) % 256
-            if frame_num == expected_total_num_frames:
-                # calculate number of tiles that will be drawn on the final frame
-                tiles_to_draw_per_frame = total_data_length - (tiles_to_draw_per_frame * (expected_total_num_frames-1))
-            frame = Frame.new(frame_seqno, tiles_to_draw_per_frame, resolution, tile_width, tile_height)
-            frame.write(byte)
-
-    # make sure the last frame gets saved if it wasn't automatically
-    if not frame.is_full:
+    for frame_num, pixels in enumerate(stats.timed('render', frames), start=1):
         path = pathlib.Path(output_path, f'test_{frame_num:03d}.png')
-        frame.image.save(path)
-        frame.image.close()
+        with stats.stage('write'):
+            Image.fromarray(pixels, mode='RGB').save(path)
         saved_frame_paths.append(path)
 
+        if progress is not None:
+            progress(stats)
+
     return saved_frame_paths
 
 
-def decode(video_path: str, keep_images: bool = False, fuzziness:int = 17) -> bytes:
-    decode_temp_image_mask = 'decodetmp%03d.png'
-    decode_temp_image_glob = 'decodetmp*.png'
+def encode_video(data: ByteSource, output_path: str, resolution: tuple[int, int] = (1280, 720), tile_width: int = None, tile_height: int = None, framerate: int = 20, images_path: Optional[str] = None, workers: int = 1, data_length: Optional[int] = None, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = None, index_path: Optional[str] = None, compression: Optional[str] = None, fec: int = 0, executor: Optional[Executor] = None, palette: Optional[Palette] = None) -> int:
+    """
+    Encodes the given data straight into a video file.
+    Rendered frames are piped into ffmpeg as raw RGB, using the same encoder settings as images_to_video,
+    so no intermediate images are written unless requested.
 
-    tempdir = tempfile.mkdtemp()
-    video_to_images(video_path, os.path.join(tempdir, decode_temp_image_mask))
+    :param data: the data to encode, or a binary stream or iterable of byte strings to read it from
+    :param output_path: the video file to write
+    :param resolution: the desired resolution of the video
+    :param tile_width: the width in pixels of each byte tile
+    :param tile_height: the height in pixels of each byte tile
+    :param framerate: frames per second of the output video
+    :param images_path: if given, also save each frame as a PNG in this directory (named like encode() names them)
+    :param workers: number of processes to render frames with
+    :param data_length: total length of a streamed input, if known
+    :param stats: if given, stage timings and counters are collected here
+    :param progress: called with the stats after each frame is written
+    :param index_path: if given, write a FrameIndex here so byte ranges can later be decoded without reading
+                       the whole video. FrameIndex.sidecar_path(output_path) is where decode_chunks() looks for it.
+                       Its offsets are into the compressed data if compression is used.
+    :param compression: name of a codec to compress the data with first, see render_frames()
+    :param fec: number of error correction parity tiles per codeword, see render_frames()
+    :param executor: a pool of worker processes to render frames with, see render_frames()
+    :param palette: the palette to draw the data in, see render_frames()
+    :return: the number of frames written
+    """
+    stats = stats if stats is not None else Stats()
+    data, codec, data_length = compress_source(data, compression, data_length)
+    tile_width, tile_height = resolve_tile_size(data, resolution, tile_width, tile_height, data_length, fec, palette)
+    bytes_before = stats.counters['bytes']
+    process = (
+        ffmpeg
+        .input('pipe:', format='rawvideo', pix_fmt='rgb24', s=f'{resolution[0]}x{resolution[1]}', framerate=framerate)
+        .output(output_path, **VIDEO_OUTPUT_OPTIONS)
+        .overwrite_output()
+        .run_async(pipe_stdin=True)
+    )
+
+    frames = _render_frames(data, codec, resolution, tile_width, tile_height, workers=workers, data_length=data_length, stats=stats, fec=fec, executor=executor, palette=palette)
+
+    num_frames = 0
+    try:
+        for pixels in stats.timed('render', frames):
+            with stats.stage('write'):
+                process.stdin.write(pixels)
+            num_frames += 1
+
+            if images_path is not None:
+                with stats.stage('save_images'):
+                    Image.fromarray(pixels, mode='RGB').save(pathlib.Path(images_path, f'test_{num_frames:03d}.png'))
+
+            if progress is not None:
+                progress(stats)
+    finally:
+        with stats.stage('write'):
+            process.stdin.close()
+            process.wait()
+
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
 
-    frames = glob.glob(os.path.join(tempdir, decode_temp_image_glob))
-    frames = sorted(frames, key=lambda x: float(re.findall(r"(\d+)", x)[-1]))
+    if index_path is not None:
+        # every frame but the last is full
+        capacity = frame_capacity(resolution, tile_width, tile_height, fec, palette)
+        total_bytes = stats.counters['bytes'] - bytes_before
+        index = FrameIndex(framerate)
+        for video_frame in range(num_frames):
+            index.add_frame(min(capacity, total_bytes - video_frame * capacity), video_frame)
+        index.save(index_path)
+
+    return num_frames
+
+
+class FrameSequencer:
+    """
+    Decides which frames to keep while reassembling a video, based on their 1-byte sequence numbers (version 1 headers).
+    Repeated frames (e.g. from a higher output framerate) are skipped, as are frames that arrive out of order,
+    since a seqno that wraps every 256 frames can't say where they belong.
+    """
+    last_seqno: int
+    next_seqno_expected: int
+    stats: Stats
 
-    num_frames = len(frames)
-    frames_decoded = 0
-    result = b''
-    last_seqno = -1
-    next_seqno_expected = 0
-    for frame_path in frames:
-        frame_to_decode = Frame.load_from_file(frame_path)
-        frames_decoded += 1 # increment here in case this frame is a dupe
+    def __init__(self, stats: Optional[Stats] = None, first_seqno: int = 0):
+        self.last_seqno = -1
+        self.next_seqno_expected = first_seqno % 256
+        self.stats = stats if stats is not None else Stats()
 
-        if frame_to_decode.frame_seqno == last_seqno:
+    def accept(self, frame_seqno: int, frame_name: str) -> bool:
+        if frame_seqno == self.last_seqno:
             # duplicate, skip
-            continue
-        elif frame_to_decode.frame_seqno != next_seqno_expected:
+            self.stats.count('duplicate_frames')
+            return False
+        elif frame_seqno != self.next_seqno_expected:
             # out of order. this should probably abort
-            print(f"frame {frame_to_decode.frame_seqno} received out of order ({frame_path})")
-            continue
+            print(f"frame {frame_seqno} received out of order ({frame_name})")
+            self.stats.count('out_of_order_frames')
+            return False
+
+        self.last_seqno = frame_seqno
+        self.next_seqno_expected = (frame_seqno + 1) % 256
+        return True
+
+    def add(self, frame_seqno: int, item, frame_name: str) -> list:
+        """:return: the items that are ready to be used now, in order. This is the item itself if the frame is accepted."""
+        return [item] if self.accept(frame_seqno, frame_name) else []
+
+    def flush(self) -> list:
+        return []
+
+
+class IndexedFrameSequencer:
+    """
+    Reassembles frames that carry an absolute frame index (version 2 headers). Frames that arrive early are held until
+    the frames before them show up, so frames can be reordered rather than dropped, and any frame whose index was
+    already used is a duplicate, not just a repeat of the previous one.
+    """
+    next_index: int
+    pending: dict[int, object]
+    stats: Stats
+
+    # frames held while waiting for an earlier one. Past this, the earlier frames are taken to be lost rather than late,
+    # so one missing frame can't make reassembly hold the rest of the video in memory.
+    max_pending = 64
+
+    def __init__(self, stats: Optional[Stats] = None, first_index: int = 0):
+        self.next_index = first_index
+        self.pending = {}
+        self.stats = stats if stats is not None else Stats()
+
+    def add(self, frame_index: int, item, frame_name: str) -> list:
+        """:return: the items that are ready to be used now, in order"""
+        if frame_index < self.next_index or frame_index in self.pending:
+            self.stats.count('duplicate_frames')
+            return []
+        if frame_index > self.next_index:
+            self.stats.count('reordered_frames')
+
+        self.pending[frame_index] = item
+        if len(self.pending) > self.max_pending:
+            self.skip_gap()
+        return self.take_ready()
+
+    def flush(self) -> list:
+        """:return: frames still waiting on a frame that never arrived, in order"""
+        ready = []
+        while self.pending:
+            self.skip_gap()
+            ready += self.take_ready()
+        return ready
+
+    def take_ready(self) -> list:
+        ready = []
+        while self.next_index in self.pending:
+            ready.append(self.pending.pop(self.next_index))
+            self.next_index += 1
+        return ready
+
+    def skip_gap(self):
+        """Gives up on the frames before the earliest pending one."""
+        first_pending = min(self.pending)
+        print(f"frames {self.next_index} to {first_pending - 1} are missing, output will have a gap")
+        self.stats.count('missing_frames', first_pending - self.next_index)
+        self.next_index = first_pending
+
+
+def sequencer_for(version: int, stats: Optional[Stats] = None, first_seqno: int = 0) -> FrameSequencer | IndexedFrameSequencer:
+    """:return: the reassembly strategy for frames with the given header version"""
+    if version >= 2:
+        return IndexedFrameSequencer(stats, first_seqno)
+    return FrameSequencer(stats, first_seqno)
+
+
+def decode(video_path: str, **kwargs) -> bytes:
+    """
+    Decodes the data stored in a video and returns it all at once.
+    See decode_chunks() for the parameters, and decode_into() for decoding large videos without holding the result in memory.
+
+    :return: the decoded data
+    """
+    return b''.join(decode_chunks(video_path, **kwargs))
+
+
+def decode_into(video_path: str, sink: BinaryIO, **kwargs) -> int:
+    """
+    Decodes the data stored in a video, writing each frame's data to the sink as soon as it is decoded.
+    Memory use stays flat regardless of the length of the video.
+    See decode_chunks() for the remaining parameters.
+
+    :param sink: a writable binary file, pipe, socket file, etc.
+    :return: the number of bytes written
+    """
+    stats = kwargs.setdefault('stats', Stats())
+    bytes_written = 0
+    for chunk in decode_chunks(video_path, **kwargs):
+        with stats.stage('write'):
+            sink.write(chunk)
+        bytes_written += len(chunk)
+    return bytes_written
+
+
+def decode_to_file(video_path: str, output_path: str, fuzziness: int = 17, workers: int = 1, ignore_errors: bool = False, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = print_progress, cache: Optional[FrameCache] = None, decimate: bool = False) -> list[int]:
+    """
+    Decodes a video straight into a file, writing each frame's body at its offset in the payload as soon as it's
+    decoded (see MappedOutput). Frames that turn up out of order are put where they belong instead of being dropped,
+    and with several workers each batch of frames is written as soon as it's done, so nothing waits in memory
+    for the frames before it. If the video has a FrameIndex sidecar, its payload length is preallocated.
+
+    Frames are placed by the frame index in version 2+ headers, so version 1 videos can't be decoded this way,
+    and neither can compressed payloads, which only make sense decompressed in order. Use decode_into() for those.
+    See decode_chunks() for the remaining parameters.
+
+    :param output_path: the file to write, which is replaced if it exists
+    :return: the indexes of the frames that are missing from the output, which is otherwise complete
+    """
+    stats = stats if stats is not None else Stats()
+    with stats.stage('probe'):
+        stream = probe_video(video_path)
+    stats.total_frames = int(stream.get('nb_frames', 0)) or None
+
+    size_hint = 0
+    sidecar_path = FrameIndex.sidecar_path(video_path)
+    if os.path.exists(sidecar_path):
+        size_hint = FrameIndex.load(sidecar_path).total_bytes
+
+    frames = stats.timed('extract', video_frames(video_path, resolution=(stream['width'], stream['height']), decimate=decimate))
+    return _decode_frames_to_file(frames, output_path, fuzziness=fuzziness, workers=workers, ignore_errors=ignore_errors,
+                                  stats=stats, progress=progress, cache=cache, size_hint=size_hint)
+
+
+def _decode_frames_to_file(frames: Iterable[np.ndarray], output_path: str, fuzziness: int = 17, workers: int = 1, ignore_errors: bool = False, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = None, cache: Optional[FrameCache] = None, size_hint: int = 0) -> list[int]:
+    stats = stats if stats is not None else Stats()
+    frames = _drop_repeats(frames, fuzziness=fuzziness, stats=stats)
+    first = next(frames, None)
+    if first is None:
+        open(output_path, 'wb').close()
+        return []
+
+    # every frame of an encode has the same geometry, so the first one says where all the others go
+    with stats.stage('decode_header'):
+        first_frame = Frame.load_from_array(first, fuzziness=fuzziness)
+    if first_frame.version < 2:
+        raise Exception("version 1 headers only have a 1-byte seqno, which can't say where a frame goes in the payload")
+    if first_frame.codec:
+        raise Exception(f"payload is compressed with {get_codec(first_frame.codec).name}, so it can only be decoded in order")
+    capacity = frame_capacity((first_frame.width, first_frame.height), first_frame.tile_width, first_frame.tile_height, first_frame.fec, first_frame.palette)
+    frames = itertools.chain([first], frames)
+
+    with MappedOutput(output_path, capacity, size_hint) as output:
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                decode_batch = functools.partial(_decode_frame_batch, fuzziness=fuzziness, ignore_errors=ignore_errors, cache=cache)
+                batches = bounded_map_unordered(executor, decode_batch, itertools.batched(frames, DECODE_BATCH_SIZE), max_pending=workers * 2)
+                _write_frames(_merge_batches(batches, stats), output, stats, progress)
         else:
-            last_seqno = frame_to_decode.frame_seqno
-            next_seqno_expected = (last_seqno + 1) % 256
+            decoded = ((frame.version, frame.codec, frame.frame_seqno, _decode_body(frame, fuzziness=fuzziness, ignore_errors=ignore_errors, stats=stats))
+                       for frame in _load_frames(frames, fuzziness=fuzziness, stats=stats, cache=cache))
+            _write_frames(decoded, output, stats, progress)
+        missing = output.missing()
+
+    stats.count('missing_frames', len(missing))
+    return missing
+
+
+def _write_frames(frames: Iterable[tuple[int, int, int, bytes]], output: MappedOutput, stats: Stats, progress: Optional[Callable[[Stats], None]] = None):
+    for version, codec, frame_index, body in frames:
+        stats.count('frames')
+        if version < 2 or codec:
+            raise Exception(f"frame {frame_index} can't be placed by offset, its header doesn't match the first frame's")
+        with stats.stage('write'):
+            written = output.write(frame_index, body)
+        if not written:
+            stats.count('duplicate_frames')
+            continue
+        stats.count('decoded_frames')
+        stats.count('bytes', len(body))
+
+        if progress is not None:
+            progress(stats)
 
-        result += frame_to_decode.decode(fuzziness=fuzziness)
 
-        print(f"{frames_decoded}/{num_frames} ({frames_decoded/num_frames*100:.1f}%)", end="\r")
+def decode_chunks(video_path: str, keep_images: bool = False, fuzziness:int = 17, workers: int = 1, ignore_errors: bool = False, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = print_progress, byte_range: Optional[tuple[int, int]] = None, index: Optional[FrameIndex] = None, cache: Optional[FrameCache] = None, decimate: bool = False, executor: Optional[Executor] = None) -> Generator[bytes, None, None]:
+    """
+    Decodes the data stored in a video, yielding the data from each frame in order.
+    Frames are streamed from ffmpeg as raw RGB and decoded as they arrive.
+    Payloads that were compressed when encoding are decompressed as they go, according to the codec in the header.
+
+    :param video_path: the video to decode
+    :param keep_images: also save every frame as a PNG in a temporary directory, for debugging
+    :param fuzziness: how far each color channel may drift from the palette and still match
+    :param workers: number of processes to decode frames with. Frames are still reassembled in order.
+    :param ignore_errors: decode tiles that don't match the palette as 0 instead of raising an exception
+    :param stats: if given, stage timings and counters are collected here
+    :param progress: called with the stats after each frame, prints the number of frames decoded by default
+    :param byte_range: only decode payload bytes start (inclusive) through end (exclusive). ffmpeg seeks straight to
+                       the first frame needed and stops after the last one, so the rest of the video is never decoded.
+                       Compressed payloads can't be decoded by range.
+    :param index: the video's FrameIndex, used with byte_range. Loaded with load_index() if not given.
+    :param cache: if given, frames decoded before are read from this cache instead of being classified again
+    :param decimate: have ffmpeg drop repeated frames before they're even converted to RGB, see video_frames().
+                     Repeats are always dropped once their header has been read, so this only saves ffmpeg's share
+                     of the work, e.g. for a video whose frame rate was raised well above the one it was encoded at.
+    :param executor: a pool of worker processes to decode frames with instead of starting new ones,
+                     with workers saying how many batches of frames to keep in flight
+    """
+    stats = stats if stats is not None else Stats()
+    if byte_range is not None:
+        yield from _decode_range(video_path, byte_range, index, stats, keep_images=keep_images, fuzziness=fuzziness,
+                                 workers=workers, ignore_errors=ignore_errors, progress=progress, cache=cache, executor=executor)
+        return
+
+    with stats.stage('probe'):
+        stream = probe_video(video_path)
+    stats.total_frames = int(stream.get('nb_frames', 0)) or None
+
+    frames = stats.timed('extract', video_frames(video_path, resolution=(stream['width'], stream['height']), decimate=decimate))
+    yield from _decode_frames(frames, keep_images=keep_images, fuzziness=fuzziness, workers=workers,
+                              ignore_errors=ignore_errors, stats=stats, progress=progress, cache=cache, executor=executor)
+
+
+def _decode_range(video_path: str, byte_range: tuple[int, int], index: Optional[FrameIndex], stats: Stats, **kwargs) -> Generator[bytes, None, None]:
+    """Decodes only the frames holding the given byte range, trimming the first and last frames to fit it."""
+    start, end = byte_range
+    if index is None:
+        index = load_index(video_path, fuzziness=kwargs.get('fuzziness', 17), stats=stats)
+
+    end = min(end, index.total_bytes)
+    positions = index.positions_for_range(start, end)
+    if not positions:
+        return
+    offset, _, first_video_frame = index.frames[positions.start]
+    last_video_frame = index.frames[positions.stop - 1][2]
+    stats.total_frames = last_video_frame - first_video_frame + 1
+
+    frames = video_frames(video_path, start_time=index.timestamp(first_video_frame), num_frames=stats.total_frames)
+    frames = stats.timed('extract', frames)
+    # offsets in the index are into the payload as it was stored, so compressed payloads can't be sliced by them
+    for chunk in _decode_frames(frames, stats=stats, first_seqno=positions.start, decompress=False, **kwargs):
+        yield chunk[max(start - offset, 0):end - offset]
+        offset += len(chunk)
+        if offset >= end:
+            return
+
+
+def _decode_frames(frames: Iterable[np.ndarray], keep_images: bool = False, fuzziness: int = 17, workers: int = 1, ignore_errors: bool = False, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = None, first_seqno: int = 0, cache: Optional[FrameCache] = None, decompress: bool = True, executor: Optional[Executor] = None) -> Generator[bytes, None, None]:
+    stats = stats if stats is not None else Stats()
+    frames = _drop_repeats(frames, fuzziness=fuzziness, stats=stats)
+    if keep_images:
+        image_dir = tempfile.mkdtemp()
+        print(f"saving frames to {image_dir}")
+        frames = _save_frames(frames, image_dir, stats)
+
+    if workers > 1 or executor is not None:
+        with _worker_pool(workers, executor) as executor:
+            decode_batch = functools.partial(_decode_frame_batch, fuzziness=fuzziness, ignore_errors=ignore_errors, cache=cache)
+            batches = bounded_map(executor, decode_batch, itertools.batched(frames, DECODE_BATCH_SIZE), max_pending=workers * 2)
+            yield from _reassemble(_merge_batches(batches, stats), stats, progress, first_seqno, decompress)
+        return
+
+    frames = _load_frames(frames, fuzziness=fuzziness, stats=stats, cache=cache)
+    bodies = ((frame.version, frame.codec, frame.frame_seqno, functools.partial(_decode_body, frame, fuzziness=fuzziness, ignore_errors=ignore_errors, stats=stats))
+              for frame in frames)
+    yield from _reassemble(bodies, stats, progress, first_seqno, decompress)
+
+
+def _worker_pool(workers: int, executor: Optional[Executor] = None) -> contextlib.AbstractContextManager[Executor]:
+    """:return: the given executor, which is left running when the with block ends, or else a new pool of worker processes"""
+    return contextlib.nullcontext(executor) if executor is not None else ProcessPoolExecutor(workers)
+
+
+def _reassemble(frames: Iterable[tuple[int, int, int, bytes | Callable[[], bytes]]], stats: Stats, progress: Optional[Callable[[Stats], None]] = None, first_seqno: int = 0, decompress: bool = True) -> Generator[bytes, None, None]:
+    """
+    Yields frame bodies in sequence order, see Reassembler.
 
+    :param frames: (header version, codec, seqno, body) for each frame
+    """
+    reassembler = Reassembler(stats, progress, first_seqno, decompress)
+    for version, codec, frame_seqno, body in frames:
+        yield from reassembler.add(version, codec, frame_seqno, body)
+    yield from reassembler.finish()
 
-    if not keep_images:
-        shutil.rmtree(tempdir)
 
-    return result
+class Reassembler:
+    """
+    Puts decoded frames back in payload order and decompresses them, a frame at a time, so it can be fed
+    by a loop (see _reassemble()) or by frames as they finish decoding (see steg.aio).
+    Bodies can be passed as callables to only decode them once the frame is known to be needed.
+    The first frame's header decides how frames are put in order (see sequencer_for()) and how they are decompressed.
+    """
+    stats: Stats
+    progress: Optional[Callable[[Stats], None]]
+    first_seqno: int
+    # if False, compressed payloads raise an exception instead of being decompressed
+    decompress: bool
+
+    _sequencer: Optional[FrameSequencer | IndexedFrameSequencer] = None
+    _decompressor = None
+
+    def __init__(self, stats: Optional[Stats] = None, progress: Optional[Callable[[Stats], None]] = None, first_seqno: int = 0, decompress: bool = True):
+        self.stats = stats if stats is not None else Stats()
+        self.progress = progress
+        self.first_seqno = first_seqno
+        self.decompress = decompress
+
+    def add(self, version: int, codec: int, frame_seqno: int, body: bytes | Callable[[], bytes]) -> Generator[bytes, None, None]:
+        """:return: the payload data that this frame makes ready, which may include frames held back before it"""
+        self.stats.count('frames') # count here in case this frame is a dupe
+        if self._sequencer is None:
+            self._sequencer = sequencer_for(version, self.stats, self.first_seqno)
+            if codec:
+                if not self.decompress:
+                    raise Exception(f"payload is compressed with {get_codec(codec).name}, so it can only be decoded as a whole")
+                self._decompressor = get_codec(codec).decompressor()
+
+        for ready in self._sequencer.add(frame_seqno, body, f"frame {self.stats.counters['frames']}"):
+            yield from _emit_body(ready, self.stats, self.progress, self._decompressor)
+
+    def finish(self) -> Generator[bytes, None, None]:
+        """:return: whatever was still held back, once there are no more frames"""
+        if self._sequencer is not None:
+            for ready in self._sequencer.flush():
+                yield from _emit_body(ready, self.stats, self.progress, self._decompressor)
+
+        if self._decompressor is not None:
+            with self.stats.stage('decompress'):
+                remaining = flush_decompressor(self._decompressor)
+            if remaining:
+                yield remaining
+
+
+def _emit_body(body: bytes | Callable[[], bytes], stats: Stats, progress: Optional[Callable[[Stats], None]] = None, decompressor=None) -> Generator[bytes, None, None]:
+    body = body() if callable(body) else body
+    stats.count('decoded_frames')
+    stats.count('bytes', len(body))
+    if decompressor is not None:
+        with stats.stage('decompress'):
+            body = decompressor.decompress(body)
+        stats.count('decompressed_bytes', len(body))
+    if body:
+        yield body
+
+    if progress is not None:
+        progress(stats)
+
+
+def _decode_body(frame: Frame, fuzziness: int = 17, ignore_errors: bool = False, stats: Optional[Stats] = None) -> bytes:
+    stats = stats if stats is not None else Stats()
+    with stats.stage('classify'):
+        body, unmatched = frame.decode_with_mask(ignore_errors=ignore_errors, fuzziness=fuzziness)
+    stats.count('tiles', len(unmatched))
+    stats.count('unmatched_tiles', int(unmatched.sum()))
+    stats.count('corrected_tiles', frame.corrected_tiles)
+    if frame.from_cache:
+        stats.count('cached_frames')
+    return body
+
+
+def _decode_frame_batch(batch: tuple[np.ndarray, ...], fuzziness: int = 17, ignore_errors: bool = False, cache: Optional[FrameCache] = None) -> tuple[list[tuple[int, int, int, bytes]], Stats]:
+    """Decodes a batch of frames in a worker process, returning each frame's version, codec, seqno and body along with the worker's stats."""
+    stats = Stats()
+    decoded = [(frame.version, frame.codec, frame.frame_seqno, _decode_body(frame, fuzziness=fuzziness, ignore_errors=ignore_errors, stats=stats))
+               for frame in _load_frames(batch, fuzziness=fuzziness, stats=stats, cache=cache)]
+    return decoded, stats
+
+
+def _merge_batches(batches: Iterable[tuple[list[tuple[int, int, int, bytes]], Stats]], stats: Stats) -> Generator[tuple[int, int, int, bytes], None, None]:
+    for decoded, batch_stats in batches:
+        stats.merge(batch_stats)
+        yield from decoded
+
+
+def _load_frames(frames: Iterable[np.ndarray], fuzziness: int = 17, stats: Optional[Stats] = None, cache: Optional[FrameCache] = None) -> Generator[Frame, None, None]:
+    """
+    Loads a run of frames from the same video. The tile size found in one frame is used to read the next frame's header
+    directly, so the tile size only has to be searched for again if it stops matching.
+    """
+    stats = stats if stats is not None else Stats()
+    tile_size = None
+    for pixels in frames:
+        with stats.stage('decode_header'):
+            frame = Frame.load_from_array(pixels, fuzziness=fuzziness, tile_size=tile_size, cache=cache)
+        if tile_size is not None and tile_size != (frame.tile_width, frame.tile_height):
+            stats.count('geometry_changes')
+        tile_size = (frame.tile_width, frame.tile_height)
+        yield frame
+
+
+def _drop_repeats(frames: Iterable[np.ndarray], fuzziness: int = 17, stats: Optional[Stats] = None) -> Generator[np.ndarray, None, None]:
+    """
+    Drops frames that repeat the frame before them, like the copies a player or re-encode adds when it raises the
+    frame rate, before anything else is done with them. Only the header tiles are sampled and compared, at the tile
+    size of the frame before, so a 3 fps video played back at 30 fps costs about 3 frames' worth of classification
+    per second, and the frames that are kept have their headers read once, by whatever decodes them next.
+    Repeats that aren't next to each other are left to the sequencer.
+    """
+    repeats = RepeatFilter(fuzziness, stats)
+    for pixels in frames:
+        if not repeats.is_repeat(pixels):
+            yield pixels
+
+
+class RepeatFilter:
+    """Tells whether each frame in a run of frames repeats the one before it, see _drop_repeats()."""
+    fuzziness: int
+    stats: Stats
+
+    # the header tiles of the frame before, as classified
+    _previous: Optional[bytes] = None
+    _tile_size: Optional[tuple[int, int]] = None
+
+    def __init__(self, fuzziness: int = 17, stats: Optional[Stats] = None):
+        self.fuzziness = fuzziness
+        self.stats = stats if stats is not None else Stats()
+
+    def is_repeat(self, pixels: np.ndarray) -> bool:
+        with self.stats.stage('drop_repeats'):
+            header = self._header_tiles(pixels)
+        if header is None:
+            # not for this stage to decide, the frame is passed on to fail where it would have anyway
+            self._previous = None
+            return False
+
+        if header == self._previous:
+            # counted like the frames the sequencer skips
+            self.stats.count('frames')
+            self.stats.count('duplicate_frames')
+            return True
+        self._previous = header
+        return False
+
+    def _header_tiles(self, pixels: np.ndarray) -> Optional[bytes]:
+        """:return: the values of the frame's header tiles, or None if its header can't be found"""
+        if self._tile_size is not None:
+            header = Frame.read_header_tiles(pixels, self._tile_size, fuzziness=self.fuzziness)
+            if header is not None:
+                return header.tobytes()
+
+        # the tile size is only searched for on the first frame, and again if it stops matching
+        try:
+            frame = Frame.load_from_array(pixels, fuzziness=self.fuzziness)
+        except Exception:
+            return None
+        self._tile_size = (frame.tile_width, frame.tile_height)
+        header = Frame.read_header_tiles(pixels, self._tile_size, fuzziness=self.fuzziness)
+        return header.tobytes() if header is not None else None
+
+
+def _save_frames(frames: Iterable[np.ndarray], image_dir: str, stats: Stats) -> Generator[np.ndarray, None, None]:
+    for frame_num, pixels in enumerate(frames, start=1):
+        with stats.stage('save_images'):
+            Image.fromarray(pixels, mode='RGB').save(os.path.join(image_dir, f'decodetmp{frame_num:03d}.png'))
+        yield pixels
+
+
+def scan_index(video_path: str, fuzziness: int = 17, stats: Optional[Stats] = None) -> FrameIndex:
+    """
+    Builds a FrameIndex for a video that doesn't have one by reading every frame's header.
+    Frame bodies are never classified, so this is much quicker than a full decode.
+    """
+    stats = stats if stats is not None else Stats()
+    with stats.stage('probe'):
+        stream = probe_video(video_path)
+    index = FrameIndex(float(Fraction(stream['r_frame_rate'])))
+
+    sequencer = None
+    frames = stats.timed('extract', video_frames(video_path, resolution=(stream['width'], stream['height'])))
+    for video_frame, frame in enumerate(_load_frames(frames, fuzziness=fuzziness, stats=stats)):
+        if sequencer is None:
+            sequencer = sequencer_for(frame.version, stats)
+        for body_length, first_video_frame in sequencer.add(frame.frame_seqno, (frame.body_length, video_frame), f"frame {video_frame}"):
+            index.add_frame(body_length, first_video_frame)
+    if sequencer is not None:
+        for body_length, first_video_frame in sequencer.flush():
+            index.add_frame(body_length, first_video_frame)
+    return index
+
+
+def load_index(video_path: str, fuzziness: int = 17, stats: Optional[Stats] = None) -> FrameIndex:
+    """
+    :return: the index from the video's sidecar file. If there isn't one, the video is scanned and the sidecar written
+             so the next lookup is quick.
+    """
+    sidecar_path = FrameIndex.sidecar_path(video_path)
+    try:
+        return FrameIndex.load(sidecar_path)
+    except FileNotFoundError:
+        pass
+
+    index = scan_index(video_path, fuzziness=fuzziness, stats=stats)
+    # the sidecar is only an optimization, so a read-only directory is not an error
+    try:
+        index.save(sidecar_path)
+    except OSError:
+        pass
+    return index
+
+
+def probe_video(video_path: str) -> dict:
+    """
+    :return: ffprobe's description of the first video stream in the file
+    """
+    probe = ffmpeg.probe(video_path)
+    return next(stream for stream in probe['streams'] if stream['codec_type'] == 'video')
+
+
+def video_frames(video_path: str, resolution: Optional[tuple[int, int]] = None, start_time: Optional[float] = None, num_frames: Optional[int] = None, decimate: bool = False) -> Generator[np.ndarray, None, None]:
+    """
+    Yields each frame of the video as an RGB array of shape (height, width, 3).
+    ffmpeg writes raw frames to a pipe that is read one frame-sized chunk at a time,
+    so nothing is written to disk and frames can be decoded while ffmpeg is still running.
+
+    :param video_path: the video to read
+    :param resolution: the video's resolution, probed from the file if not given
+    :param start_time: seek to this many seconds into the video before reading
+    :param num_frames: stop after this many frames
+    :param decimate: drop frames that barely differ from the one before (ffmpeg's mpdecimate filter). Frames are then
+                     no longer one per video frame, so this is only for reading a whole payload. mpdecimate compares
+                     pixels, not headers, so a payload that repeats itself frame after frame could lose frames.
+    """
+    if resolution is None:
+        stream = probe_video(video_path)
+        resolution = (stream['width'], stream['height'])
+    width, height = resolution
+    frame_size = width * height * 3
+
+    process = _raw_frames_output(video_path, start_time, num_frames, decimate).run_async(pipe_stdout=True)
+    try:
+        while True:
+            buffer = process.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+            yield np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+        process.stdout.close()
+        process.wait()
+
+    # only reached once ffmpeg's output has run out, not when the frames stopped being read early
+    _check_frames_output(video_path, process.returncode, len(buffer))
+
+
+def _check_frames_output(video_path: str, returncode: int, trailing_bytes: int):
+    """Raises if ffmpeg failed, or stopped partway through a frame, so a broken video isn't taken for a short one."""
+    if returncode != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
+    if trailing_bytes:
+        raise Exception(f"{video_path} ended {trailing_bytes} bytes into a frame, is it truncated or is the resolution wrong?")
+
+
+def _raw_frames_output(video_path: str, start_time: Optional[float] = None, num_frames: Optional[int] = None, decimate: bool = False):
+    """:return: the ffmpeg command that video_frames() runs, for piping raw RGB frames to stdout"""
+    input_options = {'ss': start_time} if start_time else {}
+    output_options = {'vframes': num_frames} if num_frames is not None else {}
+    stream = ffmpeg.input(video_path, **input_options)
+    if decimate:
+        stream = stream.filter('mpdecimate')
+        # otherwise ffmpeg fills the gaps back in with copies to keep the frame rate constant
+        output_options['vsync'] = 'passthrough'
+    return (
+        stream
+        .output('pipe:', format='rawvideo', pix_fmt='rgb24', **output_options)
+        .global_args('-loglevel', 'error')
+    )
 
 
 def video_to_images(video_path: str, output_path: str):
@@ -189,16 +908,6 @@ def images_to_video(image_file_names_wildcard: str, output_path: str, framerate:
     (
         ffmpeg
         .input(image_file_names_wildcard, framerate=framerate)
-        .output(output_path,
-                vcodec='libx264',
-                video_bitrate='600k',
-                # crf=36,
-                pix_fmt='yuv420p',
-                color_primaries='bt709',
-                color_trc='bt709',
-                colorspace='bt709',
-                vf='scale=in_range=full:in_color_matrix=bt709:out_range=tv:out_color_matrix=bt709',
-                **{'x264-params': 'keyint=1:scenecut=0'},
-            )
+        .output(output_path, **VIDEO_OUTPUT_OPTIONS)
         .run()
     )
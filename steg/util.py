@@ -1,9 +1,39 @@
-from collections.abc import Generator
+import collections
+import concurrent.futures
+import functools
+import os
+import pathlib
+from collections.abc import Callable, Generator, Iterable
+from concurrent.futures import Executor
+from typing import BinaryIO
 
 
 HEADER_LENGTH_BYTES = 13
 
 
+VERSION = 2
+# header version for frames with error correction, see Frame.generate_header_bytes()
+FEC_VERSION = 3
+# header version for frames whose body is drawn in a palette other than the default one, see steg.palette
+PALETTE_VERSION = 4
+
+
+def header_length(version: int) -> int:
+    """:return: the number of tiles a frame header of the given version takes, see Frame.generate_header_bytes()"""
+    # version 3 adds the error correction byte, and version 4 the palette id after it
+    return HEADER_LENGTH_BYTES + (1 if version >= 3 else 0) + (4 if version >= 4 else 0)
+
+
+def header_version(fec: int = 0, custom_palette: bool = False) -> int:
+    """:return: the header version encoders write for frames with the given error correction and palette"""
+    if custom_palette:
+        return PALETTE_VERSION
+    return FEC_VERSION if fec else VERSION
+
+# anything data can be read from when encoding: the data itself, a readable binary stream, or an iterable of byte strings
+ByteSource = bytes | bytearray | memoryview | BinaryIO | Iterable[bytes]
+
+
 def generate_default_palette() -> list[tuple[int, int, int]]:
     """generate a list of available colors as tuples in the form: (r, g, b)"""
     # limit RGB values to 16-240 instead of 0-255 to help preserve color
@@ -302,3 +332,66 @@ def list_fuzzy_search(haystack: list[tuple[int, int, int]], needle: tuple[int, i
             return ii
 
     raise Exception(f"image was too messed up, couldn't find value for color {needle}")
+
+
+def cache_dir() -> pathlib.Path:
+    """directory used for on-disk caches, overridable with the STEG_CACHE_DIR environment variable"""
+    if os.environ.get('STEG_CACHE_DIR'):
+        return pathlib.Path(os.environ['STEG_CACHE_DIR'])
+    return pathlib.Path(os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache', 'steg')
+
+
+def bounded_map(executor: Executor, fn: Callable, iterable: Iterable, max_pending: int) -> Generator:
+    """
+    Like executor.map(), but consumes the input lazily and keeps at most max_pending calls in flight,
+    so memory stays bounded no matter how long the input is. Results are yielded in input order.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def bounded_map_unordered(executor: Executor, fn: Callable, iterable: Iterable, max_pending: int) -> Generator:
+    """
+    Like bounded_map(), but yields results as soon as they're ready, in whatever order the calls finish.
+    """
+    pending = set()
+    for item in iterable:
+        pending.add(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    for future in concurrent.futures.as_completed(pending):
+        yield future.result()
+
+
+def read_chunks(source: ByteSource, chunk_size: int) -> Generator[bytes, None, None]:
+    """
+    Splits the source into chunks of exactly chunk_size bytes, except for the last one, which may be shorter.
+    Streams and iterables are consumed as the chunks are requested, so only about one chunk is held in memory at a time.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        for offset in range(0, len(source), chunk_size):
+            yield bytes(source[offset:offset + chunk_size])
+        return
+
+    if hasattr(source, 'read'):
+        # pipes and sockets can return fewer bytes than requested, which the buffering below takes care of
+        source = iter(functools.partial(source.read, chunk_size), b'')
+
+    buffer = bytearray()
+    for piece in source:
+        buffer += piece
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+
+    if buffer:
+        yield bytes(buffer)
@@ -4,6 +4,13 @@ import os
 import pytest
 
 
+@pytest.fixture(autouse=True, scope='session')
+def cache_dir(tmp_path_factory):
+    # keep lookup tables and other caches out of the real user cache directory
+    os.environ['STEG_CACHE_DIR'] = str(tmp_path_factory.mktemp('cache'))
+    yield os.environ['STEG_CACHE_DIR']
+
+
 @pytest.fixture(autouse=True)
 def cleanup():
     yield
@@ -1,10 +1,32 @@
+import asyncio
 import glob
-import time
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import threading
 
+import ffmpeg
+import numpy as np
 import pytest
+from PIL import Image
 
+from steg import fec as steg_fec
+from steg.aio import _decode_frames_async, video_frames_async
+from steg.archive import Manifest, archive_name, encode_archive, extract, pack
+from steg.cache import FrameCache
+from steg.classifier import PaletteClassifier, NO_MATCH
 from steg.frame import Frame
-from steg.steg import images_to_video, video_to_images, encode
+from steg.index import FrameIndex
+from steg.layout import plan_layout
+from steg.palette import DEFAULT_PALETTE, Palette, register_palette
+from steg.search import search_images, search_video
+from steg.server import StegService, make_server
+from steg.stats import Stats
+from steg.steg import images_to_video, video_to_images, video_frames, render_frames, encode, encode_video, decode, decode_chunks, decode_into, scan_index, estimate_encode, frame_capacity, _reassemble, _decode_frames, _decode_frames_to_file
+from steg.util import generate_default_palette, list_fuzzy_search
 
 
 def test_smoke():
@@ -65,31 +87,12 @@ def test_lorem_ipsum():
     assert total_bytes_decoded == len(data_to_encode)
 
 
-@pytest.mark.skip
+@pytest.mark.skip(reason="slow, use `uv run bench` to measure throughput")
 def test_4mb():
-    start = time.time()
-    print(f"{start=}")
-
-    # encode
-    with open('tests/orig_4MB.jpg', 'rb') as f:
-        data = f.read()
-    encode(data, tile_width=48, tile_height=48)
-
-    # convert to video
-    images_to_video('tests/test_%03d.png', 'tests/test.mp4', framerate=20)
-
-    encode_finished_time = time.time()
-    print(f"{encode_finished_time=} -- elapsed: {encode_finished_time - start}s")
+    data = random.Random(0).randbytes(4 * 1024 * 1024)
 
-    # decode
-    video_to_images('test.mp4', 'test_videoout%03d.png')
-
-    with open('test_decode.jpg', 'wb') as f:
-        for ii in range(1, 10583):
-            frame_to_decode = Frame.load_from_file(f'test_videoout{ii:03d}.png')
-            f.write(frame_to_decode.decode())
-    decode_finished_time = time.time()
-    print(f"{decode_finished_time=} -- elapsed: {decode_finished_time - encode_finished_time}s")
+    encode_video(data, 'tests/test.mp4', tile_width=48, tile_height=48)
+    assert decode('tests/test.mp4') == data
 
 
 @pytest.mark.skip
@@ -101,3 +104,705 @@ def test_youtube():
             print(f"file {ii}:")
             frame_to_decode = Frame.load_from_file(f'test_videoout{ii:03d}.png')
             f.write(frame_to_decode.decode(ignore_errors=True))
+
+
+def test_render_matches_draw():
+    data = bytes(range(256)) * 20
+    for tile_size in (16, 17, 48):
+        capacity = (1280 // tile_size) * (720 // tile_size) - Frame.header_length_bytes
+        chunk = data[:capacity]
+
+        drawn = Frame.new(7, len(chunk), (1280, 720), tile_size, tile_size)
+        drawn.write(chunk)
+        rendered = Frame.from_bytes(7, chunk, (1280, 720), tile_size, tile_size)
+
+        assert np.array_equal(np.asarray(drawn.image), np.asarray(rendered.image))
+
+    # a partially filled frame leaves the remaining tiles black
+    drawn = Frame.new(0, 5, (1280, 720), 16, 16)
+    drawn.write(b'hello')
+    rendered = Frame.from_bytes(0, b'hello', (1280, 720), 16, 16)
+    assert np.array_equal(np.asarray(drawn.image), np.asarray(rendered.image))
+
+    # so does a version 4 header, which names the palette the body is drawn in
+    palette = Palette.scrambled('render')
+    drawn = Frame.new(3, 5, (1280, 720), 16, 16, version=4, palette=palette)
+    drawn.write(b'hello')
+    rendered = Frame.from_bytes(3, b'hello', (1280, 720), 16, 16, version=4, palette=palette)
+    assert np.array_equal(np.asarray(drawn.image), np.asarray(rendered.image))
+    # error correction needs the whole body before anything is drawn
+    with pytest.raises(Exception):
+        Frame.new(0, 5, (1280, 720), 16, 16, version=3)
+
+
+def test_classifier_matches_fuzzy_search():
+    palette = generate_default_palette()
+    classifier = PaletteClassifier(palette, fuzziness=17)
+
+    rng = np.random.default_rng(0)
+    colors = [tuple(int(v) for v in color) for color in rng.integers(0, 256, (2000, 3))]
+    colors += [(r + 5, g - 9, b + 17) for r, g, b in palette if g >= 9 and max(r, b) <= 238]
+    colors += [(0, 0, 0), (17, 17, 17), (18, 17, 17), (239, 239, 239), (255, 255, 255)]
+
+    for color in colors:
+        try:
+            expected = list_fuzzy_search(palette, color, fuzziness=17)
+        except Exception:
+            expected = NO_MATCH
+        assert classifier.classify(np.array(color)) == expected
+
+    # the table is cached on disk and reused
+    assert os.path.exists(classifier.cache_path)
+    assert np.array_equal(PaletteClassifier(palette, fuzziness=17).table, classifier.table)
+
+
+def test_decode_with_mask():
+    data = bytes(range(256)) * 4
+    frame = Frame.from_bytes(0, data, (1280, 720), 16, 16)
+    # paint over the 5th body tile (the 18th tile overall) with a color that isn't in the palette
+    pixels = np.array(frame.image)
+    pixels[0:16, 17 * 16:18 * 16] = (107, 107, 107)
+
+    decoded_frame = Frame.load_from_file(io.BytesIO(_png_bytes(pixels)))
+    with pytest.raises(Exception):
+        decoded_frame.decode()
+
+    decoded, unmatched = decoded_frame.decode_with_mask(ignore_errors=True)
+    assert np.flatnonzero(unmatched).tolist() == [4]
+    assert decoded == data[:4] + b'\x00' + data[5:]
+
+
+def _png_bytes(pixels: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, mode='RGB').save(buffer, format='png')
+    return buffer.getvalue()
+
+
+def test_decode_video():
+    data_to_encode = b"Hi Mell, I love you!"
+    encode(data_to_encode, tile_width=160, tile_height=160, output_path='tests')
+    images_to_video('tests/test_%03d.png', 'tests/test.mp4', framerate=20)
+
+    assert decode('tests/test.mp4') == data_to_encode
+
+    # streamed frames match the frames ffmpeg writes out as images
+    video_to_images('tests/test.mp4', 'tests/test_videoout%03d.png')
+    for ii, pixels in enumerate(video_frames('tests/test.mp4'), start=1):
+        assert np.array_equal(pixels, np.asarray(Image.open(f'tests/test_videoout{ii:03d}.png')))
+
+
+def test_encode_video():
+    with open('tests/test_data/loremipsum.txt', 'rb') as f:
+        data_to_encode = f.read()
+
+    # piping frames into ffmpeg produces the same video as going through images
+    assert encode_video(data_to_encode * 3, 'tests/test.mp4', images_path='tests') == 2
+    images_to_video('tests/test_%03d.png', 'tests/test_images.mp4', framerate=20)
+
+    for piped, from_images in zip(video_frames('tests/test.mp4'), video_frames('tests/test_images.mp4'), strict=True):
+        assert np.array_equal(piped, from_images)
+
+
+def test_video_frames_errors(tmp_path):
+    video_path = str(tmp_path / 'out.mp4')
+    encode_video(os.urandom(10000), video_path)
+    assert len(list(video_frames(video_path))) == 3
+
+    # the wrong resolution leaves part of a frame at the end
+    with pytest.raises(Exception, match='into a frame'):
+        list(video_frames(video_path, (1280, 700)))
+
+    # ffmpeg can't read a truncated mp4, which used to look like an empty video
+    truncated_path = str(tmp_path / 'truncated.mp4')
+    with open(video_path, 'rb') as f, open(truncated_path, 'wb') as out:
+        out.write(f.read()[:2000])
+    with pytest.raises(ffmpeg.Error):
+        list(video_frames(truncated_path, (1280, 720)))
+    with pytest.raises(ffmpeg.Error):
+        asyncio.run(_collect(video_frames_async(truncated_path, (1280, 720))))
+
+    # stopping early isn't an error
+    frames = video_frames(video_path)
+    next(frames)
+    frames.close()
+
+
+async def _collect(frames):
+    return [frame async for frame in frames]
+
+
+def test_decode_video_parallel():
+    data_to_encode = bytes(range(256)) * 12
+    encode_video(data_to_encode, 'tests/test.mp4', tile_width=32, tile_height=32)
+
+    assert decode('tests/test.mp4', workers=2) == decode('tests/test.mp4') == data_to_encode
+
+
+def test_render_frames_parallel():
+    data = os.urandom(10000)
+    serial = list(render_frames(data, tile_width=16, tile_height=16))
+    parallel = list(render_frames(data, tile_width=16, tile_height=16, workers=2))
+
+    assert len(serial) == len(parallel) == 3
+    for serial_frame, parallel_frame in zip(serial, parallel):
+        assert np.array_equal(serial_frame, parallel_frame)
+
+
+def test_decode_into():
+    data_to_encode = bytes(range(256)) * 12
+    encode_video(data_to_encode, 'tests/test.mp4', tile_width=32, tile_height=32)
+
+    sink = io.BytesIO()
+    assert decode_into('tests/test.mp4', sink) == len(data_to_encode)
+    assert sink.getvalue() == data_to_encode
+    assert list(decode_chunks('tests/test.mp4')) == [data_to_encode[:867], data_to_encode[867:1734], data_to_encode[1734:2601], data_to_encode[2601:]]
+
+
+def test_encode_stream():
+    data = os.urandom(10000)
+    expected = list(render_frames(data, tile_width=16, tile_height=16))
+
+    # streams and iterables of arbitrarily sized pieces produce the same frames as the data itself
+    from_stream = list(render_frames(io.BytesIO(data), tile_width=16, tile_height=16))
+    from_iterable = list(render_frames((data[ii:ii + 1000] for ii in range(0, len(data), 1000)), tile_width=16, tile_height=16))
+
+    assert len(expected) == len(from_stream) == len(from_iterable) == 3
+    for frames in zip(expected, from_stream, from_iterable):
+        assert np.array_equal(frames[0], frames[1])
+        assert np.array_equal(frames[0], frames[2])
+
+
+def test_decode_known_header():
+    pixels = next(render_frames(bytes(range(256)), tile_width=48, tile_height=48))
+    searched = Frame.load_from_array(pixels)
+
+    for tile_size in ((48, 48), (16, 16), None):
+        frame = Frame.load_from_array(pixels, tile_size=tile_size)
+        assert (frame.tile_width, frame.tile_height, frame.frame_seqno, frame.body_length, frame.x, frame.y) == \
+               (searched.tile_width, searched.tile_height, searched.frame_seqno, searched.body_length, searched.x, searched.y)
+        assert frame.decode() == bytes(range(256))
+
+    assert searched.decode_known_header((48, 48))
+    assert not searched.decode_known_header((16, 16))
+
+
+def test_stats():
+    data_to_encode = bytes(range(256)) * 12
+    encode_stats = Stats()
+    encode_video(data_to_encode, 'tests/test.mp4', tile_width=32, tile_height=32, stats=encode_stats)
+    assert encode_stats.counters['frames'] == 4
+    assert encode_stats.counters['bytes'] == len(data_to_encode)
+    assert {'render', 'write'} <= encode_stats.stage_seconds.keys()
+
+    for workers in (1, 2):
+        progress = []
+        decode_stats = Stats()
+        decode('tests/test.mp4', workers=workers, stats=decode_stats, progress=lambda stats: progress.append(stats.counters['decoded_frames']))
+        assert progress == [1, 2, 3, 4]
+        assert decode_stats.counters['tiles'] == decode_stats.counters['bytes'] == len(data_to_encode)
+        assert decode_stats.counters['unmatched_tiles'] == 0
+        assert {'extract', 'decode_header', 'classify'} <= decode_stats.stage_seconds.keys()
+        assert json.loads(decode_stats.to_json())['counters']['frames'] == 4
+
+
+def test_decode_byte_range():
+    data = bytes(range(256)) * 12
+    video_path = 'tests/test_range.mp4'
+    index_path = FrameIndex.sidecar_path(video_path)
+    encode_video(data, video_path, tile_width=32, tile_height=32, index_path=index_path)
+
+    index = FrameIndex.load(index_path)
+    assert len(index) == 4
+    assert index.frames == scan_index(video_path).frames
+
+    for start, end in [(900, 2000), (0, 10), (2600, len(data)), (3000, 5000)]:
+        assert decode(video_path, byte_range=(start, end)) == data[start:end]
+
+    # without a sidecar, the index is built by scanning the video
+    os.remove(index_path)
+    assert decode(video_path, byte_range=(900, 2000)) == data[900:2000]
+    assert os.path.exists(index_path)
+    os.remove(index_path)
+
+
+def test_search_across_frames():
+    data = bytes(range(256)) * 12
+    encode(data, tile_width=32, tile_height=32, output_path='tests')
+    # each frame holds 867 bytes, so this needle starts in the first frame and ends in the second
+    needle = data[860:880]
+    expected = [(offset, offset // 867) for offset in range(len(data)) if data.startswith(needle, offset)]
+
+    matches = list(search_images('tests', needle, workers=2))
+    assert [(match.offset, match.frame) for match in matches] == expected
+    assert matches[0].source.endswith('test_001.png')
+
+    encode_video(data, 'tests/test_search.mp4', tile_width=32, tile_height=32)
+    for workers in (1, 2):
+        matches = list(search_video('tests/test_search.mp4', needle, workers=workers))
+        assert [(match.offset, match.frame) for match in matches] == expected
+        # labelled by the frame index in the header
+        assert [match.source for match in matches] == [f'tests/test_search.mp4 frame {frame}' for _, frame in expected]
+
+    # compressed payloads decompress to more bytes than their frames hold, but matches still name the right frame
+    text = os.urandom(2000) + data * 20 + os.urandom(2000)
+    encode_video(text, 'tests/test_search.mp4', tile_width=32, tile_height=32, compression='zlib')
+    matches = list(search_video('tests/test_search.mp4', needle))
+    assert [match.offset for match in matches] == [offset for offset in range(len(text)) if text.startswith(needle, offset)]
+    assert all(match.source == f'tests/test_search.mp4 frame {match.frame}' for match in matches)
+
+
+def test_search_video_gap(tmp_path):
+    data = os.urandom(3000)
+    frames = list(render_frames(data, tile_width=32, tile_height=32))
+    # the second frame is lost
+    for position, pixels in enumerate(frames[:1] + frames[2:]):
+        Image.fromarray(pixels).save(tmp_path / f'frame_{position:03d}.png')
+    images_to_video(str(tmp_path / 'frame_%03d.png'), str(tmp_path / 'gap.mp4'), framerate=20)
+
+    # the needle is in the last frame, which is the third one in the video
+    matches = list(search_video(str(tmp_path / 'gap.mp4'), data[2700:2720]))
+    assert [match.source for match in matches] == [f"{tmp_path / 'gap.mp4'} frame 3"]
+
+
+def test_search_errors(tmp_path):
+    data = bytes(range(256)) * 12
+    frame_paths = encode(data, tile_width=32, tile_height=32, output_path=str(tmp_path))
+    needle = data[860:880]
+    expected = [offset for offset in range(len(data)) if data.startswith(needle, offset)]
+
+    # a tile of the second frame, away from the needles, that doesn't match any palette color
+    pixels = np.array(Image.open(frame_paths[1]))
+    pixels[64:96, 640:672] = (107, 107, 107)
+    Image.fromarray(pixels).save(frame_paths[1])
+
+    with pytest.raises(Exception, match='messed up'):
+        list(search_images(str(tmp_path), needle))
+    assert [match.offset for match in search_images(str(tmp_path), needle, ignore_errors=True)] == expected
+
+
+def test_frame_cache(tmp_path):
+    cache = FrameCache(tmp_path / 'frames')
+    data = bytes(range(256)) * 4
+    pixels = np.array(Frame.from_bytes(3, data, (1280, 720), 16, 16).image)
+    pixels[0:16, 17 * 16:18 * 16] = (107, 107, 107)
+
+    first = Frame.load_from_array(pixels, cache=cache)
+    decoded, unmatched = first.decode_with_mask(ignore_errors=True)
+    assert not first.from_cache
+
+    # the header and body come straight from the cache, but only while errors are ignored
+    second = Frame.load_from_array(pixels.copy(), cache=cache)
+    assert (second.frame_seqno, second.tile_width, second.body_length) == (3, 16, len(data))
+    cached, cached_unmatched = second.decode_with_mask(ignore_errors=True)
+    assert second.from_cache
+    assert cached == decoded == data[:4] + b'\x00' + data[5:]
+    assert np.array_equal(cached_unmatched, unmatched)
+    with pytest.raises(Exception):
+        second.decode()
+
+    # a different fuzziness is a different entry
+    assert Frame.load_from_array(pixels, cache=cache).cached(fuzziness=20) is None
+
+    # the least recently used entries are evicted once the cache is full
+    entry_size = os.path.getsize(cache.entry_path(first.cache_key()))
+    small_cache = FrameCache(tmp_path / 'frames', max_bytes=entry_size * 2)
+    for seqno in range(4):
+        Frame.load_from_array(Frame.from_bytes(seqno, data, (1280, 720), 16, 16).render(data), cache=small_cache).decode()
+    assert len(list((tmp_path / 'frames').glob('*.npz'))) == 2
+
+
+def test_plan_layout():
+    # anything that doesn't fit in one frame of the smallest tiles takes the fewest frames those tiles allow
+    for data_length in (1, 20, 500, 3587, 3588, 10000):
+        layout = plan_layout(data_length, (1280, 720))
+        assert layout.frames == -(-data_length // 3587)
+        assert layout.capacity * layout.frames >= data_length
+        assert min(layout.tile_width, layout.tile_height) >= 16
+
+    # a bit more than one frame's worth still gets bigger tiles than the minimum
+    layout = plan_layout(3588, (1280, 720))
+    assert layout.frames == 2 and layout.tile_width * layout.tile_height > 16 * 16
+    square = plan_layout(3588, (1280, 720), square=True)
+    assert square.tile_width == square.tile_height
+
+    # non-square tiles decode, with or without the tile size from an earlier frame
+    layout = plan_layout(1000, (1280, 720))
+    assert layout.tile_width != layout.tile_height
+    data = os.urandom(1000)
+    pixels = next(render_frames(data))
+    for tile_size in (None, (layout.tile_width, layout.tile_height)):
+        frame = Frame.load_from_array(pixels, tile_size=tile_size)
+        assert (frame.tile_width, frame.tile_height) == (layout.tile_width, layout.tile_height)
+        assert frame.decode() == data
+
+    assert estimate_encode(10000, framerate=20)['frames'] == 3
+    assert estimate_encode(10000, tile_width=48, tile_height=48)['frames'] == 27
+
+
+def test_header_v2():
+    # a frame index past the 1-byte seqno and a body longer than 65535 tiles
+    data = os.urandom(80000)
+    pixels = Frame.from_bytes(70000, data, (3840, 2160), 10, 10, version=2).render(data)
+    for tile_size in (None, (10, 10)):
+        frame = Frame.load_from_array(pixels, tile_size=tile_size)
+        assert (frame.version, frame.frame_seqno, frame.body_length) == (2, 70000, len(data))
+        assert frame.decode() == data
+
+    # version 1 frames still decode, with the seqno wrapped to one byte
+    frame = Frame.load_from_array(Frame.from_bytes(300, b'hello', (1280, 720), 16, 16).render(b'hello'))
+    assert (frame.version, frame.frame_seqno, frame.decode()) == (1, 44, b'hello')
+
+    # version 2 frames are put back in order and repeats are dropped wherever they turn up;
+    # version 1 frames can only be compared with the previous one, so anything out of order is dropped,
+    # and once a frame is dropped nothing after it lines up
+    frames = [0, 2, 1, 1, 3, 0, 4]
+    stats = Stats()
+    assert list(_reassemble([(2, 0, index, bytes([index])) for index in frames], stats)) == [bytes([index]) for index in range(5)]
+    assert stats.counters['duplicate_frames'] == 2
+    assert list(_reassemble([(1, 0, index, bytes([index])) for index in frames], Stats())) == [b'\x00', b'\x01']
+
+
+def test_compression():
+    with open('tests/test_data/loremipsum.txt', 'rb') as f:
+        text = f.read() * 10
+
+    uncompressed = list(render_frames(text))
+    for compression in ('zlib', 'lzma'):
+        # streams are compressed as they're read
+        for data in (text, io.BytesIO(text)):
+            frames = list(render_frames(data, compression=compression, tile_width=16, tile_height=16))
+            assert len(frames) < len(uncompressed)
+            assert Frame.load_from_array(frames[0]).codec != 0
+            assert b''.join(_decode_frames(frames)) == text
+
+    # data that's already compressed is left alone
+    random_data = os.urandom(5000)
+    frames = list(render_frames(random_data, compression='zlib'))
+    assert Frame.load_from_array(frames[0]).codec == 0
+    assert b''.join(_decode_frames(frames)) == random_data
+
+    # byte ranges are offsets into the stored data, which isn't the original data when it's compressed
+    with pytest.raises(Exception):
+        list(_decode_frames(render_frames(text, compression='zlib'), decompress=False))
+
+    encode(text, output_path='tests', compression='zlib')
+    needle = text[5000:5020]
+    assert [match.offset for match in search_images('tests', needle)] == \
+           [offset for offset in range(len(text)) if text.startswith(needle, offset)]
+
+
+def test_fec_capacity():
+    assert steg_fec.data_capacity(256, 32) == 223
+    for tiles in (0, 1, 32, 33, 254, 255, 256, 287, 288, 510, 3585):
+        for nsym in (1, 16, 32, 100):
+            capacity = steg_fec.data_capacity(tiles, nsym)
+            assert capacity == 0 or steg_fec.encoded_length(capacity, nsym) <= tiles
+            assert steg_fec.encoded_length(capacity + 1, nsym) > tiles
+
+    # a frame filled to that capacity still decodes
+    data = os.urandom(frame_capacity((1280, 720), 16, 16, 32))
+    assert len(data) == 3122
+    frames = list(render_frames(data, tile_width=16, tile_height=16, fec=32))
+    assert len(frames) == 1 and b''.join(_decode_frames(frames)) == data
+
+
+def test_error_correction(tmp_path):
+    data = os.urandom(20000)
+    frames = list(render_frames(data, tile_width=12, tile_height=12, fec=32))
+    assert len(frames) == 4
+    assert b''.join(_decode_frames(frames)) == data
+
+    # wrong colors and colors that aren't in the palette, spread over the body but within what each codeword can fix
+    palette = np.asarray(generate_default_palette(), dtype=np.uint8)
+    rng = random.Random(0)
+    damaged = []
+    for pixels in frames:
+        pixels = pixels.copy()
+        tiles = rng.sample(range(Frame.header_length_bytes + 1, 106 * 60), 150)
+        for n, tile in enumerate(tiles):
+            row, column = divmod(tile, 106)
+            pixels[row * 12:(row + 1) * 12, column * 12:(column + 1) * 12] = palette[n] if n % 2 else (107, 107, 107)
+        damaged.append(pixels)
+
+    frame = Frame.load_from_array(damaged[0], tile_size=(12, 12), cache=FrameCache(tmp_path))
+    assert (frame.version, frame.fec, frame.body_length) == (3, 32, len(frame.decode()))
+    assert frame.corrected_tiles > 0
+    assert Frame.load_from_array(damaged[0], cache=FrameCache(tmp_path)).decode() == frame.decode()
+
+    stats = Stats()
+    assert b''.join(_decode_frames(damaged, stats=stats)) == data
+    assert stats.counters['unmatched_tiles'] == 0
+    assert stats.counters['corrected_tiles'] > 0
+
+    # past that, a codeword can't be fixed and the frame is an error like any other
+    pixels = frames[0].copy()
+    pixels[12:252] = (107, 107, 107)
+    with pytest.raises(Exception):
+        Frame.load_from_array(pixels).decode()
+    decoded, unmatched = Frame.load_from_array(pixels).decode_with_mask(ignore_errors=True)
+    assert unmatched.any() and len(decoded) == len(unmatched)
+
+
+def test_palette(tmp_path, monkeypatch):
+    monkeypatch.setenv('STEG_CACHE_DIR', str(tmp_path))
+    palette = Palette.scrambled('correct horse battery staple')
+    assert palette == Palette.scrambled('correct horse battery staple')
+    assert palette != Palette.scrambled('correct horse battery stapler')
+    assert sorted(palette) == sorted(DEFAULT_PALETTE) and not palette.is_default
+
+    # a 256-byte file gives each default color a value, and a 768-byte file gives each value a color
+    (tmp_path / 'reversed.pal').write_bytes(bytes(reversed(range(256))))
+    reversed_palette = Palette.from_file(tmp_path / 'reversed.pal')
+    assert reversed_palette[255] == DEFAULT_PALETTE[0]
+    (tmp_path / 'full.pal').write_bytes(reversed_palette.to_bytes())
+    assert Palette.from_file(tmp_path / 'full.pal') == reversed_palette
+    (tmp_path / 'short.pal').write_bytes(bytes(100))
+    with pytest.raises(Exception):
+        Palette.from_file(tmp_path / 'short.pal')
+
+    data = os.urandom(20000)
+    frames = list(render_frames(data, tile_width=16, tile_height=16, palette=palette, fec=16))
+    assert len(frames) == -(-len(data) // frame_capacity((1280, 720), 16, 16, 16, palette))
+    frame = Frame.load_from_array(frames[0])
+    # the header is still in the default palette, and names the body's in 4 more tiles than a version 3 header
+    assert (frame.version, frame.fec, frame.palette) == (4, 16, palette)
+    assert frame_capacity((1280, 720), 16, 16, palette=palette) == frame_capacity((1280, 720), 16, 16) - 5
+    assert b''.join(_decode_frames(frames, workers=2)) == data
+
+    # somewhere the palette was never registered, the frames can't be read until it is
+    monkeypatch.setattr('steg.palette._registry', {DEFAULT_PALETTE.id: DEFAULT_PALETTE})
+    monkeypatch.setenv('STEG_CACHE_DIR', str(tmp_path / 'elsewhere'))
+    with pytest.raises(Exception, match='palette'):
+        Frame.load_from_array(frames[0])
+    register_palette(Palette.scrambled('correct horse battery staple'))
+    assert b''.join(_decode_frames(frames)) == data
+
+
+def test_drop_repeats():
+    data = os.urandom(20000)
+    frames = list(render_frames(data, tile_width=16, tile_height=16))
+    # as if a 3 fps video were played back at 15 fps
+    repeated = [pixels for pixels in frames for _ in range(5)]
+    for workers in (1, 2):
+        stats = Stats()
+        assert b''.join(_decode_frames(repeated, workers=workers, stats=stats)) == data
+        assert stats.counters['frames'] == len(repeated)
+        assert stats.counters['duplicate_frames'] == len(repeated) - len(frames)
+        # only the frames that were kept had their bodies classified
+        assert stats.counters['tiles'] == len(data)
+
+
+def test_decode_to_file(tmp_path):
+    data = os.urandom(30000)
+    frames = list(render_frames(data, tile_width=16, tile_height=16))
+    capacity = len(Frame.load_from_array(frames[0]).decode())
+    output_path = tmp_path / 'out.bin'
+
+    # out of order and repeated, with the workers finishing in any order
+    shuffled = frames[3:] + frames[:3] + frames[:1]
+    for workers in (1, 2):
+        stats = Stats()
+        assert _decode_frames_to_file(shuffled, output_path, workers=workers, stats=stats, size_hint=len(data)) == []
+        assert output_path.read_bytes() == data
+        assert stats.counters['duplicate_frames'] == 1
+
+    # whatever was decoded is on disk, and the gaps are listed
+    assert _decode_frames_to_file(frames[:2] + frames[4:6], output_path) == [2, 3]
+    written = output_path.read_bytes()
+    assert len(written) == 6 * capacity
+    assert written[:2 * capacity] == data[:2 * capacity]
+    assert written[4 * capacity:] == data[4 * capacity:6 * capacity]
+    assert written[2 * capacity:4 * capacity] == bytes(2 * capacity)
+
+    # with the payload length known, frames lost after the last one to arrive are listed too
+    assert _decode_frames_to_file(frames[:2] + frames[4:5], output_path, size_hint=len(data)) == [2, 3] + list(range(5, len(frames)))
+
+    # frames are only placed by offset when the header says where they go
+    for frame in (Frame.from_bytes(0, b'hello', (1280, 720), 16, 16).render(b'hello'),
+                  next(render_frames(b'a' * 30000, compression='zlib'))):
+        with pytest.raises(Exception):
+            _decode_frames_to_file([frame], output_path)
+
+
+def test_decode_stream(tmp_path):
+    data = os.urandom(30000)
+    frames = list(render_frames(data, tile_width=16, tile_height=16))
+
+    async def from_list(items):
+        for item in items:
+            yield item
+
+    async def decode_all(frames, **kwargs):
+        return b''.join([chunk async for chunk in _decode_frames_async(frames, **kwargs)])
+
+    for workers in (1, 2):
+        stats = Stats()
+        assert asyncio.run(decode_all(from_list([pixels for pixels in frames for _ in range(2)]), workers=workers, stats=stats)) == data
+        assert stats.counters['duplicate_frames'] == len(frames)
+
+    # straight from ffmpeg, which is stopped if decoding stops early
+    data = os.urandom(200000)
+    video_path = str(tmp_path / 'out.mp4')
+    encode_video(data, video_path, framerate=3)
+    assert asyncio.run(decode_all(video_frames_async(video_path, (1280, 720)))) == data
+
+    async def first_frame():
+        async for pixels in video_frames_async(video_path, (1280, 720)):
+            return pixels
+    assert Frame.load_from_array(asyncio.run(first_frame())).frame_seqno == 0
+
+
+def test_archive(tmp_path):
+    paths = []
+    for i, size in enumerate([5000, 0, 3, 12000]):
+        path = tmp_path / f'{i}.bin'
+        path.write_bytes(os.urandom(size))
+        paths.append(str(path))
+    names = ['a', 'empty', 'b/c', 'd']
+
+    manifest, payload = pack(paths, names)
+    payload = b''.join(payload)
+    assert len(payload) == manifest.total_bytes
+    # all the files share the frames, rather than each one getting a partly filled last frame of its own
+    frames = list(render_frames(payload, tile_width=16, tile_height=16))
+    assert len(frames) == -(-manifest.total_bytes // frame_capacity((1280, 720), 16, 16))
+
+    decoded = b''.join(_decode_frames(frames))
+    assert Manifest.from_bytes(decoded).to_bytes() == manifest.to_bytes()
+    for name, path in zip(names, paths):
+        entry = manifest.find(name)
+        assert decoded[entry.offset:entry.offset + entry.size] == open(path, 'rb').read()
+
+    with pytest.raises(Exception):
+        manifest.find('missing')
+    with pytest.raises(Exception):
+        pack(paths[:2], ['a', 'a'])
+    with pytest.raises(Exception):
+        Manifest.from_bytes(os.urandom(100))
+
+
+def test_extract_from_archive(tmp_path):
+    paths = []
+    for i in range(200):
+        path = tmp_path / f'{i}.bin'
+        path.write_bytes(os.urandom(random.randint(0, 2000)))
+        paths.append(str(path))
+    video_path = str(tmp_path / 'archive.mp4')
+    encode_archive(paths, video_path, framerate=3)
+
+    for index_path in (FrameIndex.sidecar_path(video_path), None):
+        for path in (paths[0], paths[100], paths[-1]):
+            sink = io.BytesIO()
+            entry = extract(video_path, archive_name(path), sink)
+            assert sink.getvalue() == open(path, 'rb').read()
+            assert entry.size == len(sink.getvalue())
+        # without the sidecar, the frames are found by scanning the video's headers
+        if index_path is not None:
+            os.remove(index_path)
+
+    # a copy at a higher frame rate repeats every frame, so frame positions can't be worked out from offsets
+    repeated_path = str(tmp_path / 'repeated.mp4')
+    ffmpeg.input(video_path).filter('fps', 6).output(repeated_path, vcodec='libx264', qp=0, preset='ultrafast', pix_fmt='yuv420p').run(quiet=True)
+    sink = io.BytesIO()
+    extract(repeated_path, archive_name(paths[-1]), sink)
+    assert sink.getvalue() == open(paths[-1], 'rb').read()
+
+    # an index from before the video was re-encoded is pointed out
+    shutil.copy(FrameIndex.sidecar_path(video_path), FrameIndex.sidecar_path(repeated_path))
+    with pytest.raises(Exception, match='delete it'):
+        extract(repeated_path, archive_name(paths[-1]), io.BytesIO())
+
+
+def test_server(tmp_path):
+    palette = Palette.scrambled('test_server')
+    service = StegService(workers=1, root=str(tmp_path), palettes=[palette])
+    service.warm()
+    server = make_server(service, port=0, quiet=True, token='secret')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection = http.client.HTTPConnection(*server.server_address)
+    try:
+
+        def post(path, body, **headers):
+            connection.request('POST', path, body=body, headers={'X-Steg-Token': 'secret', **headers})
+            response = connection.getresponse()
+            return response, response.read()
+
+        data = os.urandom(3000)
+        response, image = post('/encode/frame?tile_size=16', data)
+        assert response.status == 200
+        assert 'render;dur=' in response.getheader('Server-Timing')
+        assert post('/decode/frame', image)[1] == data
+
+        response, pixels = post('/encode/frame?format=raw&width=640&height=360&fec=8', data[:500])
+        assert len(pixels) == 640 * 360 * 3
+        assert post('/decode/frame?format=raw&width=640&height=360', pixels)[1] == data[:500]
+
+        # errors don't cost the client its connection
+        response, message = post('/encode/frame?tile_size=48', data)
+        assert response.status == 400
+        assert b"fit in one frame" in message
+
+        # palettes come from the ones the server was started with
+        response, image = post(f'/encode/frame?palette={palette.id:08x}', data)
+        assert post('/decode/frame', image)[1] == data
+        response, message = post(f'/encode/frame?palette={Palette.scrambled("other").id:08x}', data)
+        assert response.status == 400
+        assert b"wasn't loaded" in message
+
+        connection.request('GET', '/status', headers={'X-Steg-Token': 'secret'})
+        status = json.loads(connection.getresponse().read())
+        assert (status['queued'], status['completed'], status['failed']) == (0, 6, 1)
+        assert [job['kind'] for job in status['recent']] == ['encode_frame', 'decode_frame'] * 2 + ['encode_frame'] + ['encode_frame', 'decode_frame']
+
+        # videos stay in the root directory
+        video_data = os.urandom(10000)
+        response, body = post(f'/encode?output=out.mp4&tile_size=32&palette={palette.id:08x}', video_data)
+        assert response.status == 200
+        assert json.loads(body)['frames'] == 12
+        assert (tmp_path / 'out.mp4').exists() and (tmp_path / 'out.mp4.index.json').exists()
+        assert post('/decode?input=out.mp4', b'')[1] == video_data
+        for path in ('../out.mp4', str(tmp_path.parent / 'out.mp4'), 'sub/../../out.mp4'):
+            response, message = post(f'/encode?output={path}', video_data)
+            assert response.status == 400
+            assert b"is outside of" in message
+            response, message = post(f'/decode?input={path}', b'')
+            assert response.status == 400
+            assert b"is outside of" in message
+        assert not (tmp_path.parent / 'out.mp4').exists()
+    finally:
+        connection.close()
+
+    # requests from web pages, or without the token, are refused before they're read
+    for headers in ({'X-Steg-Token': 'wrong'}, {}, {'X-Steg-Token': 'secret', 'Host': 'evil.example'},
+                    {'X-Steg-Token': 'secret', 'Origin': 'https://evil.example'}):
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request('POST', '/encode/frame', body=data, headers=headers)
+        assert connection.getresponse().status == 403
+        connection.close()
+    connection = http.client.HTTPConnection(*server.server_address)
+    try:
+        connection.request('GET', '/status', headers={'X-Steg-Token': 'secret', 'Origin': 'http://localhost:3000'})
+        assert connection.getresponse().status == 200
+    finally:
+        connection.close()
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def test_server_socket(tmp_path):
+    service = StegService(workers=1)
+    try:
+        # a socket left behind by a server that didn't shut down cleanly is replaced
+        socket_path = str(tmp_path / 'steg.sock')
+        make_server(service, unix_socket=socket_path, quiet=True).server_close()
+        make_server(service, unix_socket=socket_path, quiet=True).server_close()
+
+        # but anything else at the path is left alone
+        file_path = tmp_path / 'data.bin'
+        file_path.write_bytes(b'keep me')
+        with pytest.raises(Exception, match="isn't a socket"):
+            make_server(service, unix_socket=str(file_path), quiet=True)
+        assert file_path.read_bytes() == b'keep me'
+    finally:
+        service.close()
@@ -7,6 +7,12 @@ export async function getTextFile(url) {
 
 const frameDecoderShaderWgsl = await getTextFile('frame_decoder_shader.wgsl');
 
+// id of the palette the shader decodes, which version 4 headers name when a frame uses any other (see steg/palette.py)
+const DEFAULT_PALETTE_ID = 0x685e58d4;
+// codec ids in version 2 headers (see steg/codec.py). Browsers can't decompress lzma
+const ZLIB_CODEC = 1;
+const LZMA_CODEC = 2;
+
 export async function getImage(url) {
     const file = await fetch(url);
     return await createImageBitmap(await file.blob(), {colorSpaceConversion: 'none'});
@@ -146,6 +152,7 @@ export async function decodeVideo(video) {
     let view;
     let prevFrameSeqNo = -1;
     let nextFrameSeqNoExpected = 0;
+    let payloadCodec = 0;
     // reduce the array of uint8arrays down to a single one.
     // a uint8array is backed by an ArrayBuffer of a fixed size, so we need to transfer each one into a new one
     results.forEach((frame, ii, results) => {
@@ -160,17 +167,49 @@ export async function decodeVideo(video) {
             return;
         }
 
+        const version = frame[2];
+        if (version > 4) {
+            throw new Error(`frame header version ${version} isn't supported, try the python decoder`);
+        }
+        // version 3 adds the error correction byte, and version 4 the palette id after it
+        const headerLength = 13 + (version >= 3 ? 1 : 0) + (version >= 4 ? 4 : 0);
+        if (version >= 3 && frame[13] !== 0) {
+            // these bodies are interleaved with Reed-Solomon parity, which isn't decoded here
+            throw new Error("frames with error correction can only be decoded with the python decoder");
+        }
+        if (version >= 4) {
+            const paletteId = ((frame[14] << 24) | (frame[15] << 16) | (frame[16] << 8) | frame[17]) >>> 0;
+            if (paletteId !== DEFAULT_PALETTE_ID) {
+                throw new Error(`frames drawn in palette ${paletteId.toString(16).padStart(8, "0")} can only be decoded with the python decoder, given the same --palette or --palette-seed`);
+            }
+        }
+        // version 2 headers say in byte 4 which codec the payload was compressed with, if any
+        const codec = version >= 2 ? frame[4] : 0;
+        if (codec === LZMA_CODEC) {
+            throw new Error("payloads compressed with lzma can only be decoded with the python decoder");
+        }
+        if (codec !== 0 && codec !== ZLIB_CODEC) {
+            throw new Error(`payload is compressed with unknown codec ${codec}`);
+        }
+        payloadCodec = codec;
+
         prevFrameSeqNo = frameSeqNo;
         nextFrameSeqNoExpected = (frameSeqNo + 1) % 256;
 
-        // header bytes 8 and 9 contain the payload length (16 bits big-endian)
-        const len = (frame[8] << 8) + frame[9];
+        // header bytes 8 and 9 contain the payload length (16 bits big-endian).
+        // version 2 headers keep bits 16-23 in byte 3
+        const len = (frame[2] >= 2 ? frame[3] << 16 : 0) + (frame[8] << 8) + frame[9];
         // note which index we want to insert this frame's payload at
         const bufferFrameStartIndex = result.maxByteLength;
         result = result.transfer(result.maxByteLength + len);
         view = new Uint8Array(result);
-        view.set(frame.slice(13, 13 + len), bufferFrameStartIndex);
+        view.set(frame.slice(headerLength, headerLength + len), bufferFrameStartIndex);
     })
 
+    if (payloadCodec === ZLIB_CODEC) {
+        // the payload is compressed as a whole before it's split into frames, so it's decompressed once it's all here
+        const decompressed = new Blob([view]).stream().pipeThrough(new DecompressionStream('deflate'));
+        return new Uint8Array(await new Response(decompressed).arrayBuffer());
+    }
     return view;
 }